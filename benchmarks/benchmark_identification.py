@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""Report the magic number sniffer's hit rate and speedup over fido and python-magic.
+
+Reads the response and resource payloads of the given WARC/ARC files,
+identifies each one with full identification (fido and python-magic)
+and with the sniffer first, and reports how many payloads the sniffer
+answered, how often its PUID agreed with fido, and the time each
+approach took.
+"""
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+
+from warcio.archiveiterator import ArchiveIterator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import warc_metadata_sidecar as sidecar  # noqa: E402
+
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+
+
+def read_payloads(warc_files):
+    """Collect the non-empty response and resource payloads of the WARC/ARC files."""
+    payloads = []
+    for warc_file in warc_files:
+        with open(warc_file, 'rb') as stream:
+            for record in ArchiveIterator(stream, arc2warc=True):
+                if record.rec_type not in ['response', 'resource']:
+                    continue
+                if sidecar.DNS.match(record.rec_headers.get_header('WARC-Target-URI')):
+                    continue
+                payload = record.content_stream().read()
+                if payload:
+                    payloads.append(payload)
+    return payloads
+
+
+def time_identification(fido, payloads, full_identification, repeat):
+    """Identify every payload repeat times and return the results and the elapsed time."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [sidecar.find_mime_and_puid(fido, io.BytesIO(payload), full_identification)
+                   for payload in payloads]
+    return (results, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'warc_files',
+        nargs='*',
+        help='WARC/ARC files to read payloads from. Defaults to the test WARCs.'
+    )
+    parser.add_argument(
+        '--repeat',
+        action='store',
+        type=int,
+        default=20,
+        help='The number of times to identify each payload.'
+    )
+    args = parser.parse_args()
+    warc_files = args.warc_files or sorted(glob.glob(os.path.join(TEST_DIR, '*.warc')) +
+                                           glob.glob(os.path.join(TEST_DIR, '*.arc')))
+    payloads = read_payloads(warc_files)
+    if not payloads:
+        sys.exit('No payloads found')
+    fido = sidecar.ExtendFido()
+    full_results, full_time = time_identification(fido, payloads, True, args.repeat)
+    sniff_results, sniff_time = time_identification(fido, payloads, False, args.repeat)
+
+    hits = 0
+    agreed = 0
+    for (full_mimes, full_puid), (sniff_mimes, sniff_puid) in zip(full_results, sniff_results):
+        if 'sniffer' in sniff_mimes:
+            hits += 1
+            if sniff_puid == full_puid:
+                agreed += 1
+    print('Payloads: {}'.format(len(payloads)))
+    print('Sniffer hit rate: {}/{} ({:.1%})'.format(hits, len(payloads), hits / len(payloads)))
+    if hits:
+        print('Sniffer PUID agreement with fido: {}/{} ({:.1%})'.format(
+            agreed, hits, agreed / hits))
+    print('Full identification: {:.2f} ms/payload'.format(
+        full_time * 1000 / (len(payloads) * args.repeat)))
+    print('Sniffer first: {:.2f} ms/payload'.format(
+        sniff_time * 1000 / (len(payloads) * args.repeat)))
+    print('Speedup: {:.1f}x'.format(full_time / sniff_time))
+
+
+if __name__ == '__main__':
+    main()
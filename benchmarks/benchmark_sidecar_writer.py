@@ -0,0 +1,99 @@
+#!/usr/bin/python
+"""Compare sidecar write throughput and size across compression levels and compressors.
+
+Writes the same synthetic metadata records, about 300 bytes of payload
+each, to a temporary file with every available compressor at a range
+of compression levels, then reports records/sec, MB/sec of uncompressed
+input, and the size of the resulting sidecar. The first row is warcio's
+own WARCWriter, which flushes the file after every record, as a baseline.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+from warcio.warcwriter import WARCWriter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import warc_metadata_sidecar as sidecar  # noqa: E402
+
+
+def create_payloads(total):
+    """Create metadata payloads similar in size and content to real sidecar records."""
+    payloads = []
+    for number in range(total):
+        mime_dict = {'fido': 'text/html', 'python-magic': 'text/html'}
+        result_dict = {'encoding': 'utf-8', 'confidence': 0.99}
+        lang_cld = {'reliable': True,
+                    'text-bytes': 1000 + number,
+                    'languages': [{'name': 'ENGLISH', 'code': 'en', 'text-covered': 99,
+                                   'score': 1000.0 + number}]}
+        payloads.append(sidecar.create_string_payload(mime_dict, 'fmt/471', result_dict,
+                                                      lang_cld, 0.01 * (number % 100)))
+    return payloads
+
+
+def time_writer(payloads, compress_level=None, compressor=None):
+    """Write each payload as a metadata record and return the elapsed time and sizes."""
+    with tempfile.TemporaryFile() as output:
+        if compressor:
+            writer = sidecar.SidecarWriter(output, compress_level, compressor)
+        else:
+            writer = WARCWriter(output, gzip=True)
+        elapsed, raw_bytes = write_records(writer, payloads)
+        return (elapsed, raw_bytes, output.tell())
+
+
+def write_records(writer, payloads):
+    """Write the payloads with the writer and return the elapsed time and payload bytes."""
+    warc_dict = {'WARC-Date': '2021-11-11T21:11:11Z',
+                 'WARC-Concurrent-ID': '<urn:uuid:6fd6ed4c-9b12-4a3b-9b2a-8e47a1c5a0b1>'}
+    raw_bytes = 0
+    start = time.perf_counter()
+    for number, string_payload in enumerate(payloads):
+        record = writer.create_warc_record('https://www.unt.edu/{}'.format(number),
+                                           'metadata',
+                                           payload=io.BytesIO(string_payload.encode()),
+                                           warc_headers_dict=warc_dict)
+        writer.write_record(record)
+        raw_bytes += len(string_payload)
+    writer.out.flush()
+    elapsed = time.perf_counter() - start
+    return (elapsed, raw_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--records',
+        action='store',
+        type=int,
+        default=20000,
+        help='The number of metadata records to write for each combination.'
+    )
+    parser.add_argument(
+        '--levels',
+        action='store',
+        default='1,6,9',
+        help='A comma separated list of compression levels to compare.'
+    )
+    args = parser.parse_args()
+    payloads = create_payloads(args.records)
+    levels = [int(level) for level in args.levels.split(',')]
+    row = '{:<10}{:>7}{:>14.0f}{:>10.2f}{:>14}'
+    print('{:<10}{:>7}{:>14}{:>10}{:>14}'.format('compressor', 'level', 'records/sec',
+                                                 'MB/sec', 'sidecar bytes'))
+    elapsed, raw_bytes, size = time_writer(payloads)
+    print(row.format('warcio', 9, len(payloads) / elapsed, raw_bytes / elapsed / 1000000, size))
+    for compressor in sorted(sidecar.COMPRESSORS):
+        for compress_level in levels:
+            elapsed, raw_bytes, size = time_writer(payloads, compress_level, compressor)
+            print(row.format(compressor, compress_level, len(payloads) / elapsed,
+                             raw_bytes / elapsed / 1000000, size))
+
+
+if __name__ == '__main__':
+    main()
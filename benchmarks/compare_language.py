@@ -0,0 +1,106 @@
+#!/usr/bin/python
+"""Compare markup-aware, sampled language detection with detection on the whole payload.
+
+For each text payload of the given WARC/ARC files, detects the language
+the old way (the whole decoded payload, tags included) and the new way
+(visible text of HTML, sampled down to --lang-max-chars), then prints
+the top language, reliability and text bytes of each, whether they
+agree, and the total time each approach took.
+"""
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+
+from warcio.archiveiterator import ArchiveIterator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import warc_metadata_sidecar as sidecar  # noqa: E402
+
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+
+
+def read_text_payloads(warc_files):
+    """Collect the URL, payload and HTML flag of each text response or resource record."""
+    fido = sidecar.ExtendFido()
+    text_payloads = []
+    for warc_file in warc_files:
+        with open(warc_file, 'rb') as stream:
+            for record in ArchiveIterator(stream, arc2warc=True):
+                if record.rec_type not in ['response', 'resource']:
+                    continue
+                url = record.rec_headers.get_header('WARC-Target-URI')
+                if sidecar.DNS.match(url):
+                    continue
+                payload = record.content_stream().read()
+                if not payload:
+                    continue
+                mime_dict, _ = sidecar.find_mime_and_puid(fido, io.BytesIO(payload))
+                mimes_found = ' '.join(mime_dict.values())
+                if sidecar.TEXT_FORMAT_MIMES.search(mimes_found):
+                    text_payloads.append((url, payload, 'html' in mimes_found))
+    return text_payloads
+
+
+def describe(lang_cld):
+    """Summarize a find_language result as its top language, reliability and text bytes."""
+    if not lang_cld:
+        return ('-', '-', 0)
+    return (lang_cld['languages'][0]['code'], lang_cld['reliable'], lang_cld['text-bytes'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'warc_files',
+        nargs='*',
+        help='WARC/ARC files to read payloads from. Defaults to the test WARCs.'
+    )
+    parser.add_argument(
+        '--lang-max-chars',
+        action='store',
+        type=int,
+        default=sidecar.LANG_MAX_CHARS,
+        help='The number of characters of text used for language detection.'
+    )
+    parser.add_argument(
+        '--lang-samples',
+        action='store',
+        type=int,
+        default=sidecar.LANG_SAMPLES,
+        help='The number of evenly spaced samples taken from longer text.'
+    )
+    args = parser.parse_args()
+    warc_files = args.warc_files or sorted(glob.glob(os.path.join(TEST_DIR, '*.warc')) +
+                                           glob.glob(os.path.join(TEST_DIR, '*.arc')))
+    text_payloads = read_text_payloads(warc_files)
+
+    old_time = 0
+    new_time = 0
+    agreed = 0
+    row = '{:<50} {:>5} {:>6} {:>8}   {:>5} {:>6} {:>8}   {}'
+    print(row.format('url', 'old', 'rel', 'bytes', 'new', 'rel', 'bytes', 'agree'))
+    for url, payload, is_html in text_payloads:
+        start = time.perf_counter()
+        old = describe(sidecar.find_language(payload, False, 0))
+        old_time += time.perf_counter() - start
+        start = time.perf_counter()
+        new = describe(sidecar.find_language(payload, is_html, args.lang_max_chars,
+                                             args.lang_samples))
+        new_time += time.perf_counter() - start
+        agree = old[0] == new[0]
+        agreed += agree
+        print(row.format(url[:50], old[0], str(old[1]), old[2], new[0], str(new[1]), new[2],
+                         'yes' if agree else 'NO'))
+    if text_payloads:
+        print('Top language agreement: {}/{}'.format(agreed, len(text_payloads)))
+        print('Whole payload: {:.2f} ms total, markup-aware sampled: {:.2f} ms total'.format(
+            old_time * 1000, new_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,21 @@
 import argparse
+import hashlib
+import itertools
 import json
 import logging
 import os
 import re
 import time
+import zlib
 from datetime import timedelta
 
 from langcodes import Language
 
 
+# The number of CDXJ lines in each block tracked by the incremental merge manifest.
+BLOCK_SIZE = 3000
+
+
 def get_alpha3_language_codes(lang_list):
     """Find each language code and convert it to alpha3 using langcodes."""
     codes = []
@@ -36,8 +43,11 @@ def get_sidecar_fields(original_obj, meta_obj):
         # Choosing python-magic over fido, due to broader choices.
         if meta_obj['Identified-Payload-Type'].get('python-magic'):
             mime = meta_obj['Identified-Payload-Type']['python-magic']
-        else:
+        elif meta_obj['Identified-Payload-Type'].get('fido'):
             mime = meta_obj['Identified-Payload-Type']['fido']
+        else:
+            # Common formats identified from their magic numbers alone.
+            mime = meta_obj['Identified-Payload-Type']['sniffer']
         original_obj['mime-detected'] = mime
     if meta_obj.get('Preservation-Identifier'):
         puid = meta_obj['Preservation-Identifier']
@@ -93,6 +103,186 @@ def create_dict_from_meta(meta_cdxj):
     return meta_dict
 
 
+def create_raw_dict_from_meta(meta_cdxj):
+    """Map each URL/timestamp key to its JSON object string, leaving parsing for later."""
+    raw_meta_dict = {}
+    for line in meta_cdxj:
+        m_key, timestamp, meta_obj = line.split(' ', 2)
+        raw_meta_dict[m_key + ' ' + timestamp] = meta_obj.strip()
+    return raw_meta_dict
+
+
+def iter_blocks(original_cdxj, block_size):
+    """Yield lists of up to block_size lines from the original CDXJ."""
+    while True:
+        block = list(itertools.islice(original_cdxj, block_size))
+        if not block:
+            return
+        yield block
+
+
+def get_block_keys(block):
+    """Return the URL/timestamp key of each line in a block."""
+    keys = []
+    for line in block:
+        urlkey, timestamp, _ = line.split(' ', 2)
+        keys.append(urlkey + ' ' + timestamp)
+    return keys
+
+
+def block_checksum(block, raw_meta_dict):
+    """Hash the lines of an original CDXJ block together with the sidecar data they match."""
+    digest = hashlib.sha1()
+    for line, key in zip(block, get_block_keys(block)):
+        digest.update(line.encode('utf-8'))
+        digest.update(raw_meta_dict.get(key, '').encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def create_manifest_path(cdxj_path):
+    """Return the path of the block manifest kept beside a merged CDXJ."""
+    return cdxj_path + '.manifest.json'
+
+
+def remove_stale_manifest(cdxj_path):
+    """Remove the block manifest of a merged CDXJ that is about to be fully rewritten."""
+    manifest_path = create_manifest_path(cdxj_path)
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+
+
+def read_manifest(manifest_path, block_size):
+    """Load a block manifest, or return None if it is missing or uses another block size."""
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('block_size') != block_size:
+        logging.info('Ignoring manifest built with a block size of %s',
+                     manifest.get('block_size'))
+        return None
+    return manifest
+
+
+def compress_block(data):
+    """Compress a block of CDXJ lines into a single gzip member."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS + 16)
+    return compressor.compress(data) + compressor.flush()
+
+
+def merge_block(block, raw_meta_dict, zipnum=False):
+    """Merge one block of original CDXJ lines, parsing only the sidecar data it needs."""
+    meta_dict = {}
+    for key in get_block_keys(block):
+        if key in raw_meta_dict and key not in meta_dict:
+            meta_dict[key] = json.loads(raw_meta_dict[key])
+    list_of_merged, edited, _ = merge_meta_fields(meta_dict, block)
+    data = ''.join(list_of_merged).encode('utf-8')
+    if zipnum:
+        data = compress_block(data)
+    return (data, edited)
+
+
+def incremental_merge(metadata_cdxj, warc_cdxj, cdxj_path, block_size=BLOCK_SIZE, zipnum=False):
+    """Merge the CDXJs, reusing blocks of the previous merged CDXJ whose inputs are unchanged.
+
+    The original CDXJ is read in blocks of block_size lines. A manifest
+    beside the merged CDXJ stores a checksum of each block's original
+    lines and matching sidecar data, along with the block's location in
+    the merged CDXJ. Blocks with a known checksum are copied from the
+    previous merged CDXJ, and only the changed blocks are merged again.
+    With zipnum, each block is stored as its own gzip member.
+    Returns the number of merged records, the number of reused blocks,
+    and the first key, offset, and length of each block.
+    """
+    manifest_path = create_manifest_path(cdxj_path)
+    manifest = None
+    if os.path.isfile(cdxj_path):
+        manifest = read_manifest(manifest_path, block_size)
+    old_blocks = {}
+    if manifest:
+        for block_info in manifest['blocks']:
+            old_blocks[block_info['checksum']] = block_info
+
+    with open(metadata_cdxj, 'r') as meta_cdxj:
+        raw_meta_dict = create_raw_dict_from_meta(meta_cdxj)
+
+    edited_count = 0
+    reused_count = 0
+    new_blocks = []
+    block_entries = []
+    temp_path = cdxj_path + '.tmp'
+    with open(warc_cdxj, 'r') as original_cdxj, open(temp_path, 'wb') as merged_cdxj, \
+         open(cdxj_path if old_blocks else os.devnull, 'rb') as old_cdxj:
+        for block in iter_blocks(original_cdxj, block_size):
+            checksum = block_checksum(block, raw_meta_dict)
+            block_info = old_blocks.get(checksum)
+            if block_info:
+                old_cdxj.seek(block_info['offset'])
+                data = old_cdxj.read(block_info['length'])
+                edited = block_info['edited']
+                reused_count += 1
+            else:
+                data, edited = merge_block(block, raw_meta_dict, zipnum)
+            new_blocks.append({'checksum': checksum,
+                               'offset': merged_cdxj.tell(),
+                               'length': len(data),
+                               'edited': edited})
+            block_entries.append((get_block_keys(block)[0], merged_cdxj.tell(), len(data)))
+            merged_cdxj.write(data)
+            edited_count += edited
+    os.replace(temp_path, cdxj_path)
+
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump({'block_size': block_size, 'blocks': new_blocks}, manifest_file)
+    logging.info('Reused %s of %s blocks from the previous merge', reused_count, len(new_blocks))
+    return (edited_count, reused_count, block_entries)
+
+
+def zipnum_merge(metadata_cdxj, warc_cdxj, gz_path, block_size=BLOCK_SIZE):
+    """Merge the CDXJs into gzip compressed blocks of block_size lines.
+
+    Returns the number of merged records and the first key, offset,
+    and length of each block.
+    """
+    edited_count = 0
+    block_entries = []
+    with open(gz_path, 'wb') as merged_cdxj, open(metadata_cdxj, 'r') as meta_cdxj, \
+         open(warc_cdxj, 'r') as original_cdxj:
+        meta_dict = create_dict_from_meta(meta_cdxj)
+        for block in iter_blocks(original_cdxj, block_size):
+            list_of_merged, edited, _ = merge_meta_fields(meta_dict, block)
+            data = compress_block(''.join(list_of_merged).encode('utf-8'))
+            block_entries.append((get_block_keys(block)[0], merged_cdxj.tell(), len(data)))
+            merged_cdxj.write(data)
+            edited_count += edited
+    return (edited_count, block_entries)
+
+
+def create_zipnum_paths(cdxj_path):
+    """Return the paths of the compressed CDXJ, summary index, and location file for ZipNum."""
+    base_path = re.sub(r'\.cdxj$', '', cdxj_path)
+    return (base_path + '.cdxj.gz', base_path + '.idx', base_path + '.loc')
+
+
+def write_zipnum_summary(gz_path, idx_path, loc_path, block_entries):
+    """Write the pywb ZipNum summary index and location file for the compressed blocks.
+
+    Each summary line holds the first key of a block, the part name,
+    and the offset, length, and number of the block, separated by tabs.
+    The location file maps the part name to the compressed CDXJ.
+    """
+    gz_file = os.path.basename(gz_path)
+    part = re.sub(r'\.cdxj\.gz$', '', gz_file)
+    with open(idx_path, 'wt') as idx:
+        for block_number, (key, offset, length) in enumerate(block_entries):
+            idx.write('{}\t{}\t{}\t{}\t{}\n'.format(key, part, offset, length, block_number))
+    with open(loc_path, 'wt') as loc:
+        loc.write('{}\t{}\n'.format(part, gz_file))
+
+
 def create_cdxj_path(warc_cdxj, cdxj_dir):
     """Take the WARC CDXJ, replace the extension, and return the path/filename of the CDXJ."""
     w_cdxj = os.path.basename(warc_cdxj)
@@ -101,13 +291,17 @@ def create_cdxj_path(warc_cdxj, cdxj_dir):
     return os.path.join(cdxj_dir, cdxj_file)
 
 
-def merge_cdxjs(metadata_cdxj, warc_cdxj, cdxj_dir):
+def merge_cdxjs(metadata_cdxj, warc_cdxj, cdxj_dir, incremental=False, block_size=BLOCK_SIZE,
+                zipnum=False):
     """Merge fields from a sidecar CDXJ with an original WARC CDXJ.
 
     Finding the matching key (SURT URL and timestamp) of the CDXJ's,
     collect the wanted fields from the sidecar CDXJ, combine them
     with the original WARC CDXJ and write the combined records to a
-    new CDXJ file.
+    new CDXJ file. With incremental, only the blocks of the merged CDXJ
+    whose inputs changed since the last incremental merge are rewritten.
+    With zipnum, the merged CDXJ is written as pywb ZipNum gzip blocks
+    of block_size lines with a summary index and location file.
     """
     start = time.time()
     if not os.path.isdir(cdxj_dir):
@@ -123,19 +317,33 @@ def merge_cdxjs(metadata_cdxj, warc_cdxj, cdxj_dir):
 
     cdxj_path = create_cdxj_path(warc_cdxj, cdxj_dir)
 
-    with open(cdxj_path, 'wt') as merged_cdxj, open(metadata_cdxj, 'r') as meta_cdxj, \
-         open(warc_cdxj, 'r') as original_cdxj:
+    if zipnum:
+        gz_path, idx_path, loc_path = create_zipnum_paths(cdxj_path)
+        if incremental:
+            edited, _, block_entries = incremental_merge(metadata_cdxj, warc_cdxj, gz_path,
+                                                         block_size, zipnum=True)
+        else:
+            remove_stale_manifest(gz_path)
+            edited, block_entries = zipnum_merge(metadata_cdxj, warc_cdxj, gz_path, block_size)
+        write_zipnum_summary(gz_path, idx_path, loc_path, block_entries)
+        cdxj_path = idx_path
+    elif incremental:
+        edited, _, _ = incremental_merge(metadata_cdxj, warc_cdxj, cdxj_path, block_size)
+    else:
+        remove_stale_manifest(cdxj_path)
+        with open(cdxj_path, 'wt') as merged_cdxj, open(metadata_cdxj, 'r') as meta_cdxj, \
+             open(warc_cdxj, 'r') as original_cdxj:
 
-        meta_dict = create_dict_from_meta(meta_cdxj)
-        list_of_original, edited, non_edited = merge_meta_fields(meta_dict, original_cdxj)
-        for line in list_of_original:
-            merged_cdxj.write(line)
+            meta_dict = create_dict_from_meta(meta_cdxj)
+            list_of_original, edited, non_edited = merge_meta_fields(meta_dict, original_cdxj)
+            for line in list_of_original:
+                merged_cdxj.write(line)
 
-        logging.info('Finished merging in %s',
-                     str(timedelta(seconds=(time.time() - start))))
-        print('Merged {} + {} => {}\tTotal merged records: {}'.format(warc_cdxj, metadata_cdxj,
-                                                                      cdxj_path, edited))
-        logging.info('Total merged records: %s', edited)
+    logging.info('Finished merging in %s',
+                 str(timedelta(seconds=(time.time() - start))))
+    print('Merged {} + {} => {}\tTotal merged records: {}'.format(warc_cdxj, metadata_cdxj,
+                                                                  cdxj_path, edited))
+    logging.info('Total merged records: %s', edited)
 
 
 def main():
@@ -161,8 +369,30 @@ def main():
         required=True,
         help='A directory where the merged CDXJ file will be stored.'
     )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help='Only rewrite the blocks of the merged CDXJ whose inputs changed since the last '
+             'incremental merge, using a manifest stored beside the merged CDXJ.'
+    )
+    parser.add_argument(
+        '--block_size',
+        action='store',
+        type=int,
+        default=BLOCK_SIZE,
+        help='The number of CDXJ lines per block for incremental and ZipNum merges.'
+    )
+    parser.add_argument(
+        '--zipnum',
+        action='store_true',
+        default=False,
+        help='Write the merged CDXJ as pywb ZipNum gzip compressed blocks (_merged.cdxj.gz) '
+             'with a summary index (_merged.idx) and location file (_merged.loc).'
+    )
     args = parser.parse_args()
-    merge_cdxjs(args.metadata_cdxj, args.warc_cdxj, args.cdxj_dir)
+    merge_cdxjs(args.metadata_cdxj, args.warc_cdxj, args.cdxj_dir, args.incremental,
+                args.block_size, args.zipnum)
 
 
 if __name__ == '__main__':
@@ -19,12 +19,18 @@ setup(
     author='University of North Texas Libraries',
     author_email='gracie.flores@unt.edu',
     license='',
-    py_modules=['warc_metadata_sidecar', 'sidecar2cdxj', 'merge_cdxj'],
-    scripts=['warc_metadata_sidecar.py', 'sidecar2cdxj.py', 'merge_cdxj.py'],
+    py_modules=['warc_metadata_sidecar', 'sidecar2cdxj', 'merge_cdxj', 'sidecar_daemon',
+                'sidecar2parquet', 'sidecar_stats', 'sidecar_formats'],
+    scripts=['warc_metadata_sidecar.py', 'sidecar2cdxj.py', 'merge_cdxj.py',
+             'sidecar_daemon.py', 'sidecar2parquet.py', 'sidecar_stats.py'],
     description='A script that creates a metadata sidecar file from a WARC file',
     long_description=long_description,
     long_description_content_type='text/markdown',
     install_requires=dependencies,
+    extras_require={
+        'fast-gzip': ['isal', 'zlib-ng'],
+        'parquet': ['pyarrow'],
+    },
     classifiers=[
         'Natural Language :: English',
         'Programming Language :: Python',
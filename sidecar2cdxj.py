@@ -2,12 +2,39 @@ import argparse
 import json
 import os
 import re
+import sys
+from contextlib import contextmanager
 
 import surt
-from warcio.archiveiterator import ArchiveIterator
+from warcio.archiveiterator import ArchiveIterator, UnseekableYetTellable
 from warcio.timeutils import iso_date_to_timestamp
 
 
+# The path that stands for stdin or stdout.
+STDIO = '-'
+
+
+@contextmanager
+def open_stream(path, mode='rb'):
+    """Open a file, or stdin or stdout when the path is '-'.
+
+    Reading stdin in binary mode counts the bytes read, so the stream
+    can tell its position even when it is a pipe. Stdout is flushed
+    rather than closed.
+    """
+    if path != STDIO:
+        with open(path, mode) as stream:
+            yield stream
+    elif 'r' in mode:
+        yield UnseekableYetTellable(sys.stdin.buffer) if 'b' in mode else sys.stdin
+    else:
+        stream = sys.stdout.buffer if 'b' in mode else sys.stdout
+        try:
+            yield stream
+        finally:
+            stream.flush()
+
+
 def create_cdxj_path(sidecar_file, archive_dir):
     """Take the sidecar file, replace the extension, and return the path/filename of the CDXJ."""
     warc_file = os.path.basename(sidecar_file)
@@ -15,9 +42,8 @@ def create_cdxj_path(sidecar_file, archive_dir):
     return os.path.join(archive_dir, cdxj_file)
 
 
-def convert_payload_to_json(record):
-    """Parse a record's payload, put the fields into a dictionary and return it as a JSON string."""
-    string_payload = record.content_stream().read().decode('utf-8')
+def parse_payload(string_payload):
+    """Parse a sidecar payload string into a dictionary, decoding the JSON values."""
     payload_list = string_payload.split('\n')
     new_dict = {}
     for item in payload_list:
@@ -26,18 +52,36 @@ def convert_payload_to_json(record):
             new_dict[item_key] = json.loads(value)
         except json.decoder.JSONDecodeError:
             new_dict[item_key] = value
-    return json.dumps(new_dict)
+    return new_dict
+
+
+def payload_to_json(string_payload):
+    """Parse a sidecar payload string into a dictionary and return it as a JSON string."""
+    return json.dumps(parse_payload(string_payload))
+
+
+def convert_payload_to_json(record):
+    """Parse a record's payload, put the fields into a dictionary and return it as a JSON string."""
+    string_payload = record.content_stream().read().decode('utf-8')
+    return payload_to_json(string_payload)
+
+
+def create_cdxj_line(url, warc_date, json_string):
+    """Convert the URI, WARC-Date and JSON string into a CDXJ line."""
+    surt_url = surt.surt(url)
+    ts = iso_date_to_timestamp(warc_date)
+    return surt_url + ' ' + ts + ' ' + json_string + '\n'
 
 
 def record_data_to_string(record):
     """Convert dictionary into JSON object, convert record fields and JSON into a string."""
     json_string = convert_payload_to_json(record)
-    surt_url = surt.surt(record.rec_headers.get_header('WARC-Target-URI'))
-    ts = iso_date_to_timestamp(record.rec_headers.get_header('WARC-Date'))
-    return surt_url + ' ' + ts + ' ' + json_string + '\n'
+    return create_cdxj_line(record.rec_headers.get_header('WARC-Target-URI'),
+                            record.rec_headers.get_header('WARC-Date'),
+                            json_string)
 
 
-def create_sidecar_cdxj(sidecar_file, archive_dir):
+def create_sidecar_cdxj(sidecar_file, archive_dir, name=None):
     """Create a CDXJ index from a WARC formatted metadata sidecar file.
 
     Iterate the metadata records of a WARC metadata sidecar file,
@@ -45,15 +89,20 @@ def create_sidecar_cdxj(sidecar_file, archive_dir):
     timestamp, and JSON data block representing the record's payload
     key value pairs.
     Keyword arguments:
-    sidecar_file -- path to sidecar metadata WARC
-    archive_dir -- path to output directory for the CDXJ
+    sidecar_file -- path to sidecar metadata WARC, or '-' for stdin
+    archive_dir -- path to output directory for the CDXJ, or '-' for stdout
+    name -- file name of a sidecar read from stdin, used to name the CDXJ
     """
-    if not os.path.isdir(archive_dir):
-        os.mkdir(archive_dir)
-
-    cdxj_path = create_cdxj_path(sidecar_file, archive_dir)
-
-    with open(cdxj_path, 'wt') as out, open(sidecar_file, 'rb') as stream:
+    if archive_dir == STDIO:
+        cdxj_path = STDIO
+    else:
+        if sidecar_file == STDIO and not name:
+            raise ValueError('A name is required to name the CDXJ of a sidecar read from stdin')
+        if not os.path.isdir(archive_dir):
+            os.mkdir(archive_dir)
+        cdxj_path = create_cdxj_path(name or sidecar_file, archive_dir)
+
+    with open_stream(cdxj_path, 'wt') as out, open_stream(sidecar_file, 'rb') as stream:
         for record in ArchiveIterator(stream):
             if record.rec_type == 'warcinfo':
                 continue
@@ -66,15 +115,24 @@ def main():
     parser.add_argument(
         'sidecar_file',
         action='store',
-        help='A WARC metadata sidecar file that will be used to generate a CDXJ.'
+        help='A WARC metadata sidecar file that will be used to generate a CDXJ, or - to read '
+             'the sidecar from stdin.'
     )
     parser.add_argument(
         'archive_dir',
         action='store',
-        help='A directory where the CDXJ file will be stored.'
+        help='A directory where the CDXJ file will be stored, or - to write the CDXJ to stdout.'
+    )
+    parser.add_argument(
+        '--name',
+        action='store',
+        default=None,
+        help='The file name of a sidecar read from stdin, used to name the CDXJ.'
     )
     args = parser.parse_args()
-    create_sidecar_cdxj(args.sidecar_file, args.archive_dir)
+    if args.sidecar_file == STDIO and args.archive_dir != STDIO and not args.name:
+        parser.error('--name is required to write the CDXJ of a sidecar read from stdin')
+    create_sidecar_cdxj(args.sidecar_file, args.archive_dir, args.name)
 
 
 if __name__ == '__main__':
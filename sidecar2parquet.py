@@ -0,0 +1,179 @@
+#!/usr/bin/python
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+
+import surt
+from warcio.archiveiterator import ArchiveIterator
+from warcio.timeutils import iso_date_to_datetime
+
+import merge_cdxj
+import sidecar2cdxj
+
+# pyarrow is only needed for the Parquet export: pip install -e .[parquet]
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# The number of sidecar records written to each Parquet row group.
+ROW_GROUP_SIZE = 65536
+
+COMPRESSIONS = ['zstd', 'snappy', 'gzip', 'none']
+
+
+def create_schema():
+    """Return the Arrow schema of the Parquet export, one row per sidecar metadata record."""
+    return pa.schema([
+        ('surt', pa.string()),
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('mime_fido', pa.string()),
+        ('mime_magic', pa.string()),
+        ('mime_sniffer', pa.string()),
+        ('puid', pa.string()),
+        ('charset', pa.string()),
+        ('charset_confidence', pa.float64()),
+        ('languages', pa.list_(pa.string())),
+        ('soft404', pa.float64()),
+        ('filename', pa.dictionary(pa.int32(), pa.string())),
+        ('offset', pa.int64()),
+    ])
+
+
+def create_parquet_path(sidecar_file, parquet_dir):
+    """Take the sidecar file, replace the extension, and return the path of the Parquet file."""
+    parquet_file = re.sub('warc.meta.gz', 'parquet', os.path.basename(sidecar_file))
+    return os.path.join(parquet_dir, parquet_file)
+
+
+def record_to_row(record, filename):
+    """Convert a sidecar metadata record into a row of typed column values, except its offset."""
+    payload = sidecar2cdxj.parse_payload(record.content_stream().read().decode('utf-8'))
+    mime_dict = payload.get('Identified-Payload-Type', {})
+    charset = payload.get('Charset-Detected', {})
+    languages = payload.get('Languages-cld2', {}).get('languages', [])
+    lang_codes = merge_cdxj.get_alpha3_language_codes(languages)
+    soft404 = payload.get('Soft-404-Detected')
+    return {'surt': surt.surt(record.rec_headers.get_header('WARC-Target-URI')),
+            'timestamp': iso_date_to_datetime(record.rec_headers.get_header('WARC-Date')),
+            'mime_fido': mime_dict.get('fido'),
+            'mime_magic': mime_dict.get('python-magic'),
+            'mime_sniffer': mime_dict.get('sniffer'),
+            'puid': payload.get('Preservation-Identifier'),
+            'charset': charset.get('encoding'),
+            'charset_confidence': charset.get('confidence'),
+            'languages': lang_codes.split(',') if lang_codes else [],
+            'soft404': float(soft404) if soft404 is not None else None,
+            'filename': filename}
+
+
+def iter_sidecar_rows(sidecar_file):
+    """Yield a row for each metadata record of a sidecar, with its offset in the sidecar."""
+    filename = os.path.basename(sidecar_file)
+    with open(sidecar_file, 'rb') as stream:
+        archive_iterator = ArchiveIterator(stream)
+        for record in archive_iterator:
+            if record.rec_type != 'metadata':
+                continue
+            row = record_to_row(record, filename)
+            # The offset is known once the record has been read.
+            row['offset'] = archive_iterator.get_record_offset()
+            yield row
+
+
+def create_sidecar_parquet(sidecar_file, parquet_dir, row_group_size=ROW_GROUP_SIZE,
+                           compression='zstd'):
+    """Write the metadata records of a sidecar to a Parquet file in parquet_dir.
+
+    Rows are collected into columns and written one row group at a
+    time, so memory use is bounded by row_group_size rather than the
+    size of the sidecar. Returns the Parquet path and the number of rows.
+    """
+    schema = create_schema()
+    parquet_path = create_parquet_path(sidecar_file, parquet_dir)
+    total_rows = 0
+    with pq.ParquetWriter(parquet_path, schema, compression=compression) as writer:
+        columns = {name: [] for name in schema.names}
+        for row in iter_sidecar_rows(sidecar_file):
+            for name, value in row.items():
+                columns[name].append(value)
+            total_rows += 1
+            if len(columns['surt']) >= row_group_size:
+                writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+                columns = {name: [] for name in schema.names}
+        # A sidecar without metadata records still gets a Parquet file with the schema.
+        if columns['surt'] or not total_rows:
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+    return (parquet_path, total_rows)
+
+
+def convert_sidecar(job):
+    """Convert one sidecar in a worker process; job holds the create_sidecar_parquet args."""
+    return create_sidecar_parquet(*job)
+
+
+def create_parquet_files(sidecar_files, parquet_dir, workers=1, row_group_size=ROW_GROUP_SIZE,
+                         compression='zstd'):
+    """Write a Parquet file for each sidecar, converting up to workers sidecars at once.
+
+    Returns the Parquet path and number of rows of each sidecar, in the
+    order the sidecars were given.
+    """
+    if not os.path.isdir(parquet_dir):
+        os.mkdir(parquet_dir)
+    jobs = [(sidecar_file, parquet_dir, row_group_size, compression)
+            for sidecar_file in sidecar_files]
+    if workers > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(min(workers, len(jobs))) as pool:
+            return pool.map(convert_sidecar, jobs)
+    return [convert_sidecar(job) for job in jobs]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'parquet_dir',
+        action='store',
+        help='A directory where a Parquet file will be written for each sidecar.'
+    )
+    parser.add_argument(
+        'sidecar_files',
+        nargs='+',
+        help='WARC metadata sidecar files to export.'
+    )
+    parser.add_argument(
+        '--workers',
+        action='store',
+        type=int,
+        default=1,
+        help='The number of sidecars converted at once, each in its own process.'
+    )
+    parser.add_argument(
+        '--row-group-size',
+        action='store',
+        type=int,
+        default=ROW_GROUP_SIZE,
+        help='The number of records in each Parquet row group, which bounds memory use.'
+    )
+    parser.add_argument(
+        '--compression',
+        action='store',
+        default='zstd',
+        choices=COMPRESSIONS,
+        help='The compression codec of the Parquet column chunks.'
+    )
+    args = parser.parse_args()
+    if pa is None:
+        sys.exit('sidecar2parquet.py requires pyarrow: pip install -e .[parquet]')
+    results = create_parquet_files(args.sidecar_files, args.parquet_dir, args.workers,
+                                   args.row_group_size, args.compression)
+    for parquet_path, total_rows in results:
+        print('{}\t{} records'.format(parquet_path, total_rows))
+
+
+if __name__ == '__main__':
+    main()
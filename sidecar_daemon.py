@@ -0,0 +1,280 @@
+#!/usr/bin/python
+import argparse
+import functools
+import io
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+import warc_metadata_sidecar as sidecar
+
+
+# The ExtendFido of a worker process, loaded once when the worker starts.
+WORKER_FIDO = None
+
+# A payload run through every detector when a worker starts, so its first job starts warm.
+WARM_PAYLOAD = (b'<html><head><title>Warm up</title></head>'
+                b'<body><p>This page loads the detectors before the first job.</p></body></html>')
+
+# The number of seconds between checks of the spool directory for new jobs.
+POLL_INTERVAL = 1
+
+JOB_SUFFIX = '.job'
+RUNNING_SUFFIX = '.running'
+RESULT_SUFFIX = '.result'
+
+# The job fields that are not keyword arguments of metadata_sidecar.
+JOB_FIELDS = ('id', 'archive_dir', 'warc_file')
+# Options a pool worker cannot run: daemonic workers cannot start their own workers, and
+# following a growing WARC would hold a worker indefinitely.
+REJECTED_OPTIONS = ('workers', 'follow')
+
+
+def init_daemon_worker():
+    """Load the signatures, libraries, and models used by a worker once, before its first job.
+
+    Workers ignore Ctrl-C, which reaches the whole process group, so the
+    daemon can finish the accepted jobs, and do not inherit the daemon's
+    SIGTERM handler.
+    """
+    global WORKER_FIDO
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sidecar.init_range_worker()
+    WORKER_FIDO = sidecar.ExtendFido()
+    sidecar.find_mime_and_puid(WORKER_FIDO, io.BytesIO(WARM_PAYLOAD), True)
+    sidecar.find_character_set(io.BytesIO(WARM_PAYLOAD))
+    sidecar.find_language(WARM_PAYLOAD, True)
+    sidecar.determine_soft404(WARM_PAYLOAD)
+
+
+def parse_job(job_text):
+    """Parse a JSON job, raising ValueError unless it is a JSON object a worker can run.
+
+    Jobs with the workers or follow options are rejected.
+    """
+    job = json.loads(job_text)
+    if not isinstance(job, dict):
+        raise ValueError('a job must be a JSON object')
+    rejected = [option for option in REJECTED_OPTIONS if option in job]
+    if rejected:
+        raise ValueError('{} cannot be used in a daemon job'.format(', '.join(rejected)))
+    return job
+
+
+def run_job(job, received=None):
+    """Create the sidecar for one job and return the job's result.
+
+    A job is a dictionary with the archive_dir and warc_file arguments
+    of metadata_sidecar, any of its keyword arguments but workers and
+    follow, and an optional id that is returned with the result.
+    """
+    start = time.time()
+    result = {'id': job.get('id'), 'warc_file': job.get('warc_file')}
+    if received:
+        result['wait_seconds'] = round(start - received, 3)
+    options = {key: value for key, value in job.items() if key not in JOB_FIELDS}
+    # Each job starts with an empty cache, so the memory of a long-lived worker does not grow.
+    sidecar.DIGEST_CACHE.clear()
+    try:
+        meta_file_path, records_read, mime_type_records = sidecar.metadata_sidecar(
+            job['archive_dir'], job['warc_file'], fido=WORKER_FIDO, **options)
+    except Exception as e:
+        result.update({'status': 'error', 'error': '{}: {}'.format(type(e).__name__, e)})
+    else:
+        # metadata_sidecar resets the worker's high-water mark, so the peak is this job's.
+        result.update({'status': 'ok',
+                       'sidecar': meta_file_path,
+                       'records_read': records_read,
+                       'mime_type_records': mime_type_records,
+                       'peak_memory_mb': round(sidecar.peak_memory() / 2 ** 20, 1)})
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Run each JSON job line sent over a connection, writing each result as a JSON line."""
+    def handle(self):
+        lock = threading.Lock()
+
+        def write_result(result):
+            # This runs in the pool's result thread, which must outlive a client that left.
+            with lock:
+                try:
+                    self.wfile.write((json.dumps(result) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+                except OSError:
+                    logging.warning('Could not return the result of job %s', result.get('id'))
+
+        pending = []
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = parse_job(line)
+            except ValueError as e:
+                write_result({'status': 'error', 'error': 'Invalid job: {}'.format(e)})
+                continue
+            pending.append(self.server.pool.apply_async(run_job, (job, time.time()),
+                                                        callback=write_result))
+        # Keep the connection open until every job sent over it has a result.
+        for async_result in pending:
+            async_result.wait()
+
+
+class JobServer(socketserver.ThreadingUnixStreamServer):
+    """A Unix socket server that runs the jobs it receives on a pool of warm workers."""
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool):
+        self.pool = pool
+        super(JobServer, self).__init__(socket_path, JobHandler)
+
+
+def submit_jobs(socket_path, jobs):
+    """Send jobs to the daemon listening on socket_path and return the results as they finish."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(''.join(json.dumps(job) + '\n' for job in jobs).encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('r') as results:
+            return [json.loads(line) for line in results]
+
+
+def requeue_running_jobs(spool_dir):
+    """Return jobs claimed by a daemon that stopped before finishing them to the spool."""
+    for filename in os.listdir(spool_dir):
+        if filename.endswith(JOB_SUFFIX + RUNNING_SUFFIX):
+            running_path = os.path.join(spool_dir, filename)
+            os.rename(running_path, running_path[:-len(RUNNING_SUFFIX)])
+
+
+def claim_spool_jobs(spool_dir):
+    """Claim each job file in spool_dir by renaming it, and return the claimed paths."""
+    claimed = []
+    for filename in sorted(os.listdir(spool_dir)):
+        if not filename.endswith(JOB_SUFFIX):
+            continue
+        job_path = os.path.join(spool_dir, filename)
+        try:
+            os.rename(job_path, job_path + RUNNING_SUFFIX)
+        except FileNotFoundError:
+            # Another daemon claimed the job first.
+            continue
+        claimed.append(job_path + RUNNING_SUFFIX)
+    return claimed
+
+
+def write_spool_result(running_path, result):
+    """Write the result of a spool job beside it, then remove the claimed job file."""
+    result_path = running_path[:-len(JOB_SUFFIX + RUNNING_SUFFIX)] + RESULT_SUFFIX
+    tmp_path = result_path + '.tmp'
+    with open(tmp_path, 'w') as result_file:
+        json.dump(result, result_file)
+    os.replace(tmp_path, result_path)
+    os.remove(running_path)
+    logging.info('Finished job %s: %s', result.get('id'), result['status'])
+
+
+def process_spool(spool_dir, pool):
+    """Run each new job file in spool_dir on the pool, writing its result when it finishes.
+
+    A job file named name.job is renamed to name.job.running while it
+    runs, and its result is written to name.result. Returns the pending
+    results of the jobs.
+    """
+    pending = []
+    for running_path in claim_spool_jobs(spool_dir):
+        job_id = os.path.basename(running_path)[:-len(JOB_SUFFIX + RUNNING_SUFFIX)]
+        try:
+            with open(running_path, 'r') as job_file:
+                job = parse_job(job_file.read())
+        except ValueError as e:
+            write_spool_result(running_path, {'id': job_id, 'status': 'error',
+                                              'error': 'Invalid job: {}'.format(e)})
+            continue
+        job.setdefault('id', job_id)
+        callback = functools.partial(write_spool_result, running_path)
+        pending.append(pool.apply_async(run_job, (job, time.time()), callback=callback))
+    return pending
+
+
+def run_daemon(workers, socket_path=None, spool_dir=None, poll_interval=POLL_INTERVAL):
+    """Keep a pool of warm workers running jobs from a Unix socket and a spool directory.
+
+    Runs until interrupted, then finishes the jobs already accepted.
+    """
+    with multiprocessing.Pool(workers, initializer=init_daemon_worker) as pool:
+        server = None
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = JobServer(socket_path, pool)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            logging.info('Listening for jobs on %s', socket_path)
+        if spool_dir:
+            requeue_running_jobs(spool_dir)
+            logging.info('Watching %s for jobs', spool_dir)
+        try:
+            while True:
+                if spool_dir:
+                    process_spool(spool_dir, pool)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logging.info('Stopping after the accepted jobs finish')
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+                os.remove(socket_path)
+            pool.close()
+            pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--socket',
+        action='store',
+        default=None,
+        help='The path of a Unix socket that accepts jobs as JSON lines and returns a JSON '
+             'result line for each.'
+    )
+    parser.add_argument(
+        '--spool-dir',
+        action='store',
+        default=None,
+        help='A directory watched for .job files, each holding a JSON job. The result is '
+             'written to a .result file of the same name.'
+    )
+    parser.add_argument(
+        '--workers',
+        action='store',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help='The number of warm worker processes.'
+    )
+    parser.add_argument(
+        '--poll-interval',
+        action='store',
+        type=float,
+        default=POLL_INTERVAL,
+        help='The number of seconds between checks of the spool directory.'
+    )
+    args = parser.parse_args()
+    if not args.socket and not args.spool_dir:
+        parser.error('at least one of --socket and --spool-dir is required')
+    logging.basicConfig(level=logging.INFO, format=sidecar.LOG_FORMAT)
+    # Stop on SIGTERM the same way as on Ctrl-C, finishing the accepted jobs.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    run_daemon(args.workers, args.socket, args.spool_dir, args.poll_interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+"""Format rules shared by the sidecar writer and the tools that read sidecars."""
+import re
+
+
+# Mimetypes of payloads whose charset and language are detected.
+TEXT_FORMAT_MIMES = re.compile(r'(text|html|xml)')  # this may change
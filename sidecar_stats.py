@@ -0,0 +1,231 @@
+#!/usr/bin/python
+import argparse
+import json
+import math
+import multiprocessing
+import os
+
+import merge_cdxj
+import sidecar_formats
+
+
+# The number of equal width bins of the soft-404 sketch over [0, 1]. A quantile read from the
+# sketch is within half a bin width of the true value.
+SOFT404_BINS = 1000
+
+SOFT404_QUANTILES = [0.5, 0.9, 0.99]
+
+# The normal quantile of a 95% confidence interval.
+Z_95 = 1.959964
+
+# The histograms of the statistics, each counting records by one sidecar field.
+HISTOGRAMS = ['mime', 'puid', 'language', 'charset']
+
+
+def create_stats():
+    """Return empty statistics, which other statistics can be merged into."""
+    stats = {'files': [], 'records': 0, 'text_records': 0, 'non_text_records': 0}
+    for histogram in HISTOGRAMS:
+        stats[histogram] = {}
+    stats['soft404'] = {'bin_count': SOFT404_BINS, 'count': 0, 'bins': {}}
+    return stats
+
+
+def count(histogram, key, number=1):
+    """Add number to the count of key in a histogram."""
+    histogram[key] = histogram.get(key, 0) + number
+
+
+def add_cdxj_line(stats, line):
+    """Add the sidecar fields of one sidecar CDXJ line to the statistics."""
+    _, _, meta_obj = line.split(' ', 2)
+    add_meta_obj(stats, json.loads(meta_obj))
+
+
+def add_meta_obj(stats, meta_obj):
+    """Add the sidecar fields of one record, parsed into a dictionary, to the statistics."""
+    # The same fields, chosen the same way, as merge_cdxj.py adds to the merged CDXJ.
+    fields = merge_cdxj.get_sidecar_fields({}, meta_obj)
+    stats['records'] += 1
+    mimes_found = ' '.join(meta_obj.get('Identified-Payload-Type', {}).values())
+    if sidecar_formats.TEXT_FORMAT_MIMES.search(mimes_found):
+        stats['text_records'] += 1
+    else:
+        stats['non_text_records'] += 1
+    if fields.get('mime-detected'):
+        count(stats['mime'], fields['mime-detected'])
+    if fields.get('puid'):
+        count(stats['puid'], fields['puid'])
+    if fields.get('languages'):
+        # Records are counted by their most covered language.
+        count(stats['language'], fields['languages'].split(',')[0])
+    if fields.get('charset'):
+        count(stats['charset'], fields['charset'])
+    soft404 = meta_obj.get('Soft-404-Detected')
+    if soft404 is not None:
+        sketch = stats['soft404']
+        bin_index = min(int(float(soft404) * SOFT404_BINS), SOFT404_BINS - 1)
+        count(sketch['bins'], str(bin_index))
+        sketch['count'] += 1
+
+
+def cdxj_stats(cdxj_path):
+    """Return the statistics of one sidecar CDXJ."""
+    stats = create_stats()
+    stats['files'].append(os.path.basename(cdxj_path))
+    with open(cdxj_path, 'r') as cdxj:
+        for line in cdxj:
+            if line.strip():
+                add_cdxj_line(stats, line)
+    return stats
+
+
+def merge_stats(stats, other):
+    """Add other statistics into stats and return stats."""
+    if other['soft404']['bin_count'] != stats['soft404']['bin_count']:
+        raise ValueError('Statistics with different soft-404 bin counts cannot be merged')
+    overlap = set(stats['files']) & set(other['files'])
+    if overlap:
+        raise ValueError('Statistics already include {}'.format(', '.join(sorted(overlap))))
+    stats['files'] = sorted(set(stats['files']) | set(other['files']))
+    for total in ['records', 'text_records', 'non_text_records']:
+        stats[total] += other[total]
+    for histogram in HISTOGRAMS:
+        for key, number in other[histogram].items():
+            count(stats[histogram], key, number)
+    stats['soft404']['count'] += other['soft404']['count']
+    for bin_index, number in other['soft404']['bins'].items():
+        count(stats['soft404']['bins'], bin_index, number)
+    return stats
+
+
+def soft404_quantiles(sketch, quantiles=SOFT404_QUANTILES):
+    """Estimate quantiles of the soft-404 scores from the sketch, as the middle of their bins."""
+    estimates = {}
+    if not sketch['count']:
+        return estimates
+    bins = sorted((int(bin_index), number) for bin_index, number in sketch['bins'].items())
+    for quantile in quantiles:
+        rank = quantile * sketch['count']
+        seen = 0
+        for bin_index, number in bins:
+            seen += number
+            if seen >= rank:
+                break
+        estimates[str(quantile)] = round((bin_index + 0.5) / sketch['bin_count'], 6)
+    return estimates
+
+
+def wilson_interval(successes, trials, z=Z_95):
+    """Return the Wilson score interval of a proportion observed in a sample."""
+    if not trials:
+        return (0.0, 1.0)
+    share = successes / trials
+    denominator = 1 + z ** 2 / trials
+    center = (share + z ** 2 / (2 * trials)) / denominator
+    margin = z * math.sqrt(share * (1 - share) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+    return (max(center - margin, 0.0), min(center + margin, 1.0))
+
+
+def estimate_share(sampled, sample_size, population):
+    """Estimate the share and number of records in a population from a count in a sample."""
+    low, high = wilson_interval(sampled, sample_size)
+    share = sampled / sample_size if sample_size else None
+    return {'sampled': sampled,
+            'share': round(share, 6) if sample_size else None,
+            'share_ci95': [round(low, 6), round(high, 6)],
+            'estimated_records': round(share * population) if sample_size else None,
+            'estimated_records_ci95': [round(low * population), round(high * population)]}
+
+
+def sample_summary(stats, population):
+    """Estimate the makeup of population records from the statistics of a random sample of them.
+
+    Each histogram key gets its share of the sample and the estimated
+    number of population records, with 95% Wilson score intervals.
+    """
+    sample_size = stats['records']
+    summary = {'sample_size': sample_size,
+               'population': population,
+               'text_records': estimate_share(stats['text_records'], sample_size, population)}
+    for histogram in HISTOGRAMS:
+        summary[histogram] = {key: estimate_share(number, sample_size, population)
+                              for key, number in stats[histogram].items()}
+    summary['soft404_quantiles'] = soft404_quantiles(stats['soft404'])
+    return summary
+
+
+def collect_stats(cdxj_files, stats=None, workers=1):
+    """Merge the statistics of sidecar CDXJs into stats, reading up to workers CDXJs at once.
+
+    CDXJs already included in stats, by file name, are skipped, so new
+    CDXJs can be added without reading the old ones again.
+    """
+    stats = stats or create_stats()
+    new_files = [cdxj_path for cdxj_path in cdxj_files
+                 if os.path.basename(cdxj_path) not in stats['files']]
+    if workers > 1 and len(new_files) > 1:
+        with multiprocessing.Pool(min(workers, len(new_files))) as pool:
+            for file_stats in pool.imap_unordered(cdxj_stats, new_files):
+                merge_stats(stats, file_stats)
+    else:
+        for cdxj_path in new_files:
+            merge_stats(stats, cdxj_stats(cdxj_path))
+    return stats
+
+
+def read_stats(stats_path):
+    """Read statistics written by write_stats."""
+    with open(stats_path, 'r') as stats_file:
+        stats = json.load(stats_file)
+    stats.pop('soft404_quantiles', None)
+    return stats
+
+
+def write_stats(stats, stats_path):
+    """Write the statistics as JSON with the estimated soft-404 quantiles, replacing stats_path."""
+    report = dict(stats, soft404_quantiles=soft404_quantiles(stats['soft404']))
+    tmp_path = stats_path + '.tmp'
+    with open(tmp_path, 'w') as stats_file:
+        json.dump(report, stats_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, stats_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'stats_file',
+        action='store',
+        help='A JSON file of collection statistics. New CDXJs are added to an existing file.'
+    )
+    parser.add_argument(
+        'cdxj_files',
+        nargs='*',
+        help='Sidecar CDXJ files to add to the statistics.'
+    )
+    parser.add_argument(
+        '--merge',
+        nargs='+',
+        default=[],
+        help='Statistics JSON files, such as those of other collections, to merge in.'
+    )
+    parser.add_argument(
+        '--workers',
+        action='store',
+        type=int,
+        default=1,
+        help='The number of CDXJs read at once, each in its own process.'
+    )
+    args = parser.parse_args()
+    stats = None
+    if os.path.isfile(args.stats_file):
+        stats = read_stats(args.stats_file)
+    stats = collect_stats(args.cdxj_files, stats, args.workers)
+    for merge_path in args.merge:
+        merge_stats(stats, read_stats(merge_path))
+    write_stats(stats, args.stats_file)
+    print('{} records from {} CDXJ files'.format(stats['records'], len(stats['files'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import gzip
 import io
 import os
 from logging import INFO
@@ -92,6 +93,14 @@ def test_get_sidecar_fields(m_alpha):
     m_alpha.assert_not_called()
 
 
+def test_get_sniffed_sidecar_fields():
+    original_obj = {'mime': 'image/gif'}
+    meta_obj = {'Identified-Payload-Type': {'sniffer': 'image/gif'},
+                'Preservation-Identifier': 'fmt/4'}
+    actual = merge_cdxj.get_sidecar_fields(original_obj, meta_obj)
+    assert actual == {'mime': 'image/gif', 'mime-detected': 'image/gif', 'puid': 'fmt/4'}
+
+
 @patch('merge_cdxj.get_alpha3_language_codes')
 def test_merge_meta_fields(m_lang):
     m_lang.return_value = 'eng'
@@ -188,3 +197,162 @@ def test_merge_cdxj2(m_merge_meta, m_create_dict, caplog, tmpdir):
     with open(merged_file_path, 'r') as m_file:
         lines = m_file.readlines()
         assert lines == expected
+
+
+ORIGINAL_LINES = ['com,example) 20091111212121 {"url": "http://www.example.com", '
+                  '"mime": "text/html"}\n',
+                  'com,example)/a 20091111212122 {"url": "http://www.example.com/a", '
+                  '"mime": "image/gif"}\n',
+                  'com,example)/b 20091111212123 {"url": "http://www.example.com/b", '
+                  '"mime": "text/plain"}\n']
+
+META_LINES = ['com,example) 20091111212121 {"Identified-Payload-Type": '
+              '{"python-magic": "text/html"}, "Preservation-Identifier": "fmt/96"}\n',
+              'com,example)/b 20091111212123 {"Identified-Payload-Type": '
+              '{"python-magic": "text/plain"}, "Charset-Detected": '
+              '{"encoding": "ascii", "confidence": 1.0}}\n']
+
+
+def write_lines(path, lines):
+    with open(path, 'w') as out:
+        out.writelines(lines)
+
+
+def test_create_raw_dict_from_meta():
+    raw_dict = merge_cdxj.create_raw_dict_from_meta(META_LINES)
+    assert raw_dict == {'com,example) 20091111212121': META_LINES[0].split(' ', 2)[2].strip(),
+                        'com,example)/b 20091111212123': META_LINES[1].split(' ', 2)[2].strip()}
+
+
+def test_iter_blocks():
+    blocks = list(merge_cdxj.iter_blocks(iter(ORIGINAL_LINES), 2))
+    assert blocks == [ORIGINAL_LINES[:2], ORIGINAL_LINES[2:]]
+
+
+def test_block_checksum_includes_meta():
+    raw_dict = merge_cdxj.create_raw_dict_from_meta(META_LINES)
+    checksum = merge_cdxj.block_checksum(ORIGINAL_LINES, raw_dict)
+    assert checksum == merge_cdxj.block_checksum(ORIGINAL_LINES, dict(raw_dict))
+    raw_dict['com,example)/b 20091111212123'] = '{"Preservation-Identifier": "x-fmt/111"}'
+    assert checksum != merge_cdxj.block_checksum(ORIGINAL_LINES, raw_dict)
+
+
+class Test_Incremental_Merge:
+
+    def full_merge(self, tmpdir, meta_path, warc_path):
+        full_dir = str(tmpdir / 'full')
+        merge_cdxj.merge_cdxjs(meta_path, warc_path, full_dir)
+        with open(os.path.join(full_dir, 'warc_merged.cdxj'), 'r') as merged:
+            return merged.read()
+
+    def test_incremental_merge(self, tmpdir):
+        meta_path = str(tmpdir / 'meta.cdxj')
+        warc_path = str(tmpdir / 'warc.cdxj')
+        cdxj_path = str(tmpdir / 'warc_merged.cdxj')
+        write_lines(meta_path, META_LINES)
+        write_lines(warc_path, ORIGINAL_LINES)
+        edited, reused, _ = merge_cdxj.incremental_merge(meta_path, warc_path, cdxj_path, 1)
+        assert (edited, reused) == (2, 0)
+        assert os.path.isfile(merge_cdxj.create_manifest_path(cdxj_path))
+        with open(cdxj_path, 'r') as merged:
+            assert merged.read() == self.full_merge(tmpdir, meta_path, warc_path)
+        # Nothing changed, so every block is copied from the previous merge.
+        edited, reused, _ = merge_cdxj.incremental_merge(meta_path, warc_path, cdxj_path, 1)
+        assert (edited, reused) == (2, 3)
+
+    def test_incremental_merge_changed_block(self, tmpdir):
+        meta_path = str(tmpdir / 'meta.cdxj')
+        warc_path = str(tmpdir / 'warc.cdxj')
+        cdxj_path = str(tmpdir / 'warc_merged.cdxj')
+        write_lines(meta_path, META_LINES)
+        write_lines(warc_path, ORIGINAL_LINES)
+        merge_cdxj.incremental_merge(meta_path, warc_path, cdxj_path, 1)
+        write_lines(meta_path, META_LINES[:1] + [
+            'com,example)/a 20091111212122 {"Identified-Payload-Type": '
+            '{"fido": "image/gif"}, "Preservation-Identifier": "fmt/4"}\n'] + META_LINES[1:])
+        edited, reused, _ = merge_cdxj.incremental_merge(meta_path, warc_path, cdxj_path, 1)
+        assert (edited, reused) == (3, 2)
+        with open(cdxj_path, 'r') as merged:
+            assert merged.read() == self.full_merge(tmpdir, meta_path, warc_path)
+
+    def test_incremental_merge_new_block_size(self, tmpdir):
+        meta_path = str(tmpdir / 'meta.cdxj')
+        warc_path = str(tmpdir / 'warc.cdxj')
+        cdxj_path = str(tmpdir / 'warc_merged.cdxj')
+        write_lines(meta_path, META_LINES)
+        write_lines(warc_path, ORIGINAL_LINES)
+        merge_cdxj.incremental_merge(meta_path, warc_path, cdxj_path, 1)
+        edited, reused, _ = merge_cdxj.incremental_merge(meta_path, warc_path, cdxj_path, 2)
+        assert (edited, reused) == (2, 0)
+
+    def test_full_merge_removes_manifest(self, tmpdir):
+        meta_path = str(tmpdir / 'meta.cdxj')
+        warc_path = str(tmpdir / 'warc.cdxj')
+        write_lines(meta_path, META_LINES)
+        write_lines(warc_path, ORIGINAL_LINES)
+        merge_cdxj.merge_cdxjs(meta_path, warc_path, str(tmpdir), incremental=True)
+        manifest_path = str(tmpdir / 'warc_merged.cdxj.manifest.json')
+        assert os.path.isfile(manifest_path)
+        merge_cdxj.merge_cdxjs(meta_path, warc_path, str(tmpdir))
+        assert not os.path.isfile(manifest_path)
+
+
+def read_zipnum_blocks(gz_path, idx_path):
+    blocks = []
+    with open(idx_path, 'r') as idx, open(gz_path, 'rb') as gz:
+        for line in idx:
+            key, part, offset, length, block_number = line.rstrip('\n').split('\t')
+            gz.seek(int(offset))
+            blocks.append((key, part, int(block_number),
+                           gzip.decompress(gz.read(int(length))).decode('utf-8')))
+    return blocks
+
+
+def test_create_zipnum_paths(tmpdir):
+    cdxj_path = os.path.join(str(tmpdir), 'file_merged.cdxj')
+    paths = merge_cdxj.create_zipnum_paths(cdxj_path)
+    assert paths == (os.path.join(str(tmpdir), 'file_merged.cdxj.gz'),
+                     os.path.join(str(tmpdir), 'file_merged.idx'),
+                     os.path.join(str(tmpdir), 'file_merged.loc'))
+
+
+class Test_Zipnum_Merge:
+
+    def test_merge_cdxjs_zipnum(self, tmpdir):
+        meta_path = str(tmpdir / 'meta.cdxj')
+        warc_path = str(tmpdir / 'warc.cdxj')
+        write_lines(meta_path, META_LINES)
+        write_lines(warc_path, ORIGINAL_LINES)
+        merge_cdxj.merge_cdxjs(meta_path, warc_path, str(tmpdir / 'full'))
+        with open(str(tmpdir / 'full' / 'warc_merged.cdxj'), 'r') as merged:
+            expected = merged.readlines()
+        merge_cdxj.merge_cdxjs(meta_path, warc_path, str(tmpdir), block_size=2, zipnum=True)
+        blocks = read_zipnum_blocks(str(tmpdir / 'warc_merged.cdxj.gz'),
+                                    str(tmpdir / 'warc_merged.idx'))
+        assert blocks == [('com,example) 20091111212121', 'warc_merged', 0,
+                           ''.join(expected[:2])),
+                          ('com,example)/b 20091111212123', 'warc_merged', 1,
+                           ''.join(expected[2:]))]
+        with open(str(tmpdir / 'warc_merged.loc'), 'r') as loc:
+            assert loc.read() == 'warc_merged\twarc_merged.cdxj.gz\n'
+        assert not os.path.isfile(str(tmpdir / 'warc_merged.cdxj'))
+
+    def test_merge_cdxjs_zipnum_incremental(self, tmpdir):
+        meta_path = str(tmpdir / 'meta.cdxj')
+        warc_path = str(tmpdir / 'warc.cdxj')
+        write_lines(meta_path, META_LINES)
+        write_lines(warc_path, ORIGINAL_LINES)
+        merge_cdxj.merge_cdxjs(meta_path, warc_path, str(tmpdir / 'full'), block_size=1,
+                               zipnum=True)
+        merge_cdxj.merge_cdxjs(meta_path, warc_path, str(tmpdir), incremental=True,
+                               block_size=1, zipnum=True)
+        gz_path = str(tmpdir / 'warc_merged.cdxj.gz')
+        with open(gz_path, 'rb') as gz, \
+             open(str(tmpdir / 'full' / 'warc_merged.cdxj.gz'), 'rb') as full_gz:
+            assert gz.read() == full_gz.read()
+        edited, reused, block_entries = merge_cdxj.incremental_merge(meta_path, warc_path,
+                                                                     gz_path, 1, zipnum=True)
+        assert (edited, reused) == (2, 3)
+        assert [key for key, _, _ in block_entries] == ['com,example) 20091111212121',
+                                                        'com,example)/a 20091111212122',
+                                                        'com,example)/b 20091111212123']
@@ -1,7 +1,10 @@
+import io
 import json
 import os
 from unittest.mock import patch
 
+import pytest
+
 from warcio.archiveiterator import ArchiveIterator
 
 import sidecar2cdxj
@@ -44,6 +47,20 @@ def test_convert_payload_to_json():
     assert json_string == CDXJ_JSON
 
 
+def test_payload_to_json():
+    string_payload = ('Identified-Payload-Type: {"fido": "image/gif"}\n'
+                      'Preservation-Identifier: fmt/4')
+    json_string = sidecar2cdxj.payload_to_json(string_payload)
+    assert json_string == json.dumps({'Identified-Payload-Type': {'fido': 'image/gif'},
+                                      'Preservation-Identifier': 'fmt/4'})
+
+
+def test_create_cdxj_line():
+    line = sidecar2cdxj.create_cdxj_line('https://www.unt.edu', '2021-11-11T21:11:11Z',
+                                         CDXJ_JSON)
+    assert line == 'edu,unt)/ 20211111211111 {}\n'.format(CDXJ_JSON)
+
+
 @patch('sidecar2cdxj.convert_payload_to_json')
 def test_record_data_to_string(m_json):
     m_json.return_value = CDXJ_JSON
@@ -77,3 +94,19 @@ class Test_Create_Sidecar_Cdxj:
             # Confirm that warcinfo record was skipped.
             assert len(lines) == 1
             assert expected in lines
+
+    def test_create_sidecar_cdxj_stdio(self, tmpdir):
+        with open(TEXT_META_FILE, 'rb') as meta_file:
+            meta_data = meta_file.read()
+        expected = 'edu,unt)/ 20211111211111 {}\n'.format(CDXJ_JSON)
+        with patch('sys.stdin', io.TextIOWrapper(io.BytesIO(meta_data))), \
+             patch('sys.stdout', new_callable=io.StringIO) as m_stdout:
+            sidecar2cdxj.create_sidecar_cdxj('-', '-')
+        assert m_stdout.getvalue() == expected
+        # A sidecar read from stdin is named for the CDXJ written to a directory.
+        with patch('sys.stdin', io.TextIOWrapper(io.BytesIO(meta_data))):
+            sidecar2cdxj.create_sidecar_cdxj('-', str(tmpdir), 'piped.warc.meta.gz')
+        with open(os.path.join(tmpdir / 'piped.cdxj'), 'r') as out:
+            assert out.read() == expected
+        with pytest.raises(ValueError):
+            sidecar2cdxj.create_sidecar_cdxj('-', str(tmpdir))
@@ -0,0 +1,81 @@
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+import sidecar2parquet
+import warc_metadata_sidecar as sidecar
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+TEST_DIR = os.path.dirname(__file__)
+
+TEXT_META_FILE = os.path.join(TEST_DIR, 'warc.warc.meta.gz')
+DIGEST_TEST_FILE = os.path.join(TEST_DIR, 'digest_multiples.warc')
+DNS_TEST_FILE = os.path.join(TEST_DIR, 'dns.warc')
+
+
+def test_create_parquet_path(tmpdir):
+    parquet_path = sidecar2parquet.create_parquet_path(TEXT_META_FILE, str(tmpdir))
+    assert parquet_path == os.path.join(tmpdir / 'warc.parquet')
+
+
+def test_iter_sidecar_rows():
+    rows = list(sidecar2parquet.iter_sidecar_rows(TEXT_META_FILE))
+    assert len(rows) == 1
+    row = rows[0]
+    assert row['surt'] == 'edu,unt)/'
+    assert row['timestamp'] == datetime(2021, 11, 11, 21, 11, 11)
+    assert row['mime_fido'] == row['mime_magic'] == 'text/html'
+    assert row['mime_sniffer'] is None
+    assert row['puid'] == 'fmt/471'
+    assert (row['charset'], row['charset_confidence']) == ('utf-8', 0.99)
+    assert row['languages'] == ['eng']
+    assert row['soft404'] == 0.022243212227210058
+    assert row['filename'] == 'warc.warc.meta.gz'
+    assert row['offset'] > 0
+
+
+def test_create_sidecar_parquet(tmpdir):
+    parquet_path, total_rows = sidecar2parquet.create_sidecar_parquet(TEXT_META_FILE,
+                                                                      str(tmpdir))
+    assert total_rows == 1
+    table = pq.read_table(parquet_path)
+    assert table.schema == sidecar2parquet.create_schema()
+    assert table.column('puid').to_pylist() == ['fmt/471']
+    assert table.column('timestamp').to_pylist() == [datetime(2021, 11, 11, 21, 11, 11,
+                                                              tzinfo=timezone.utc)]
+
+
+def test_create_sidecar_parquet_row_groups(tmpdir):
+    sidecar.DIGEST_CACHE = {}
+    meta_file_path = sidecar.metadata_sidecar(str(tmpdir), DIGEST_TEST_FILE)[0]
+    parquet_path, total_rows = sidecar2parquet.create_sidecar_parquet(meta_file_path,
+                                                                      str(tmpdir), 3)
+    parquet_file = pq.ParquetFile(parquet_path)
+    assert total_rows == 4
+    assert parquet_file.metadata.num_row_groups == 2
+    assert parquet_file.metadata.num_rows == 4
+    table = parquet_file.read()
+    assert table.column('mime_magic').to_pylist().count('image/gif') == 2
+    # The offsets locate the metadata records in the sidecar.
+    assert table.column('offset').to_pylist() == sorted(table.column('offset').to_pylist())
+
+
+def test_create_parquet_files(tmpdir):
+    sidecar.DIGEST_CACHE = {}
+    sidecar_files = [TEXT_META_FILE,
+                     sidecar.metadata_sidecar(str(tmpdir), DIGEST_TEST_FILE)[0],
+                     sidecar.metadata_sidecar(str(tmpdir), DNS_TEST_FILE)[0]]
+    parquet_dir = str(tmpdir / 'parquet')
+    results = sidecar2parquet.create_parquet_files(sidecar_files, parquet_dir, workers=2)
+    assert results == [(os.path.join(parquet_dir, 'warc.parquet'), 1),
+                       (os.path.join(parquet_dir, 'digest_multiples.parquet'), 4),
+                       (os.path.join(parquet_dir, 'dns.parquet'), 0)]
+    # The Parquet files can be read together as one dataset.
+    table = pq.read_table(parquet_dir)
+    assert table.num_rows == 5
+    assert sorted(set(table.column('filename').to_pylist())) == ['digest_multiples.warc.meta.gz',
+                                                                 'warc.warc.meta.gz']
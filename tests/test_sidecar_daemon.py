@@ -0,0 +1,119 @@
+import json
+import multiprocessing
+import os
+import signal
+import threading
+from multiprocessing.pool import ThreadPool
+from unittest.mock import call, patch
+
+import pytest
+
+import sidecar_daemon
+import warc_metadata_sidecar as sidecar
+
+
+TEST_DIR = os.path.dirname(__file__)
+
+IMAGE_TEST_FILE = os.path.join(TEST_DIR, 'gif.warc')
+DIGEST_TEST_FILE = os.path.join(TEST_DIR, 'digest_multiples.warc')
+
+
+@patch('sidecar_daemon.signal.signal')
+@patch('warc_metadata_sidecar.init_range_worker')
+def test_init_daemon_worker(m_init_range_worker, m_signal):
+    with patch.object(sidecar_daemon, 'WORKER_FIDO', None):
+        sidecar_daemon.init_daemon_worker()
+        assert isinstance(sidecar_daemon.WORKER_FIDO, sidecar.ExtendFido)
+    m_init_range_worker.assert_called_once()
+    m_signal.assert_has_calls([call(signal.SIGINT, signal.SIG_IGN),
+                               call(signal.SIGTERM, signal.SIG_DFL)])
+
+
+def get_signal_handlers():
+    return (signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM))
+
+
+def test_init_daemon_worker_signals():
+    # The handlers are installed in a real worker process.
+    with multiprocessing.Pool(1, initializer=sidecar_daemon.init_daemon_worker) as pool:
+        assert pool.apply(get_signal_handlers) == (signal.SIG_IGN, signal.SIG_DFL)
+
+
+@patch('warc_metadata_sidecar.metadata_sidecar')
+def test_run_job(m_sidecar):
+    m_sidecar.return_value = ('sidecars/gif.warc.meta.gz', 1, 1)
+    job = {'id': 'job1', 'archive_dir': 'sidecars', 'warc_file': IMAGE_TEST_FILE,
+           'emit_cdxj': True}
+    with patch.object(sidecar_daemon, 'WORKER_FIDO', 'fido'):
+        result = sidecar_daemon.run_job(job, 1.0)
+    m_sidecar.assert_called_once_with('sidecars', IMAGE_TEST_FILE, fido='fido', emit_cdxj=True)
+    assert result['status'] == 'ok'
+    assert result['id'] == 'job1'
+    assert result['sidecar'] == 'sidecars/gif.warc.meta.gz'
+    assert (result['records_read'], result['mime_type_records']) == (1, 1)
+    assert result['peak_memory_mb'] > 0
+    assert result['wait_seconds'] > 0
+    assert 'seconds' in result
+
+
+def test_run_job_error(tmpdir):
+    job = {'archive_dir': str(tmpdir), 'warc_file': str(tmpdir / 'missing.warc')}
+    result = sidecar_daemon.run_job(job)
+    assert result['status'] == 'error'
+    assert result['error'].startswith('FileNotFoundError')
+
+
+def test_process_spool(tmpdir):
+    spool_dir = tmpdir.mkdir('spool')
+    archive_dir = str(tmpdir / 'sidecars')
+    spool_dir.join('gif.job').write(json.dumps({'archive_dir': archive_dir,
+                                                'warc_file': IMAGE_TEST_FILE}))
+    spool_dir.join('bad.job').write('{')
+    spool_dir.join('notes.txt').write('')
+    with ThreadPool(1) as pool:
+        for async_result in sidecar_daemon.process_spool(str(spool_dir), pool):
+            async_result.wait()
+    assert sorted(os.listdir(str(spool_dir))) == ['bad.result', 'gif.result', 'notes.txt']
+    with open(str(spool_dir / 'gif.result'), 'r') as result_file:
+        result = json.load(result_file)
+    assert result['id'] == 'gif'
+    assert result['status'] == 'ok'
+    assert result['sidecar'] == os.path.join(archive_dir, 'gif.warc.meta.gz')
+    assert os.path.isfile(result['sidecar'])
+    with open(str(spool_dir / 'bad.result'), 'r') as result_file:
+        assert json.load(result_file)['status'] == 'error'
+
+
+def test_parse_job():
+    assert sidecar_daemon.parse_job('{"warc_file": "a.warc.gz", "emit_cdxj": true}') == {
+        'warc_file': 'a.warc.gz', 'emit_cdxj': True}
+    for job_text in ['[]', '{"workers": 2}', '{"follow": true}']:
+        with pytest.raises(ValueError):
+            sidecar_daemon.parse_job(job_text)
+
+
+def test_requeue_running_jobs(tmpdir):
+    tmpdir.join('a.job.running').write('{}')
+    tmpdir.join('b.result').write('{}')
+    sidecar_daemon.requeue_running_jobs(str(tmpdir))
+    assert sorted(os.listdir(str(tmpdir))) == ['a.job', 'b.result']
+
+
+def test_job_server(tmpdir):
+    socket_path = str(tmpdir / 'sidecar.sock')
+    jobs = [{'id': name, 'archive_dir': str(tmpdir / name), 'warc_file': warc_file}
+            for name, warc_file in [('gif', IMAGE_TEST_FILE), ('digest', DIGEST_TEST_FILE)]]
+    with ThreadPool(2) as pool:
+        server = sidecar_daemon.JobServer(socket_path, pool)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            results = sidecar_daemon.submit_jobs(socket_path, jobs + ['not a job'])
+        finally:
+            server.shutdown()
+            server.server_close()
+    results = {result.get('id'): result for result in results}
+    assert results['gif']['records_read'] == 1
+    assert results['digest']['records_read'] == 5
+    assert results['digest']['mime_type_records'] == 4
+    # A job that is not a dictionary returns an error rather than stopping the daemon.
+    assert results[None]['status'] == 'error'
@@ -0,0 +1,126 @@
+import json
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+
+import sidecar2cdxj
+import sidecar_stats
+import warc_metadata_sidecar as sidecar
+
+
+TEST_DIR = os.path.dirname(__file__)
+
+TEXT_META_FILE = os.path.join(TEST_DIR, 'warc.warc.meta.gz')
+DIGEST_TEST_FILE = os.path.join(TEST_DIR, 'digest_multiples.warc')
+IMAGE_TEST_FILE = os.path.join(TEST_DIR, 'gif.warc')
+
+
+def create_cdxjs(tmpdir):
+    sidecar.DIGEST_CACHE = {}
+    cdxj_dir = str(tmpdir / 'cdxj')
+    sidecar2cdxj.create_sidecar_cdxj(TEXT_META_FILE, cdxj_dir)
+    for warc_file in [DIGEST_TEST_FILE, IMAGE_TEST_FILE]:
+        sidecar.metadata_sidecar(str(tmpdir), warc_file, emit_cdxj=True)
+    return [os.path.join(cdxj_dir, 'warc.cdxj'),
+            str(tmpdir / 'digest_multiples.cdxj'),
+            str(tmpdir / 'gif.cdxj')]
+
+
+def test_import_is_lightweight():
+    # Reading CDXJ text does not load the detectors of warc_metadata_sidecar.py.
+    loaded = subprocess.check_output(
+        [sys.executable, '-c', 'import sys, sidecar_stats; '
+         'print(sorted({"warc_metadata_sidecar", "fido", "soft404"} & set(sys.modules)))'],
+        cwd=os.path.dirname(TEST_DIR), universal_newlines=True)
+    assert loaded.strip() == '[]'
+
+
+def test_cdxj_stats(tmpdir):
+    cdxj_path = create_cdxjs(tmpdir)[0]
+    stats = sidecar_stats.cdxj_stats(cdxj_path)
+    assert stats['files'] == ['warc.cdxj']
+    assert (stats['records'], stats['text_records'], stats['non_text_records']) == (1, 1, 0)
+    assert stats['mime'] == {'text/html': 1}
+    assert stats['puid'] == {'fmt/471': 1}
+    assert stats['language'] == {'eng': 1}
+    assert stats['charset'] == {'utf-8': 1}
+    assert stats['soft404'] == {'bin_count': 1000, 'count': 1, 'bins': {'22': 1}}
+
+
+def test_collect_stats(tmpdir):
+    cdxj_files = create_cdxjs(tmpdir)
+    stats = sidecar_stats.collect_stats(cdxj_files)
+    assert stats['files'] == ['digest_multiples.cdxj', 'gif.cdxj', 'warc.cdxj']
+    assert (stats['records'], stats['text_records'], stats['non_text_records']) == (6, 3, 3)
+    assert stats['mime'] == {'text/html': 1, 'image/gif': 3, 'text/plain': 2}
+    # Reading the CDXJs in parallel gives the same statistics.
+    assert sidecar_stats.collect_stats(cdxj_files, workers=2) == stats
+
+
+def test_collect_stats_incremental(tmpdir):
+    cdxj_files = create_cdxjs(tmpdir)
+    stats = sidecar_stats.collect_stats(cdxj_files[:2])
+    stats_path = str(tmpdir / 'stats.json')
+    sidecar_stats.write_stats(stats, stats_path)
+    stats = sidecar_stats.read_stats(stats_path)
+    with patch('sidecar_stats.cdxj_stats', wraps=sidecar_stats.cdxj_stats) as m_cdxj_stats:
+        stats = sidecar_stats.collect_stats(cdxj_files, stats)
+    # Only the new CDXJ is read.
+    m_cdxj_stats.assert_called_once_with(cdxj_files[2])
+    assert stats == sidecar_stats.collect_stats(cdxj_files)
+
+
+def test_merge_stats_checks():
+    stats = sidecar_stats.create_stats()
+    stats['files'] = ['a.cdxj']
+    other = sidecar_stats.create_stats()
+    other['files'] = ['a.cdxj']
+    with pytest.raises(ValueError):
+        sidecar_stats.merge_stats(stats, other)
+    other['files'] = ['b.cdxj']
+    other['soft404']['bin_count'] = 10
+    with pytest.raises(ValueError):
+        sidecar_stats.merge_stats(stats, other)
+
+
+def test_soft404_quantiles():
+    stats = sidecar_stats.create_stats()
+    for number in range(1000):
+        line = 'edu,unt)/ 20211111211111 {}'.format(json.dumps(
+            {'Soft-404-Detected': number / 1000}))
+        sidecar_stats.add_cdxj_line(stats, line)
+    quantiles = sidecar_stats.soft404_quantiles(stats['soft404'])
+    assert quantiles == {'0.5': 0.4995, '0.9': 0.8995, '0.99': 0.9895}
+    assert sidecar_stats.soft404_quantiles(sidecar_stats.create_stats()['soft404']) == {}
+
+
+def test_write_stats(tmpdir):
+    stats = sidecar_stats.cdxj_stats(create_cdxjs(tmpdir)[0])
+    stats_path = str(tmpdir / 'stats.json')
+    sidecar_stats.write_stats(stats, stats_path)
+    with open(stats_path, 'r') as stats_file:
+        assert json.load(stats_file)['soft404_quantiles'] == {'0.5': 0.0225, '0.9': 0.0225,
+                                                              '0.99': 0.0225}
+    assert sidecar_stats.read_stats(stats_path) == stats
+
+
+def test_wilson_interval():
+    low, high = sidecar_stats.wilson_interval(5, 10)
+    assert (round(low, 4), round(high, 4)) == (0.2366, 0.7634)
+    assert sidecar_stats.wilson_interval(0, 10)[0] == 0.0
+    assert round(sidecar_stats.wilson_interval(10, 10)[1], 9) == 1.0
+    assert sidecar_stats.wilson_interval(0, 0) == (0.0, 1.0)
+
+
+def test_sample_summary(tmpdir):
+    stats = sidecar_stats.cdxj_stats(create_cdxjs(tmpdir)[1])
+    summary = sidecar_stats.sample_summary(stats, 400)
+    assert (summary['sample_size'], summary['population']) == (4, 400)
+    gif = summary['mime']['image/gif']
+    assert (gif['sampled'], gif['share'], gif['estimated_records']) == (2, 0.5, 200)
+    low, high = gif['estimated_records_ci95']
+    assert low < 200 < high
+    assert summary['text_records']['sampled'] == 2
@@ -1,12 +1,21 @@
 import io
 import json
 import os
+import re
 import socket
-from logging import INFO
+import struct
+import subprocess
+import sys
+import zlib
+from logging import DEBUG, INFO
 from unittest.mock import patch, call
 
 import pycld2 as cld2
+import pytest
 from warcio.archiveiterator import ArchiveIterator
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+import sidecar2cdxj
 import warc_metadata_sidecar as sidecar
 
 
@@ -46,7 +55,7 @@ CLD2 = (True,
 
 WARCINFO_DICT = {'software': 'warc-metadata-sidecar/1.0',
                  'hostname': HOSTNAME,
-                 'ip': socket.gethostbyname(HOSTNAME),
+                 'ip': '10.0.0.5',
                  'conformsTo': 'http://bibnum.bnf.fr/WARC/WARC_ISO_28500_version1_latestdraft.pdf',
                  'description': 'WARC metdata sidecar for sample.warc',
                  'publisher': 'University of North Texas - Digital Projects Unit'}
@@ -54,10 +63,61 @@ WARCINFO_DICT = {'software': 'warc-metadata-sidecar/1.0',
 
 def test_find_mime_and_puid():
     fido = sidecar.ExtendFido()
-    mime_and_puid = sidecar.find_mime_and_puid(fido, RECORD1['payload'])
+    mime_and_puid = sidecar.find_mime_and_puid(fido, RECORD1['payload'], True)
     assert mime_and_puid == ({'fido': 'text/html', 'python-magic': 'text/html'}, 'fmt/471')
 
 
+def test_find_mime_and_puid_sniffed():
+    fido = sidecar.ExtendFido()
+    with patch.object(fido, 'identify_stream') as m_identify:
+        mime_and_puid = sidecar.find_mime_and_puid(fido, RECORD1['payload'])
+    assert mime_and_puid == ({'sniffer': 'text/html'}, 'fmt/471')
+    m_identify.assert_not_called()
+
+
+def test_find_mime_and_puid_not_sniffed():
+    fido = sidecar.ExtendFido()
+    payload = io.BytesIO(b'<?xml version="1.0"?><a/>')
+    mime_and_puid = sidecar.find_mime_and_puid(fido, payload)
+    assert mime_and_puid == ({'fido': 'application/xml', 'python-magic': 'text/xml'}, 'fmt/101')
+
+
+def create_png(*chunk_types):
+    def chunk(chunk_type, data):
+        return (struct.pack('>I', len(data)) + chunk_type + data +
+                struct.pack('>I', zlib.crc32(chunk_type + data)))
+    return (sidecar.PNG_SIGNATURE + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0)) +
+            b''.join(chunk(chunk_type, b'\x00' * 4) for chunk_type in chunk_types) +
+            chunk(b'IDAT', zlib.compress(b'\x00' * 4)) + chunk(b'IEND', b''))
+
+
+def test_sniff_format_agrees_with_fido():
+    fido = sidecar.ExtendFido()
+    jfif = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x02\x00\x00\x01\x00\x01\x00\x00'
+    payloads = [b'GIF87a\x01\x00\x01\x00\x00\x00\x00;',
+                b'GIF89a\x01\x00\x01\x00\x00\x00\x00;\n',
+                jfif + b'\x00' * 100 + b'\xff\xd9',
+                b'%PDF-1.4\n1 0 obj\n<<>>\nendobj\ntrailer\n<<>>\n%%EOF\n',
+                b'%PDF-1.7\n1 0 obj\n<<>>\nendobj\ntrailer\n<<>>\n%%EOF\n',
+                b'<!doctype html>\n<html><body>hi</body></html>',
+                create_png(),
+                create_png(b'sRGB'),
+                create_png(b'iTXt')]
+    for payload in payloads:
+        assert sidecar.sniff_format(payload) == fido.identify_stream(io.BytesIO(payload))
+
+
+def test_sniff_format_inconclusive():
+    # Truncated payloads and formats outside the table are left to fido and python-magic.
+    assert sidecar.sniff_format(b'GIF89a\x01\x00\x01\x00') is None
+    assert sidecar.sniff_format(b'GIF89a\x01\x00\x01\x00\x00\x00\x00;\n\n\n\n\n') is None
+    assert sidecar.sniff_format(create_png() + b'\n' * 5) is None
+    assert sidecar.sniff_format(b'%PDF-1.4\n1 0 obj\n') is None
+    assert sidecar.sniff_format(create_png()[:-12]) is None
+    assert sidecar.sniff_format(b'<html><body>hi</body></html>') is None
+    assert sidecar.sniff_format(b'\xff\xd8\xff\xe1\x00\x10Exif\x00\x00\xff\xd9') is None
+
+
 def test_find_character_set():
     RECORD1['payload'].seek(0)
     result_dict = sidecar.find_character_set(RECORD1['payload'])
@@ -77,6 +137,43 @@ def test_unknown_language():
     assert language is None
 
 
+def test_extract_visible_text():
+    html_text = ('<html><head><style>p { color: red; }</style>'
+                 '<script>var texte = "Le chat";</script></head>\n'
+                 '<body><!-- commentaire --><p>Fish &amp; chips</p>\n'
+                 '<p>for  two</p></body></html>')
+    assert sidecar.extract_visible_text(html_text) == ' Fish & chips for two '
+
+
+def test_sample_text():
+    text = ' '.join('word{}'.format(number) for number in range(1000))
+    assert sidecar.sample_text(text, 0) == text
+    assert sidecar.sample_text(text, len(text)) == text
+    sampled = sidecar.sample_text(text, 400, 4)
+    samples = sampled.split('\n')
+    assert len(samples) == 4
+    assert all(len(sample) <= 100 for sample in samples)
+    # The samples are spread from the start to the end of the text, starting on whole words.
+    assert samples[0].startswith('word0 ')
+    assert samples[-1].endswith('word999')
+    assert all(sample.startswith('word') for sample in samples)
+
+
+def test_find_language_html():
+    html_payload = (b'<html><head><script>var texte = "Le chat";</script></head>'
+                    b'<body><p>Some text</p></body></html>')
+    with patch.object(cld2, 'detect', return_value=CLD2) as m_detect:
+        sidecar.find_language(html_payload, is_html=True)
+    m_detect.assert_called_once_with(' Some text ', bestEffort=True)
+
+
+def test_find_language_sampled():
+    with patch.object(cld2, 'detect', return_value=CLD2) as m_detect:
+        sidecar.find_language(b'some words ' * 1000, max_chars=100, samples=2)
+    sampled_text = m_detect.call_args[0][0]
+    assert len(sampled_text) <= 101
+
+
 @patch('soft404.probability', return_value='0.978654321')
 def test_determine_soft404(m_soft404):
     soft404_page = b'<h1>Page Not Found<h1>'
@@ -85,12 +182,39 @@ def test_determine_soft404(m_soft404):
     assert detected == '0.978654321'
 
 
-def test_create_warcinfo_payload():
+@patch('warc_metadata_sidecar.get_host_identity', return_value=(HOSTNAME, '10.0.0.5'))
+def test_create_warcinfo_payload(m_identity):
     publisher = 'University of North Texas - Digital Projects Unit'
     warcinfo = sidecar.create_warcinfo_payload('sample.warc', None, publisher)
+    m_identity.assert_called_once_with(None, None)
     assert warcinfo == WARCINFO_DICT
 
 
+@patch.dict('os.environ', {}, clear=True)
+@patch.dict('warc_metadata_sidecar.HOST_IDENTITY', {}, clear=True)
+@patch('warc_metadata_sidecar.find_host_ip', return_value='10.0.0.5')
+def test_get_host_identity_is_cached(m_find_ip):
+    assert sidecar.get_host_identity() == (HOSTNAME, '10.0.0.5')
+    assert sidecar.get_host_identity() == (HOSTNAME, '10.0.0.5')
+    m_find_ip.assert_called_once()
+
+
+@patch.dict('os.environ', {'SIDECAR_HOSTNAME': 'node1', 'SIDECAR_IP': '10.0.0.6'})
+@patch.dict('warc_metadata_sidecar.HOST_IDENTITY', {}, clear=True)
+@patch('warc_metadata_sidecar.find_host_ip')
+def test_get_host_identity_overrides(m_find_ip):
+    assert sidecar.get_host_identity() == ('node1', '10.0.0.6')
+    assert sidecar.get_host_identity('node2', '10.0.0.7') == ('node2', '10.0.0.7')
+    m_find_ip.assert_not_called()
+
+
+@patch('warc_metadata_sidecar.socket.socket')
+def test_find_host_ip_without_route(m_socket):
+    m_socket.return_value.connect.side_effect = OSError
+    assert sidecar.find_host_ip() == '127.0.0.1'
+    m_socket.return_value.close.assert_called_once()
+
+
 def test_create_string_payload():
     mime_dict = {'fido': 'text/html', 'python-magic': 'text/html'}
     puid = 'fmt/471'
@@ -106,6 +230,401 @@ def test_create_string_payload():
                             sidecar.SOFT404_TITLE, soft_404)
 
 
+def test_sidecar_analyzer():
+    analyzer = sidecar.SidecarAnalyzer(sidecar.ExtendFido(), full_identification=True)
+    html_payload = RECORD1['payload'].getvalue()
+    http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html')], 'HTTP/1.1')
+    with patch('warc_metadata_sidecar.determine_soft404', return_value=0.25) as m_soft404:
+        string_payload = analyzer.analyze(html_payload, http_headers)
+    m_soft404.assert_called_once_with(html_payload)
+    fields = sidecar.parse_string_payload(string_payload)
+    assert fields[sidecar.MIME_TITLE] == '{"fido": "text/html", "python-magic": "text/html"}'
+    assert fields[sidecar.PUID_TITLE] == 'fmt/471'
+    assert json.loads(fields[sidecar.CHARSET_TITLE])['encoding'] == 'ascii'
+    assert fields[sidecar.SOFT404_TITLE] == '0.25'
+    # The chardet detector is reset and reused, and payloads without an HTTP status skip
+    # soft-404 detection.
+    detector = analyzer.charset_detector
+    ascii_payload = b'plain ascii text ' * 10
+    assert list(analyzer.analyze_many([ascii_payload, (html_payload, None)])) == [
+        sidecar.create_string_payload(*sidecar.find_mime_and_puid(
+            analyzer.fido, io.BytesIO(ascii_payload), True),
+            sidecar.find_character_set(io.BytesIO(ascii_payload)),
+            sidecar.find_language(ascii_payload), None),
+        string_payload.replace('\n{} 0.25'.format(sidecar.SOFT404_TITLE), '')]
+    assert analyzer.charset_detector is detector
+
+
+def test_sidecar_analyzer_detector_limits():
+    analyzer = sidecar.SidecarAnalyzer(sidecar.ExtendFido(), detector_limits={
+        'charset': 200, 'lang': 150, 'soft404': 100})
+    html_payload = RECORD1['payload'].getvalue()
+    assert len(html_payload) > 200
+    with patch('warc_metadata_sidecar.find_character_set',
+               wraps=sidecar.find_character_set) as m_charset, \
+         patch('warc_metadata_sidecar.find_language', return_value=None) as m_lang, \
+         patch('warc_metadata_sidecar.determine_soft404', return_value=0.5) as m_soft404:
+        analyzer.analyze_payload(html_payload, '200')
+    # Each detector is given only the start of the payload its limit allows.
+    assert m_charset.call_args[0][0].getvalue() == html_payload[:200]
+    assert m_lang.call_args[0][0] == html_payload[:150]
+    m_soft404.assert_called_once_with(html_payload[:100])
+
+
+def test_sidecar_analyzer_detectors():
+    analyzer = sidecar.SidecarAnalyzer()
+    with patch('warc_metadata_sidecar.find_language') as m_lang:
+        string_payload, is_text = analyzer.analyze_payload(RECORD1['payload'].getvalue(), '200',
+                                                           ('mime',))
+    m_lang.assert_not_called()
+    assert is_text
+    assert string_payload.startswith(sidecar.MIME_TITLE)
+    assert sidecar.CHARSET_TITLE not in string_payload
+    assert analyzer.analyze_payload(b'GIF89a\x01\x00;', '200')[1] is False
+
+
+@patch('warc_metadata_sidecar.time')
+def test_progress_reporter(m_time, caplog):
+    caplog.set_level(INFO)
+    stream = io.BytesIO(b'x' * 4000000)
+    stream.seek(2000000)
+    m_time.time.side_effect = [100.0, 110.0, 160.0]
+    progress = sidecar.ProgressReporter(stream, 4000000, 60)
+    progress.update(10, 5)
+    assert 'Progress' not in caplog.text
+    progress.update(20, 15)
+    assert ('Progress: 20 records read, 15 written, 0.3 records/sec, 0.03 MB/sec, '
+            'ETA 0:01:00') in caplog.text
+
+
+def test_progress_reporter_disabled(caplog):
+    caplog.set_level(INFO)
+    progress = sidecar.ProgressReporter(io.BytesIO(), None, 0)
+    progress.update(10, 5)
+    assert 'Progress' not in caplog.text
+
+
+def count_gzip_members(data):
+    members = 0
+    while data:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS + 16)
+        decompressor.decompress(data)
+        data = decompressor.unused_data
+        members += 1
+    return members
+
+
+def test_sidecar_writer():
+    for compressor in sidecar.COMPRESSORS:
+        output = io.BytesIO()
+        writer = sidecar.SidecarWriter(output, 1, compressor)
+        for number in range(3):
+            record = writer.create_warc_record('https://www.unt.edu/{}'.format(number),
+                                               'metadata',
+                                               payload=io.BytesIO(b'payload'))
+            writer.write_record(record)
+        # Each record is compressed as its own gzip member.
+        assert count_gzip_members(output.getvalue()) == 3
+        output.seek(0)
+        urls = [record.rec_headers.get_header('WARC-Target-URI')
+                for record in ArchiveIterator(output)]
+        assert urls == ['https://www.unt.edu/0', 'https://www.unt.edu/1', 'https://www.unt.edu/2']
+
+
+def test_compress_level():
+    payload = b'Identified-Payload-Type: {"python-magic": "text/html"}\n' * 20
+    sizes = []
+    for compress_level in [0, 9]:
+        output = io.BytesIO()
+        writer = sidecar.SidecarWriter(output, compress_level)
+        writer.write_record(writer.create_warc_record('https://www.unt.edu', 'metadata',
+                                                      payload=io.BytesIO(payload)))
+        sizes.append(len(output.getvalue()))
+    assert sizes[0] > sizes[1]
+
+
+def read_metadata_records(sidecar_file):
+    records = []
+    with open(sidecar_file, 'rb') as stream:
+        for record in ArchiveIterator(stream):
+            if record.rec_type == 'metadata':
+                records.append((record.rec_headers.get_header('WARC-Target-URI'),
+                                record.rec_headers.get_header('WARC-Concurrent-ID'),
+                                record.content_stream().read()))
+    return records
+
+
+def gzip_warc(warc_file, gz_path):
+    with open(warc_file, 'rb') as stream, open(gz_path, 'wb') as output:
+        writer = WARCWriter(output, gzip=True)
+        for record in ArchiveIterator(stream):
+            writer.write_record(record)
+
+
+def test_split_ranges():
+    offsets = [0, 100, 250, 600, 900]
+    assert sidecar.split_ranges(offsets, 1000, 1) == [(0, 1000)]
+    assert sidecar.split_ranges(offsets, 1000, 2) == [(0, 600), (600, 1000)]
+    assert sidecar.split_ranges(offsets, 1000, 4) == [(0, 250), (250, 600), (600, 900),
+                                                      (900, 1000)]
+    assert sidecar.split_ranges(offsets, 1000, 8) == [(0, 250), (250, 600), (600, 900),
+                                                      (900, 1000)]
+    assert sidecar.split_ranges([0], 1000, 4) == [(0, 1000)]
+
+
+def test_find_record_offsets(tmpdir):
+    gz_path = str(tmpdir / 'digest_multiples.warc.gz')
+    gzip_warc(DIGEST_TEST_FILE, gz_path)
+    offsets = sidecar.find_record_offsets(gz_path)
+    assert len(offsets) == 5
+    with open(gz_path, 'rb') as stream:
+        for offset in offsets:
+            stream.seek(offset)
+            assert stream.read(2) == b'\x1f\x8b'
+    # The offsets of a CDXJ are used instead of scanning the WARC.
+    cdxj_path = str(tmpdir / 'digest_multiples.cdxj')
+    with open(cdxj_path, 'w') as cdxj:
+        for offset in offsets[1:4]:
+            cdxj.write('com,example)/ 20211111211111 {}\n'.format(json.dumps(
+                {'offset': str(offset), 'filename': 'digest_multiples.warc.gz'})))
+        cdxj.write('com,example)/ 20211111211111 {}\n'.format(json.dumps(
+            {'offset': '5', 'filename': 'other.warc.gz'})))
+    assert sidecar.find_record_offsets(gz_path, cdxj_path) == offsets[:4]
+
+
+def test_find_split_offsets(tmpdir):
+    gz_path = str(tmpdir / 'digest_multiples.warc.gz')
+    gzip_warc(DIGEST_TEST_FILE, gz_path)
+    for warc_file in [DIGEST_TEST_FILE, gz_path]:
+        offsets = sidecar.find_record_offsets(warc_file)
+        file_size = os.path.getsize(warc_file)
+        # Small search blocks make the search cross from block to block.
+        with patch.object(sidecar, 'BOUNDARY_SEARCH_BLOCK', 64):
+            split_offsets = sidecar.find_split_offsets(warc_file, 4)
+        expected = {0}
+        for number in range(1, 4):
+            point = file_size * number // 4
+            expected.add(min([offset for offset in offsets if offset >= point] + [file_size]))
+        assert split_offsets == sorted(expected)
+    with open(gz_path, 'rb') as stream:
+        # A record starting exactly at the point is found, and no record after the last.
+        assert sidecar.find_record_boundary(stream, offsets[2], file_size) == offsets[2]
+        assert sidecar.find_record_boundary(stream, offsets[-1] + 1, file_size) == file_size
+
+
+def test_find_complete_end(tmpdir):
+    gz_path = str(tmpdir / 'digest_multiples.warc.gz')
+    gzip_warc(DIGEST_TEST_FILE, gz_path)
+    for warc_file in [DIGEST_TEST_FILE, gz_path]:
+        offsets = sidecar.find_record_offsets(warc_file)
+        with open(warc_file, 'rb') as stream:
+            data = stream.read()
+        partial_path = str(tmpdir / 'partial')
+        # Records are complete once the next record has started.
+        for size, complete_end in [(len(data), offsets[4]),
+                                   (offsets[3] - 1, offsets[2]),
+                                   (offsets[3] + 5, offsets[2]),
+                                   (offsets[3] + 300, offsets[3]),
+                                   (offsets[1] - 1, 0)]:
+            with open(partial_path, 'wb') as partial:
+                partial.write(data[:size])
+            with open(partial_path, 'rb') as stream:
+                assert sidecar.find_complete_end(stream, 0, size) == complete_end
+        # The scan can start from an earlier complete end.
+        with open(warc_file, 'rb') as stream:
+            assert sidecar.find_complete_end(stream, offsets[2], len(data)) == offsets[4]
+
+
+def test_follow_directory(tmpdir):
+    for filename in ['a.warc.gz.open', 'b.arc.gz.open', 'c.warc.gz', 'd.cdxj']:
+        (tmpdir / filename).write('')
+    with patch('warc_metadata_sidecar.multiprocessing.Process') as m_process, \
+         patch('warc_metadata_sidecar.time.sleep'):
+        m_process.return_value.is_alive.return_value = False
+        followed = sidecar.follow_directory('sidecars', str(tmpdir), 1, 0, ('operator',))
+    assert followed == [str(tmpdir / 'a.warc.gz.open'), str(tmpdir / 'b.arc.gz.open')]
+    m_process.assert_any_call(target=sidecar.metadata_sidecar,
+                              args=('sidecars', str(tmpdir / 'a.warc.gz.open'), 'operator'))
+    assert m_process.return_value.start.call_count == 2
+
+
+def test_script_imports_itself_once():
+    # No module the script imports imports it back as warc_metadata_sidecar.
+    script = ('import runpy, sys; runpy.run_path("warc_metadata_sidecar.py"); '
+              'print("warc_metadata_sidecar" in sys.modules)')
+    loaded = subprocess.check_output([sys.executable, '-c', script],
+                                     cwd=os.path.dirname(TEST_DIR), universal_newlines=True)
+    assert loaded.strip() == 'False'
+
+
+def test_sample_value():
+    value = sidecar.sample_value('http://example.com/', 'sha1:ABC')
+    assert 0 <= value < 1
+    assert value == sidecar.sample_value('http://example.com/', 'sha1:ABC')
+    assert value != sidecar.sample_value('http://example.com/', 'sha1:DEF')
+
+
+def test_find_sample_threshold():
+    with open(DIGEST_TEST_FILE, 'rb') as stream:
+        values = sorted(sidecar.iter_sample_values(stream))
+    assert len(values) == 4
+    assert sidecar.find_sample_threshold(DIGEST_TEST_FILE, 2) == values[2]
+    # A sample larger than the WARC takes every record.
+    assert sidecar.find_sample_threshold(DIGEST_TEST_FILE, 4) == 1.0
+
+
+def test_find_sample_threshold_rules(tmpdir):
+    rules = sidecar.load_rules(write_rules(tmpdir, [{'action': 'exclude',
+                                                     'content_type': 'image/'}]))
+    with open(DIGEST_TEST_FILE, 'rb') as stream:
+        values = sorted(sidecar.iter_sample_values(stream, rules))
+    # Only the two records the rules include are counted.
+    assert len(values) == 2
+    assert sidecar.find_sample_threshold(DIGEST_TEST_FILE, 1, rules) == values[1]
+    assert sidecar.find_sample_threshold(DIGEST_TEST_FILE, 2, rules) == 1.0
+
+
+def write_rules(tmpdir, rules):
+    rules_path = str(tmpdir / 'rules.json')
+    with open(rules_path, 'w') as rules_file:
+        json.dump(rules, rules_file)
+    return rules_path
+
+
+def test_load_rules(tmpdir):
+    rules = sidecar.load_rules(write_rules(tmpdir, [
+        {'action': 'exclude', 'surt_prefix': 'com,google-analytics)/j/'},
+        {'content_type': ['Video/', 'audio/'], 'min_length': 100, 'detectors': []},
+    ]))
+    assert rules[0] == {'action': 'exclude', 'detectors': sidecar.DETECTORS,
+                        'surt_prefix': ('com,google-analytics)/j/',)}
+    assert rules[1] == {'action': 'include', 'detectors': ('mime',),
+                        'content_type': ('video/', 'audio/'), 'min_length': 100}
+    for invalid in [{'action': 'skip'}, {'detectors': ['ocr']}, {'size': 1}, 'exclude']:
+        with pytest.raises(ValueError):
+            sidecar.load_rules(write_rules(tmpdir, invalid))
+
+
+def test_choose_detectors(tmpdir):
+    with open(DIGEST_TEST_FILE, 'rb') as stream:
+        records = [(record, record.rec_headers.get_header('WARC-Target-URI'))
+                   for record in ArchiveIterator(stream) if record.rec_type == 'response']
+        rules = sidecar.load_rules(write_rules(tmpdir, [
+            {'action': 'exclude', 'surt_prefix': 'com,google-analytics)/j/collect'},
+            {'content_type': 'image/', 'max_length': 100, 'detectors': ['charset']},
+            {'action': 'exclude', 'url_regex': 'collect'},
+        ]))
+        # The length bound of the second rule can only be checked on the payload.
+        assert [sidecar.choose_detectors(rules, record, url) for record, url in records] == [
+            sidecar.UNREAD, sidecar.UNREAD, None, None]
+        assert [sidecar.choose_detectors(rules, record, url, 100) for record, url in records] == [
+            ('mime', 'charset'), ('mime', 'charset'), None, None]
+        assert sidecar.choose_detectors(rules, *records[0], 101) is None
+        # A record that no rule matches gets every detector.
+        assert sidecar.choose_detectors(rules[:1], *records[0]) == sidecar.DETECTORS
+
+
+def test_declared_length():
+    output = io.BytesIO()
+    writer = WARCWriter(output, gzip=False)
+    http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'image/gif')], 'HTTP/1.1')
+    writer.write_record(writer.create_warc_record('http://example.com/', 'response',
+                                                  payload=io.BytesIO(b'x' * 46),
+                                                  http_headers=http_headers))
+    output.seek(0)
+    assert sidecar.declared_length(next(iter(ArchiveIterator(output)))) == 46
+    # The WARC Content-Length of gif.warc is 4 bytes over its block.
+    with open(IMAGE_TEST_FILE, 'rb') as stream:
+        for record in ArchiveIterator(stream):
+            if record.rec_type == 'response':
+                assert sidecar.declared_length(record) == 50
+                assert len(record.content_stream().read()) == 46
+
+
+def test_parse_memory_size():
+    assert sidecar.parse_memory_size('512M') == 512 * 2 ** 20
+    assert sidecar.parse_memory_size('1.5g') == 3 * 2 ** 29
+    assert sidecar.parse_memory_size('2GiB') == 2 ** 31
+    assert sidecar.parse_memory_size('4096') == 4096
+    with pytest.raises(ValueError):
+        sidecar.parse_memory_size('lots')
+
+
+def test_plan_memory():
+    base = sidecar.WORKER_BASE_MEMORY
+    workers, payload_limit, cache_bytes, detector_limits = sidecar.plan_memory(3 * base)
+    assert workers == 1
+    assert cache_bytes == int(2 * base * sidecar.CACHE_SHARE)
+    payload_share = (2 * base - cache_bytes) // 2
+    assert payload_limit == payload_share // sidecar.PAYLOAD_COPIES
+    # Each detector's limit keeps its measured memory within the other half of the share.
+    assert detector_limits['soft404'] == payload_share // sidecar.DETECTOR_MEMORY['soft404']
+    assert detector_limits['charset'] == payload_limit
+    for detector, limit in detector_limits.items():
+        assert limit * sidecar.DETECTOR_MEMORY[detector] <= payload_share
+    # Each worker gets at least its base again, after the parent's base.
+    assert sidecar.plan_memory(7 * base, 8)[0] == 3
+    assert sidecar.plan_memory(7 * base, 2)[0] == 2
+    with pytest.raises(ValueError):
+        sidecar.plan_memory(base)
+
+
+def test_max_memory_peak_within_budget(tmpdir):
+    # HTML dense with tags takes the most memory per byte to find its soft-404 probability.
+    payload = b'<html><body>' + b'<a href="/x">x</a><b>y</b>\n' * 200000 + b'</body></html>'
+    warc_path = str(tmpdir / 'tags.warc.gz')
+    with open(warc_path, 'wb') as output:
+        writer = WARCWriter(output, gzip=True)
+        http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html')], 'HTTP/1.1')
+        writer.write_record(writer.create_warc_record('http://example.com/', 'response',
+                                                      payload=io.BytesIO(payload),
+                                                      http_headers=http_headers))
+    budget_mb = 320
+    assert len(payload) < sidecar.plan_memory(budget_mb * 2 ** 20)[1]
+    report = subprocess.check_output(
+        [sys.executable, 'warc_metadata_sidecar.py', str(tmpdir / 'sidecars'), warc_path,
+         '--max-memory', '{}M'.format(budget_mb)],
+        cwd=os.path.dirname(TEST_DIR), stderr=subprocess.DEVNULL, universal_newlines=True)
+    peak_mb = float(re.search(r'Peak memory for this WARC: ([\d.]+) MB', report).group(1))
+    assert peak_mb < budget_mb
+
+
+def test_peak_memory():
+    if not sidecar.reset_peak_memory():
+        pytest.skip('the high-water mark cannot be reset here')
+    allocated = bytearray(64 * 2 ** 20)
+    peak = sidecar.peak_memory()
+    assert peak >= len(allocated)
+    del allocated
+    # After a reset, the memory freed no longer counts.
+    sidecar.reset_peak_memory()
+    assert sidecar.peak_memory() < peak - 32 * 2 ** 20
+
+
+@patch('warc_metadata_sidecar.sys.platform', 'linux')
+@patch('warc_metadata_sidecar.resource.getrusage')
+def test_peak_memory_without_proc(m_getrusage):
+    m_getrusage.return_value.ru_maxrss = 300
+    with patch.object(sidecar, 'PROC_STATUS', '/nonexistent/status'), \
+         patch.object(sidecar, 'PROC_CLEAR_REFS', '/nonexistent/clear_refs'):
+        assert not sidecar.reset_peak_memory()
+        assert sidecar.peak_memory() == 300 * 1024
+
+
+def test_cache_metadata():
+    sidecar.DIGEST_CACHE = {}
+    entry_size = sys.getsizeof('sha1:A') + sys.getsizeof('payload')
+    for key in ['sha1:A', 'sha1:B']:
+        sidecar.cache_metadata(key, 'payload', 2 * entry_size)
+    assert sidecar.get_cached_metadata('sha1:A') == 'payload'
+    # The least recently used entry is evicted first.
+    sidecar.cache_metadata('sha1:C', 'payload', 2 * entry_size)
+    assert list(sidecar.DIGEST_CACHE) == ['sha1:A', 'sha1:C']
+    assert sidecar.DIGEST_CACHE_SIZE == 2 * entry_size
+    assert sidecar.get_cached_metadata('sha1:B') is None
+    sidecar.DIGEST_CACHE = {}
+
+
 class Test_Warc_Metadata_Sidecar:
 
     @patch('warc_metadata_sidecar.determine_soft404')
@@ -114,7 +633,7 @@ class Test_Warc_Metadata_Sidecar:
     @patch('warc_metadata_sidecar.find_language')
     @patch('warc_metadata_sidecar.create_string_payload', return_value='payload')
     @patch('warc_metadata_sidecar.create_warcinfo_payload')
-    @patch('warc_metadata_sidecar.WARCWriter')
+    @patch('warc_metadata_sidecar.SidecarWriter')
     def test_metadata_sidecar(self, mock_warcwriter, m_warcinfo, m_create_payload, m_lang,
                               m_charset, m_find_mime, m_soft404, caplog, tmpdir):
         # Get record digest to test DIGEST_CACHE
@@ -129,7 +648,7 @@ class Test_Warc_Metadata_Sidecar:
         assert 'Determined sidecar information for 1 response/resource record(s)' in caplog.text
         assert tmpdir / 'text.warc.meta.gz' in tmpdir.listdir()
         assert writer.write_record.call_count == 2
-        m_warcinfo.assert_called_with('text.warc', None, None)
+        m_warcinfo.assert_called_with('text.warc', None, None, None, None)
         calls = [call(writer.create_warcinfo_record.return_value),
                  call(writer.create_warc_record.return_value)]
         writer.write_record.assert_has_calls(calls)
@@ -156,12 +675,15 @@ class Test_Warc_Metadata_Sidecar:
     @patch('warc_metadata_sidecar.find_language')
     @patch('warc_metadata_sidecar.determine_soft404')
     def test_metadata_sidecar_image_record(self, mock_404, mock_language, mock_character, tmpdir):
+        # Clear the sniffed payloads cached by previous tests
+        sidecar.DIGEST_CACHE = {}
         mime_dict = '{"fido": "image/gif", "python-magic": "image/gif"}'
         puid = 'fmt/4'
         img_payload = '{0} {1}\n{2} {3}'.format(
                             sidecar.MIME_TITLE, mime_dict,
                             sidecar.PUID_TITLE, puid).encode('utf-8')
-        metadata_sidecar_return = sidecar.metadata_sidecar(str(tmpdir), IMAGE_TEST_FILE)
+        metadata_sidecar_return = sidecar.metadata_sidecar(str(tmpdir), IMAGE_TEST_FILE,
+                                                           full_identification=True)
         mock_language.assert_not_called()
         mock_character.assert_not_called()
         mock_404.assert_not_called()
@@ -202,7 +724,7 @@ class Test_Warc_Metadata_Sidecar:
     @patch('warc_metadata_sidecar.find_language')
     @patch('warc_metadata_sidecar.create_string_payload', return_value='payload')
     @patch('warc_metadata_sidecar.create_warcinfo_payload')
-    @patch('warc_metadata_sidecar.WARCWriter')
+    @patch('warc_metadata_sidecar.SidecarWriter')
     def test_digest_multiples_use_cache(self, mock_warcwriter, m_warcinfo, m_create_payload,
                                         m_lang, m_charset, m_find_mime, m_soft404, caplog,
                                         tmpdir):
@@ -231,3 +753,424 @@ class Test_Warc_Metadata_Sidecar:
         assert metadata_sidecar_return == (tmpdir / 'digest_multiples.warc.meta.gz', 5, 4)
         for digest in digest_list:
             assert digest in sidecar.DIGEST_CACHE
+
+    def test_metadata_sidecar_emit_cdxj(self, tmpdir):
+        # Clear the mocked payloads cached by previous tests
+        sidecar.DIGEST_CACHE = {}
+        meta_file_path, _, _ = sidecar.metadata_sidecar(str(tmpdir), DIGEST_TEST_FILE,
+                                                        emit_cdxj=True)
+        emitted_path = os.path.join(tmpdir / 'digest_multiples.cdxj')
+        assert emitted_path in tmpdir.listdir()
+        with open(emitted_path, 'r') as emitted:
+            emitted_lines = emitted.readlines()
+        # The emitted CDXJ matches one created by a second pass over the sidecar.
+        second_pass_dir = str(tmpdir / 'second_pass')
+        sidecar2cdxj.create_sidecar_cdxj(meta_file_path, second_pass_dir)
+        with open(os.path.join(second_pass_dir, 'digest_multiples.cdxj'), 'r') as second_pass:
+            assert emitted_lines == second_pass.readlines()
+        assert len(emitted_lines) == 4
+
+    def test_metadata_sidecar_log_file(self, tmpdir):
+        sidecar.metadata_sidecar(str(tmpdir), IMAGE_TEST_FILE)
+        with open(os.path.join(tmpdir, 'sidecar.log'), 'r') as log:
+            log_text = log.read()
+        assert 'Creating sidecar gif.warc.meta.gz' in log_text
+        assert 'Progress: 1 records read, 1 written' in log_text
+        assert 'https://' not in log_text
+
+    def test_metadata_sidecar_debug_log_level(self, tmpdir):
+        sidecar.metadata_sidecar(str(tmpdir), IMAGE_TEST_FILE, log_level='DEBUG')
+        with open(os.path.join(tmpdir, 'sidecar.log'), 'r') as log:
+            assert 'DEBUG https://www.google-analytics.com/' in log.read()
+
+    def test_metadata_sidecar_sniffed_image_record(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        img_payload = '{0} {1}\n{2} {3}'.format(
+                            sidecar.MIME_TITLE, '{"sniffer": "image/gif"}',
+                            sidecar.PUID_TITLE, 'fmt/4').encode('utf-8')
+        sidecar.metadata_sidecar(str(tmpdir), IMAGE_TEST_FILE)
+        with open(os.path.join(tmpdir / 'gif.warc.meta.gz'), 'rb') as stream:
+            for record in ArchiveIterator(stream):
+                if record.rec_type == 'metadata':
+                    payload = record.content_stream().read()
+        assert payload == img_payload
+
+    def test_metadata_sidecar_workers(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        for warc_file in [DIGEST_TEST_FILE, TEXT_TEST_FILE]:
+            gz_path = str(tmpdir / (os.path.basename(warc_file) + '.gz'))
+            gzip_warc(warc_file, gz_path)
+            for test_file in [warc_file, gz_path]:
+                test_dir = tmpdir.mkdir(os.path.basename(test_file) + '_sidecars')
+                sequential = sidecar.metadata_sidecar(str(test_dir / 'sequential'), test_file,
+                                                      emit_cdxj=True)
+                parallel = sidecar.metadata_sidecar(str(test_dir / 'parallel'), test_file,
+                                                    emit_cdxj=True, workers=3)
+                assert sequential[1:] == parallel[1:]
+                assert read_metadata_records(sequential[0]) == read_metadata_records(parallel[0])
+                cdxj_name = sidecar2cdxj.create_cdxj_path(parallel[0], '')
+                with open(str(test_dir / 'sequential' / cdxj_name), 'r') as s_cdxj, \
+                     open(str(test_dir / 'parallel' / cdxj_name), 'r') as p_cdxj:
+                    assert s_cdxj.read() == p_cdxj.read()
+                # Only the joined sidecar and CDXJ are left.
+                assert sorted(os.listdir(str(test_dir / 'parallel'))) == sorted([
+                    os.path.basename(parallel[0]), cdxj_name, 'sidecar.log'])
+                with open(parallel[0], 'rb') as stream:
+                    rec_types = [record.rec_type for record in ArchiveIterator(stream)]
+                assert rec_types.count('warcinfo') == 1
+                assert rec_types.count('metadata') == parallel[2]
+
+    def test_metadata_sidecar_workers_embedded_record(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        # A payload holding the text of WARC records, which only look like record starts.
+        embedded = io.BytesIO()
+        embedded_writer = WARCWriter(embedded, gzip=False)
+        embedded_writer.write_record(embedded_writer.create_warc_record(
+            'http://example.com/embedded', 'resource', payload=io.BytesIO(b'embedded text'),
+            warc_content_type='text/plain'))
+        warc_path = str(tmpdir / 'embedded.warc')
+        with open(warc_path, 'wb') as output:
+            writer = WARCWriter(output, gzip=False)
+            for number, payload in enumerate([b'first', embedded.getvalue() * 50, b'last']):
+                writer.write_record(writer.create_warc_record(
+                    'http://example.com/{}'.format(number), 'resource',
+                    payload=io.BytesIO(payload), warc_content_type='text/plain'))
+        sequential = sidecar.metadata_sidecar(str(tmpdir / 'sequential'), warc_path)
+        parallel = sidecar.metadata_sidecar(str(tmpdir / 'parallel'), warc_path, workers=4)
+        assert sequential[1:] == parallel[1:] == (3, 3)
+        assert read_metadata_records(sequential[0]) == read_metadata_records(parallel[0])
+
+    def test_metadata_sidecar_workers_failure(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        offsets = sidecar.find_record_offsets(DIGEST_TEST_FILE)
+        file_size = os.path.getsize(DIGEST_TEST_FILE)
+        # A range starting inside a record fails to parse.
+        bad_ranges = [(0, offsets[2]), (offsets[2] + 10, file_size)]
+        with patch('warc_metadata_sidecar.split_ranges', return_value=bad_ranges):
+            with pytest.raises(Exception):
+                sidecar.metadata_sidecar(str(tmpdir), DIGEST_TEST_FILE, emit_cdxj=True,
+                                         workers=2)
+        # Neither the partial sidecars nor a sidecar missing records are left behind.
+        assert os.listdir(str(tmpdir)) == ['sidecar.log']
+
+    def test_metadata_sidecar_workers_peak_memory(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        with patch('warc_metadata_sidecar.peak_memory', return_value=2 ** 20):
+            sidecar.metadata_sidecar(str(tmpdir), DIGEST_TEST_FILE, workers=2)
+        with open(str(tmpdir / 'sidecar.log'), 'r') as log_file:
+            # The parent's peak is added to that of each of its workers.
+            assert 'Peak memory for this WARC: 3.0 MB' in log_file.read()
+
+    def test_metadata_sidecar_workers_progress(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        with patch.object(sidecar.ProgressReporter, 'report') as m_report:
+            sidecar.metadata_sidecar(str(tmpdir / 'sequential'), DIGEST_TEST_FILE)
+            m_report.assert_called_once_with(5, 4)
+            m_report.reset_mock()
+            # Parallel workers read the WARC, so the parent reports no throughput of its own.
+            sidecar.metadata_sidecar(str(tmpdir / 'parallel'), DIGEST_TEST_FILE, workers=2)
+            m_report.assert_not_called()
+
+    def test_metadata_sidecar_workers_logging(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        sidecar.metadata_sidecar(str(tmpdir), DIGEST_TEST_FILE, workers=2,
+                                 log_level=DEBUG)
+        with open(str(tmpdir / 'sidecar.log'), 'r') as log_file:
+            log_text = log_file.read()
+        # The workers' records reach sidecar.log through the parent's listener.
+        with open(DIGEST_TEST_FILE, 'rb') as stream:
+            for record in ArchiveIterator(stream):
+                if record.rec_type == 'response':
+                    assert record.rec_headers.get_header('WARC-Target-URI') in log_text
+
+    def test_metadata_sidecar_follow(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        gz_path = str(tmpdir / 'digest_multiples.warc.gz')
+        gzip_warc(DIGEST_TEST_FILE, gz_path)
+        with open(gz_path, 'rb') as stream:
+            data = stream.read()
+        open_path = gz_path + '.open'
+        with open(open_path, 'wb') as open_warc:
+            open_warc.write(data[:1000])
+
+        def grow_warc(poll_interval):
+            # Each poll the crawler writes more of the WARC, then closes it.
+            size = os.path.getsize(open_path)
+            with open(open_path, 'ab') as open_warc:
+                open_warc.write(data[size:size + 1000])
+            if size + 1000 >= len(data):
+                os.rename(open_path, gz_path)
+
+        follow_dir = str(tmpdir / 'follow')
+        with patch('warc_metadata_sidecar.time.sleep', side_effect=grow_warc) as m_sleep:
+            followed = sidecar.metadata_sidecar(follow_dir, open_path, emit_cdxj=True,
+                                                follow=True, poll_interval=1)
+        assert m_sleep.call_count == 4
+        sequential = sidecar.metadata_sidecar(str(tmpdir / 'sequential'), gz_path,
+                                              emit_cdxj=True)
+        assert followed[0] == os.path.join(follow_dir, 'digest_multiples.warc.meta.gz')
+        assert followed[1:] == sequential[1:]
+        assert read_metadata_records(followed[0]) == read_metadata_records(sequential[0])
+        with open(os.path.join(follow_dir, 'digest_multiples.cdxj'), 'r') as f_cdxj, \
+             open(str(tmpdir / 'sequential' / 'digest_multiples.cdxj'), 'r') as s_cdxj:
+            assert f_cdxj.read() == s_cdxj.read()
+        # The checkpoint is removed once the WARC is closed.
+        assert sorted(os.listdir(follow_dir)) == ['digest_multiples.cdxj',
+                                                  'digest_multiples.warc.meta.gz',
+                                                  'sidecar.log']
+
+    def test_metadata_sidecar_follow_resumes(self, caplog, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        caplog.set_level(INFO)
+        open_path = str(tmpdir / 'digest_multiples.warc.open')
+        with open(DIGEST_TEST_FILE, 'rb') as stream:
+            data = stream.read()
+        with open(open_path, 'wb') as open_warc:
+            open_warc.write(data[:4000])
+        follow_dir = str(tmpdir / 'follow')
+        # The crawler stops writing, so following stops and leaves a checkpoint.
+        sidecar.metadata_sidecar(follow_dir, open_path, follow=True, idle_timeout=0)
+        assert 'has not grown for 0 seconds, stopping' in caplog.text
+        meta_file_path = os.path.join(follow_dir, 'digest_multiples.warc.meta.gz')
+        checkpoint = sidecar.read_checkpoint(sidecar.create_checkpoint_path(meta_file_path))
+        assert 0 < checkpoint['offset'] < 4000
+        assert checkpoint['sidecar_size'] == os.path.getsize(meta_file_path)
+        # Bytes written after the checkpoint by an interrupted follow are dropped.
+        with open(meta_file_path, 'ab') as meta_file:
+            meta_file.write(b'partial record')
+        with open(open_path, 'ab') as open_warc:
+            open_warc.write(data[4000:])
+        closed_path = str(tmpdir / 'digest_multiples.warc')
+        os.rename(open_path, closed_path)
+        # A WARC without .open is closed once it stops growing.
+        followed = sidecar.metadata_sidecar(follow_dir, closed_path, follow=True,
+                                            idle_timeout=0)
+        assert 'Resuming from byte {}'.format(checkpoint['offset']) in caplog.text
+        assert followed[1:] == (5, 4)
+        with open(meta_file_path, 'rb') as stream:
+            rec_types = [record.rec_type for record in ArchiveIterator(stream)]
+        assert rec_types == ['warcinfo'] + ['metadata'] * 4
+        assert not os.path.exists(sidecar.create_checkpoint_path(meta_file_path))
+
+    def test_metadata_sidecar_follow_other_warc_checkpoint(self, tmpdir):
+        follow_dir = tmpdir.mkdir('follow')
+        checkpoint_path = str(follow_dir / 'digest_multiples.warc.meta.gz.checkpoint.json')
+        sidecar.write_checkpoint(checkpoint_path, {'warc_file': str(tmpdir / 'other' /
+                                                                    'digest_multiples.warc'),
+                                                   'offset': 100,
+                                                   'counts': [0, 0, 0, 0],
+                                                   'sidecar_size': 0,
+                                                   'cdxj_size': 0})
+        # A WARC that only shares the sidecar name does not resume from the checkpoint.
+        with pytest.raises(ValueError):
+            sidecar.metadata_sidecar(str(follow_dir), DIGEST_TEST_FILE, follow=True,
+                                     idle_timeout=0)
+        assert sidecar.read_checkpoint(checkpoint_path)['offset'] == 100
+
+    def test_metadata_sidecar_stdio(self, capsys, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        gz_path = str(tmpdir / 'digest_multiples.warc.gz')
+        gzip_warc(DIGEST_TEST_FILE, gz_path)
+        with open(gz_path, 'rb') as stream:
+            stdin = io.TextIOWrapper(io.BytesIO(stream.read()))
+        stdout = io.TextIOWrapper(io.BytesIO())
+        stdio_dir = str(tmpdir / 'stdio')
+        with patch('sys.stdin', stdin), patch('sys.stdout', stdout):
+            piped = sidecar.metadata_sidecar(stdio_dir, '-', emit_cdxj=True,
+                                             name='digest_multiples.warc.gz', to_stdout=True)
+        assert 'Total Records for this WARC file: 5' in capsys.readouterr().err
+        sidecar_path = str(tmpdir / 'piped.warc.meta.gz')
+        with open(sidecar_path, 'wb') as piped_sidecar:
+            piped_sidecar.write(stdout.buffer.getvalue())
+        sequential = sidecar.metadata_sidecar(str(tmpdir / 'sequential'), gz_path)
+        assert piped == ('-',) + sequential[1:]
+        assert read_metadata_records(sidecar_path) == read_metadata_records(sequential[0])
+        with open(sidecar_path, 'rb') as stream:
+            warcinfo = next(iter(ArchiveIterator(stream))).content_stream().read()
+        assert b'sidecar for digest_multiples.warc.gz' in warcinfo
+        # The sidecar is only written to stdout, with its CDXJ and log in the directory.
+        assert sorted(os.listdir(stdio_dir)) == ['digest_multiples.cdxj', 'sidecar.log']
+        with pytest.raises(ValueError):
+            sidecar.metadata_sidecar(stdio_dir, '-')
+
+    def test_refresh_sidecar_unchanged_detectors(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        for warc_file in [DIGEST_TEST_FILE, TEXT_TEST_FILE, ARC_TEST_FILE]:
+            archive_dir = tmpdir.mkdir(os.path.basename(warc_file) + '_sidecars')
+            meta_file_path = sidecar.metadata_sidecar(str(archive_dir), warc_file,
+                                                      full_identification=True)[0]
+            created = read_metadata_records(meta_file_path)
+            # Rerunning a detector that has not changed gives the same sidecar.
+            for detector in sidecar.REFRESH_TITLES:
+                sidecar.refresh_sidecar(str(archive_dir), warc_file, detector,
+                                        full_identification=True)
+                assert read_metadata_records(meta_file_path) == created
+            with open(meta_file_path, 'rb') as stream:
+                warcinfo = next(iter(ArchiveIterator(stream))).content_stream().read()
+            assert b'puid refreshed' in warcinfo
+            assert not os.path.exists(meta_file_path + '.tmp')
+
+    def test_refresh_sidecar_soft404(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        with patch('warc_metadata_sidecar.determine_soft404', return_value=0.25):
+            meta_file_path = sidecar.metadata_sidecar(str(tmpdir), TEXT_TEST_FILE)[0]
+        created = read_metadata_records(meta_file_path)
+        with patch('warc_metadata_sidecar.find_mime_and_puid') as m_find_mime, \
+             patch('warc_metadata_sidecar.determine_soft404', return_value=0.5) as m_soft404:
+            refreshed = sidecar.refresh_sidecar(str(tmpdir), TEXT_TEST_FILE, 'soft404',
+                                                emit_cdxj=True)
+        assert refreshed == (meta_file_path, 1, 0)
+        m_soft404.assert_called_once()
+        m_find_mime.assert_not_called()
+        url, concurrent_id, payload = read_metadata_records(meta_file_path)[0]
+        assert (url, concurrent_id) == created[0][:2]
+        assert payload == created[0][2].replace(b'Soft-404-Detected: 0.25',
+                                                b'Soft-404-Detected: 0.5')
+        with open(str(tmpdir / 'text.cdxj'), 'r') as cdxj:
+            assert '"Soft-404-Detected": 0.5' in cdxj.read()
+
+    def test_refresh_sidecar_only_text_records(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        meta_file_path = sidecar.metadata_sidecar(str(tmpdir), DIGEST_TEST_FILE)[0]
+        with patch('warc_metadata_sidecar.find_language', return_value=RECORD_LANG_DICT) as m_lang:
+            refreshed = sidecar.refresh_sidecar(str(tmpdir), DIGEST_TEST_FILE, 'lang')
+        # The image records are copied, and the text payload that repeats is detected once.
+        assert refreshed == (meta_file_path, 2, 2)
+        m_lang.assert_called_once()
+
+    def test_refresh_sidecar_wrong_warc(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        sidecar.metadata_sidecar(str(tmpdir), TEXT_TEST_FILE)
+        with open(TEXT_TEST_FILE, 'rb') as stream:
+            warc_data = stream.read()
+        other_warc = str(tmpdir / 'other' / 'text.warc')
+        os.mkdir(str(tmpdir / 'other'))
+        with open(other_warc, 'wb') as other:
+            other.write(warc_data.replace(b'<urn:uuid:', b'<urn:uuid:0'))
+        with pytest.raises(ValueError):
+            sidecar.refresh_sidecar(str(tmpdir), other_warc, 'lang')
+
+    def test_metadata_sidecar_sample_n(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        meta_file_path, records_read, mime_type_records = sidecar.metadata_sidecar(
+            str(tmpdir), DIGEST_TEST_FILE, sample_n=2)
+        assert (records_read, mime_type_records) == (5, 2)
+        sampled = read_metadata_records(meta_file_path)
+        with open(str(tmpdir / 'digest_multiples.warc.sample.json'), 'r') as sample_file:
+            summary = json.load(sample_file)
+        assert summary['sample_n'] == 2
+        assert (summary['population'], summary['sampled_records'], summary['sample_size']) == (
+            4, 2, 2)
+        assert sum(share['sampled'] for share in summary['mime'].values()) == 2
+        for share in summary['mime'].values():
+            low, high = share['share_ci95']
+            assert low <= share['share'] <= high
+            assert share['estimated_records'] == round(share['share'] * 4)
+        # The same records are sampled on every run.
+        sidecar.DIGEST_CACHE = {}
+        sidecar.metadata_sidecar(str(tmpdir / 'rerun'), DIGEST_TEST_FILE, sample_n=2)
+        assert read_metadata_records(str(tmpdir / 'rerun' / 'digest_multiples.warc.meta.gz')) \
+            == sampled
+
+    def test_metadata_sidecar_sample_n_rules(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        rules_path = write_rules(tmpdir, [{'action': 'exclude', 'content_type': 'image/'}])
+        meta_file_path = sidecar.metadata_sidecar(str(tmpdir), DIGEST_TEST_FILE, sample_n=2,
+                                                  rules_file=rules_path)[0]
+        # The sample takes 2 of the records the rules include, not 2 of every record.
+        assert len(read_metadata_records(meta_file_path)) == 2
+        with open(str(tmpdir / 'digest_multiples.warc.sample.json'), 'r') as sample_file:
+            summary = json.load(sample_file)
+        assert (summary['sampled_records'], summary['sample_size']) == (2, 2)
+
+    def test_metadata_sidecar_sample_rate(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        with patch('warc_metadata_sidecar.find_mime_and_puid') as m_mime:
+            sidecar.metadata_sidecar(str(tmpdir), DIGEST_TEST_FILE, sample_rate=0)
+        # Records outside the sample are not analyzed.
+        m_mime.assert_not_called()
+        sidecar.DIGEST_CACHE = {}
+        sidecar.metadata_sidecar(str(tmpdir / 'all'), DIGEST_TEST_FILE, sample_rate=1)
+        with open(str(tmpdir / 'all' / 'digest_multiples.warc.sample.json'), 'r') as sample_file:
+            summary = json.load(sample_file)
+        assert (summary['population'], summary['sampled_records'], summary['sample_size']) == (
+            4, 4, 4)
+        assert summary['mime']['image/gif']['estimated_records'] == 2
+
+    def test_metadata_sidecar_sample_empty_payloads(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        warc_path = str(tmpdir / 'empty.warc.gz')
+        with open(warc_path, 'wb') as output:
+            writer = WARCWriter(output, gzip=True)
+            for number in range(4):
+                payload = b'' if number % 2 else RECORD1['payload'].getvalue()
+                http_headers = StatusAndHeaders(
+                    '200 OK', [('Content-Type', 'text/html')], 'HTTP/1.1')
+                writer.write_record(writer.create_warc_record(
+                    'http://example.com/{}'.format(number), 'response',
+                    payload=io.BytesIO(payload), http_headers=http_headers))
+        sidecar.metadata_sidecar(str(tmpdir / 'out'), warc_path, sample_rate=1)
+        with open(str(tmpdir / 'out' / 'empty.warc.sample.json'), 'r') as sample_file:
+            summary = json.load(sample_file)
+        # Records with empty payloads are not counted in the estimates.
+        assert (summary['candidate_records'], summary['sampled_records']) == (4, 4)
+        assert (summary['population'], summary['sample_size']) == (2, 2)
+        assert summary['text_records']['estimated_records'] == 2
+        assert summary['mime']['text/html']['estimated_records'] == 2
+
+    def test_metadata_sidecar_rules(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        rules_path = write_rules(tmpdir, [{'action': 'exclude', 'content_type': 'image/'}])
+        with patch('warc_metadata_sidecar.find_mime_and_puid',
+                   wraps=sidecar.find_mime_and_puid) as m_mime:
+            meta_file_path, records_read, mime_type_records = sidecar.metadata_sidecar(
+                str(tmpdir), DIGEST_TEST_FILE, rules_file=rules_path)
+        # The excluded image records are never analyzed.
+        assert (records_read, mime_type_records) == (5, 2)
+        m_mime.assert_called_once()
+        assert len(read_metadata_records(meta_file_path)) == 2
+
+    def test_metadata_sidecar_rules_detectors(self, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        rules_path = write_rules(tmpdir, [{'min_length': 1000, 'detectors': ['charset']}])
+        with patch('warc_metadata_sidecar.find_language') as m_lang, \
+             patch('warc_metadata_sidecar.determine_soft404') as m_soft404:
+            meta_file_path = sidecar.metadata_sidecar(str(tmpdir), TEXT_TEST_FILE,
+                                                      rules_file=rules_path)[0]
+        m_lang.assert_not_called()
+        m_soft404.assert_not_called()
+        payload = read_metadata_records(meta_file_path)[0][2].decode('utf-8')
+        assert sidecar.CHARSET_TITLE in payload
+        assert sidecar.LANGUAGE_TITLE not in payload
+        # Metadata found with fewer detectors is not reused for a record with every detector.
+        assert 'sha1:6ZIRNZMPETWZZQPM3V4PJ6IAELZV45TL' not in sidecar.DIGEST_CACHE
+
+    @pytest.mark.parametrize('rule, written', [
+        ({'action': 'exclude', 'max_length': 46}, 0),
+        ({'action': 'exclude', 'max_length': 45}, 1),
+        ({'action': 'exclude', 'min_length': 46}, 0),
+        ({'action': 'exclude', 'min_length': 47}, 1),
+    ])
+    def test_metadata_sidecar_rules_length_bound(self, tmpdir, rule, written):
+        sidecar.DIGEST_CACHE = {}
+        rules_path = write_rules(tmpdir, [rule])
+        meta_file_path = sidecar.metadata_sidecar(str(tmpdir), IMAGE_TEST_FILE,
+                                                  rules_file=rules_path)[0]
+        # The 46 byte payload is bounded by its length, not the 50 bytes its headers declare.
+        assert len(read_metadata_records(meta_file_path)) == written
+
+    def test_metadata_sidecar_max_memory(self, capsys, tmpdir):
+        sidecar.DIGEST_CACHE = {}
+        with patch('warc_metadata_sidecar.plan_memory',
+                   return_value=(1, 1000, 500, {'lang': 100})) as m_plan, \
+             patch('warc_metadata_sidecar.find_language') as m_lang:
+            meta_file_path = sidecar.metadata_sidecar(str(tmpdir), TEXT_TEST_FILE, workers=4,
+                                                      max_memory=2 ** 30)[0]
+        m_plan.assert_called_once_with(2 ** 30, 4)
+        # A payload over the limit only gets the format identified from its start.
+        m_lang.assert_not_called()
+        payload = read_metadata_records(meta_file_path)[0][2].decode('utf-8')
+        assert payload.startswith(sidecar.MIME_TITLE)
+        assert sidecar.CHARSET_TITLE not in payload
+        assert sidecar.DIGEST_CACHE == {}
+        assert 'Peak memory for this WARC: ' in capsys.readouterr().out
@@ -3,24 +3,56 @@
 __version__ = '1.0'
 
 import argparse
+import bisect
+import hashlib
+import heapq
+import html
 import io
 import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
 import re
 import regex
+import resource
+import shutil
 import socket
+import struct
+import sys
 import time
+import zlib
+from contextlib import contextmanager
 from datetime import timedelta
 
 import magic
 import pycld2 as cld2
 import soft404
+import surt
 from chardet.universaldetector import UniversalDetector
 from fido.fido import Fido
 from warcio.archiveiterator import ArchiveIterator
+from warcio.limitreader import LimitReader
 from warcio.warcwriter import WARCWriter
 
+import sidecar2cdxj
+import sidecar_formats
+import sidecar_stats
+
+# Faster deflate implementations are used when they are installed.
+COMPRESSORS = {'zlib': zlib}
+try:
+    from isal import isal_zlib
+    COMPRESSORS['isal'] = isal_zlib
+except ImportError:
+    pass
+try:
+    from zlib_ng import zlib_ng
+    COMPRESSORS['zlib-ng'] = zlib_ng
+except ImportError:
+    pass
+
 
 MIME_TITLE = 'Identified-Payload-Type:'
 PUID_TITLE = 'Preservation-Identifier:'
@@ -28,16 +60,137 @@ CHARSET_TITLE = 'Charset-Detected:'
 LANGUAGE_TITLE = 'Languages-cld2:'
 SOFT404_TITLE = 'Soft-404-Detected:'
 
+# The fields of a sidecar payload, in the order they are written.
+PAYLOAD_TITLES = [MIME_TITLE, PUID_TITLE, CHARSET_TITLE, LANGUAGE_TITLE, SOFT404_TITLE]
+
+# The fields written by each detector that can be rerun over an existing sidecar.
+REFRESH_TITLES = {'puid': [MIME_TITLE, PUID_TITLE],
+                  'charset': [CHARSET_TITLE],
+                  'lang': [LANGUAGE_TITLE],
+                  'soft404': [SOFT404_TITLE]}
+
 BAD_CHARS = regex.compile(r'\p{Cc}|\p{Cs}|\p{Cn}')
 
-TEXT_FORMAT_MIMES = re.compile(r'(text|html|xml)')  # this may change
+TEXT_FORMAT_MIMES = sidecar_formats.TEXT_FORMAT_MIMES
+
+# The parts of an HTML document that are not visible text, and the remaining tags.
+HTML_INVISIBLE = re.compile(r'<script\b.*?</script\s*>|<style\b.*?</style\s*>|<!--.*?-->',
+                            re.I | re.S)
+HTML_TAG = re.compile(r'<[^>]*>')
+WHITESPACE = re.compile(r'\s+')
+
+# The number of characters of text given to pycld2, taken as evenly spaced samples.
+LANG_MAX_CHARS = 65536
+LANG_SAMPLES = 8
 
 ARC = re.compile(r'.*\.arc(\.gz)?$')
 
+# A WARC or ARC that the crawler is still writing.
+OPEN_WARC = re.compile(r'.*\.w?arc(\.gz)?\.open$')
+OPEN_SUFFIX = '.open'
+
+# Magic numbers of common formats, used to identify them without fido and python-magic.
+# Each entry is a pattern matched at the start of the payload, the trailer that must be
+# found within the last bytes of the payload (as fido requires), the number of last bytes
+# searched for it, the mimetype, and the PUID fido reports.
+SNIFF_TABLE = [
+    (re.compile(rb'GIF87a'), b';', 5, 'image/gif', 'fmt/3'),
+    (re.compile(rb'GIF89a'), b';', 5, 'image/gif', 'fmt/4'),
+    (re.compile(rb'\xff\xd8\xff\xe0..JFIF\x00\x01\x00', re.S), b'\xff\xd9', 1024, 'image/jpeg',
+     'fmt/42'),
+    (re.compile(rb'\xff\xd8\xff\xe0..JFIF\x00\x01\x01', re.S), b'\xff\xd9', 1024, 'image/jpeg',
+     'fmt/43'),
+    (re.compile(rb'\xff\xd8\xff\xe0..JFIF\x00\x01\x02', re.S), b'\xff\xd9', 1024, 'image/jpeg',
+     'fmt/44'),
+    (re.compile(rb'%PDF-1\.0'), b'%%EOF', 1024, 'application/pdf', 'fmt/14'),
+    (re.compile(rb'%PDF-1\.1'), b'%%EOF', 1024, 'application/pdf', 'fmt/15'),
+    (re.compile(rb'%PDF-1\.2'), b'%%EOF', 1024, 'application/pdf', 'fmt/16'),
+    (re.compile(rb'%PDF-1\.3'), b'%%EOF', 1024, 'application/pdf', 'fmt/17'),
+    (re.compile(rb'%PDF-1\.4'), b'%%EOF', 1024, 'application/pdf', 'fmt/18'),
+    (re.compile(rb'%PDF-1\.5'), b'%%EOF', 1024, 'application/pdf', 'fmt/19'),
+    (re.compile(rb'%PDF-1\.6'), b'%%EOF', 1024, 'application/pdf', 'fmt/20'),
+    (re.compile(rb'%PDF-1\.7'), b'%%EOF', 1024, 'application/pdf', 'fmt/276'),
+    (re.compile(rb'(?:\xef\xbb\xbf)?\s*<!doctype html>', re.I), b'', 0, 'text/html', 'fmt/471'),
+]
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# The number of bytes fido allows after the end of a PNG's IEND chunk.
+PNG_TRAILING_BYTES = 4
+
+# PNG chunks that first appeared in PNG 1.2 and 1.1, and the PUID each version implies.
+PNG_VERSION_CHUNKS = [({b'iTXt'}, 'fmt/13'), ({b'sRGB', b'iCCP', b'sPLT'}, 'fmt/12')]
+
 DNS = re.compile(r'^dns:')
 
 DIGEST_CACHE = {}
 
+# The estimated size in bytes of the entries in DIGEST_CACHE.
+DIGEST_CACHE_SIZE = 0
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+# The number of seconds between progress summaries in the log.
+PROGRESS_INTERVAL = 60
+
+# The gzip compression level used by warcio for each sidecar record.
+COMPRESS_LEVEL = 9
+
+# The hostname and IP address of this host, found once per process.
+HOST_IDENTITY = {}
+
+# A non-routable address used to select the outgoing interface; no packets are sent to it.
+PROBE_ADDRESS = ('10.255.255.255', 1)
+
+# The number of seconds between checks of a followed WARC for new records.
+FOLLOW_POLL_INTERVAL = 10
+
+# The number of seconds a followed WARC may go without growing before following stops.
+FOLLOW_IDLE_TIMEOUT = 3600
+
+# The number of bytes read at a time while searching for the first record after a split point.
+BOUNDARY_SEARCH_BLOCK = 2 ** 20
+
+# The bytes that begin a gzip member and a WARC record.
+GZIP_MAGIC = b'\x1f\x8b\x08'
+WARC_MAGIC = b'WARC/1.'
+
+# The estimated resident memory of a process with the fido signatures, soft-404 model, and
+# detectors loaded, before any payload is read. It measures 150 to 200 MB, depending on the
+# versions of the libraries.
+WORKER_BASE_MEMORY = 224 * 2 ** 20
+
+# The bytes of memory per payload byte held while a payload is read and identified: the bytes
+# read, the decompressed chunks they are joined from, and the copy python-magic reads.
+PAYLOAD_COPIES = 3
+
+# The peak bytes of memory per byte of payload given to each detector, the highest measured on
+# plain text, CJK text, and HTML dense with tags, rounded up. soft404 parses the whole page.
+DETECTOR_MEMORY = {'charset': 2, 'lang': 24, 'soft404': 128}
+
+# The share of a process's memory above its base given to DIGEST_CACHE. Half of the rest is for
+# reading payloads, and half for the detectors.
+CACHE_SHARE = 0.25
+
+# Linux files that hold a process's resident memory high-water mark, and that reset it.
+PROC_STATUS = '/proc/self/status'
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+
+MEMORY_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+# The detectors a rule's profile can choose from. The mimetype and PUID are always identified.
+DETECTORS = ('mime', 'charset', 'lang', 'soft404')
+
+# The conditions a rule can have, all of which must hold for the rule to match a record.
+RULE_CONDITIONS = ('surt_prefix', 'url_regex', 'content_type', 'min_length', 'max_length')
+# Stands for a payload length that is not known until the payload is read.
+UNREAD = object()
+
+RULE_ACTIONS = ('include', 'exclude')
+
+# The sample values of records are the first SAMPLE_HASH_BYTES bytes of a hash, scaled to [0, 1).
+SAMPLE_HASH_BYTES = 8
+
 
 class ExtendFido(Fido):
     """A class that extends Fido to override some methods."""
@@ -73,13 +226,98 @@ class ExtendFido(Fido):
         return (fido_mime, puid)
 
 
-def find_mime_and_puid(fido, payload):
-    """Find the mimetype and preservation identifier using fido and python-magic."""
+class CompressingWrapper:
+    """Compress everything written for one record into its own gzip member.
+
+    Unlike warcio's GzippingWrapper, flushing does not flush the
+    underlying file, so the file's buffer batches many small records
+    into each write.
+    """
+    def __init__(self, out, compressor=zlib, compress_level=COMPRESS_LEVEL):
+        self.compressor = compressor.compressobj(compress_level, zlib.DEFLATED,
+                                                 zlib.MAX_WBITS + 16)
+        self.out = out
+
+    def write(self, buff):
+        self.out.write(self.compressor.compress(buff))
+
+    def flush(self):
+        self.out.write(self.compressor.flush())
+
+
+class SidecarWriter(WARCWriter):
+    """A WARCWriter with a choice of gzip compression level and deflate implementation."""
+    def __init__(self, filebuf, compress_level=COMPRESS_LEVEL, compressor='zlib'):
+        super(SidecarWriter, self).__init__(filebuf, gzip=False)
+        self.compressor = COMPRESSORS[compressor]
+        if compressor == 'isal':
+            # ISA-L only has compression levels 0 to 3.
+            compress_level = min(compress_level, isal_zlib.ISAL_BEST_COMPRESSION)
+        self.compress_level = compress_level
+
+    def _write_warc_record(self, out, record):
+        """Write the record as a single gzip member, keeping each record randomly accessible."""
+        wrapper = CompressingWrapper(out, self.compressor, self.compress_level)
+        super(SidecarWriter, self)._write_warc_record(wrapper, record)
+
+
+def sniff_png_puid(bytes_payload):
+    """Walk the chunks of a PNG and return its PUID, or None if the PNG is incomplete."""
+    chunk_types = set()
+    position = len(PNG_SIGNATURE)
+    while position + 8 <= len(bytes_payload):
+        length, chunk_type = struct.unpack('>I4s', bytes_payload[position:position + 8])
+        chunk_types.add(chunk_type)
+        position += length + 12
+        if chunk_type == b'IEND':
+            if len(bytes_payload) - position > PNG_TRAILING_BYTES:
+                return None
+            for version_chunks, puid in PNG_VERSION_CHUNKS:
+                if chunk_types & version_chunks:
+                    return puid
+            return 'fmt/11'
+    return None
+
+
+def sniff_format(bytes_payload):
+    """Identify the most common formats from their magic numbers.
+
+    Returns the mimetype and PUID, or None when the payload is not one
+    of the formats in SNIFF_TABLE or is truncated, so fido and
+    python-magic can make the identification.
+    """
+    if bytes_payload.startswith(PNG_SIGNATURE):
+        puid = sniff_png_puid(bytes_payload)
+        return ('image/png', puid) if puid else None
+    for pattern, trailer, window, mime, puid in SNIFF_TABLE:
+        if pattern.match(bytes_payload):
+            if trailer in bytes_payload[-window:]:
+                return (mime, puid)
+            return None
+    return None
+
+
+def find_mime_and_puid(fido, payload, full_identification=False, magic_handle=None):
+    """Find the mimetype and preservation identifier.
+
+    Common formats are identified by their magic numbers, recorded with
+    the 'sniffer' key. Fido and python-magic are used for everything
+    else, or for every payload with full_identification. A magic.Magic
+    handle can be passed in to be reused.
+    """
+    if not full_identification:
+        sniffed = sniff_format(payload.getvalue())
+        if sniffed:
+            sniffed_mime, puid = sniffed
+            return ({'sniffer': sniffed_mime}, puid)
     # Using fido to find mimetype and puid.
     fido_mime, puid = fido.identify_stream(payload)
     # Using python-magic to find mimetype.
     payload.seek(0)
-    magic_mime = magic.from_buffer(payload.read(), mime=True)
+    if magic_handle:
+        magic_mime = magic_handle.from_buffer(payload.read())
+    else:
+        magic_mime = magic.from_buffer(payload.read(), mime=True)
     mime_dict = {}
     if fido_mime:
         mime_dict['fido'] = fido_mime
@@ -88,10 +326,17 @@ def find_mime_and_puid(fido, payload):
     return (mime_dict, puid)
 
 
-def find_character_set(payload):
-    """Find the character set of the payload using chardet."""
-    detector = UniversalDetector()
-    for line in payload.readlines():
+def find_character_set(payload, detector=None):
+    """Find the character set of the payload using chardet.
+
+    A detector can be passed in to be reset and reused.
+    """
+    if detector is None:
+        detector = UniversalDetector()
+    else:
+        detector.reset()
+    # Lines are fed as they are read, without a list of every line of the payload.
+    for line in payload:
         detector.feed(line)
         if detector.done:
             break
@@ -102,12 +347,46 @@ def find_character_set(payload):
     return result_dict
 
 
-def find_language(bytes_load):
-    """Find the language of the payload using pycld2."""
-    is_reliable, bytes_found, details = cld2.detect(BAD_CHARS.sub('',
-                                                                  bytes_load.decode('utf-8',
-                                                                                    'replace')),
-                                                    bestEffort=True)
+def extract_visible_text(html_text):
+    """Remove scripts, styles, comments and tags from HTML, leaving the visible text."""
+    html_text = HTML_INVISIBLE.sub(' ', html_text)
+    html_text = HTML_TAG.sub(' ', html_text)
+    return WHITESPACE.sub(' ', html.unescape(html_text))
+
+
+def sample_text(text, max_chars=LANG_MAX_CHARS, samples=LANG_SAMPLES):
+    """Return at most max_chars of the text, taken as evenly spaced samples.
+
+    Each sample starts at a word boundary where one is near, so words
+    are not cut in half. Text within the limit is returned unchanged.
+    """
+    if not max_chars or len(text) <= max_chars:
+        return text
+    samples = max(samples, 1)
+    sample_chars = max_chars // samples
+    step = (len(text) - sample_chars) / max(samples - 1, 1)
+    sampled = []
+    for number in range(samples):
+        start = int(number * step)
+        if start:
+            word_start = text.find(' ', start, start + sample_chars // 2)
+            if word_start != -1:
+                start = word_start + 1
+        sampled.append(text[start:start + sample_chars])
+    return '\n'.join(sampled)
+
+
+def find_language(bytes_load, is_html=False, max_chars=LANG_MAX_CHARS, samples=LANG_SAMPLES):
+    """Find the language of the payload using pycld2.
+
+    Only the visible text of HTML is used, and long text is sampled
+    down to max_chars before detection.
+    """
+    text = bytes_load.decode('utf-8', 'replace')
+    if is_html:
+        text = extract_visible_text(text)
+    text = sample_text(text, max_chars, samples)
+    is_reliable, bytes_found, details = cld2.detect(BAD_CHARS.sub('', text), bestEffort=True)
     new_list = []
     # 'details' seems to always return 3, if the language is 'Unknown' we don't need to list it.
     for item in details:
@@ -131,13 +410,46 @@ def determine_soft404(bytes_payload):
     return soft404.probability(bytes_payload.decode('utf-8', 'replace'))
 
 
-def create_warcinfo_payload(new_file, operator=None, publisher=None):
+def find_host_ip():
+    """Find the IP address of the outgoing network interface without a DNS lookup."""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Connecting a UDP socket only selects a route, nothing is sent or resolved.
+        probe.connect(PROBE_ADDRESS)
+        return probe.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+    finally:
+        probe.close()
+
+
+def get_host_identity(hostname=None, ip=None):
+    """Return the hostname and IP address to record in the warcinfo record.
+
+    Values passed in take precedence, followed by the SIDECAR_HOSTNAME
+    and SIDECAR_IP environment variables. Otherwise the hostname and
+    the address of the outgoing interface are found once per process,
+    without a DNS lookup, and cached in HOST_IDENTITY.
+    """
+    if not HOST_IDENTITY:
+        found_hostname = os.environ.get('SIDECAR_HOSTNAME')
+        if not found_hostname:
+            try:
+                found_hostname = socket.gethostname()
+            except OSError:
+                found_hostname = 'localhost'
+        HOST_IDENTITY['hostname'] = found_hostname
+        HOST_IDENTITY['ip'] = os.environ.get('SIDECAR_IP') or find_host_ip()
+    return (hostname or HOST_IDENTITY['hostname'], ip or HOST_IDENTITY['ip'])
+
+
+def create_warcinfo_payload(new_file, operator=None, publisher=None, hostname=None, ip=None):
     """Collect WARC fields to create warcinfo record payload."""
-    hostname = socket.gethostname()
+    hostname, ip = get_host_identity(hostname, ip)
     warc_doc = 'http://bibnum.bnf.fr/WARC/WARC_ISO_28500_version1_latestdraft.pdf'
     warcinfo_payload = {'software': 'warc-metadata-sidecar/' + __version__,
                         'hostname': hostname,
-                        'ip': socket.gethostbyname(hostname),
+                        'ip': ip,
                         'conformsTo': warc_doc,
                         'description': 'WARC metdata sidecar for ' + new_file}
     if publisher:
@@ -148,6 +460,16 @@ def create_warcinfo_payload(new_file, operator=None, publisher=None):
     return warcinfo_payload
 
 
+def parse_warcinfo(record):
+    """Return the fields of a warcinfo record's payload as a dictionary."""
+    warc_info = {}
+    for line in record.content_stream().read().decode('utf-8').splitlines():
+        if ': ' in line:
+            key, value = line.split(': ', 1)
+            warc_info[key] = value
+    return warc_info
+
+
 def create_string_payload(mime_dict, puid, result_dict, lang_cld, soft404):
     """Collect content mime, puid, encoding, and language to create record payload."""
     payload = []
@@ -164,143 +486,1196 @@ def create_string_payload(mime_dict, puid, result_dict, lang_cld, soft404):
     return '\n'.join(payload)
 
 
-def metadata_sidecar(archive_dir, warc_file, operator=None, publisher=None):
-    start = time.time()
+def parse_string_payload(string_payload):
+    """Split a sidecar record payload into a dictionary of its field titles and values."""
+    fields = {}
+    for line in string_payload.split('\n'):
+        title, value = line.split(' ', 1)
+        fields[title] = value
+    return fields
 
-    if not os.path.isdir(archive_dir):
-        os.mkdir(archive_dir)
 
-    logging.basicConfig(
-        filename=os.path.join(archive_dir, 'sidecar.log'),
-        level=logging.INFO,
-        format='%(asctime)s %(levelname)s %(message)s',
-    )
-    logging.getLogger(__name__)
-    logging.info('Logging WARC metadata record information for %s', warc_file)
-
-    # Create sidecar filename, adding 'meta' as extension.
-    new_file = os.path.basename(warc_file)
-    meta_file = re.sub(r'w?arc(\.gz)?$', 'warc.meta.gz', new_file)
-    logging.info('Creating sidecar %s', meta_file)
-    meta_file_path = os.path.join(archive_dir, meta_file)
-    # Determine the type of file we are processing, WARC or ARC.
-    warc = True
-    if ARC.match(new_file):
-        warc = False
-
-    # Open the sidecar file to write in the metadata, open the warc file to get each record.
-    with open(meta_file_path, 'ab') as output, open(warc_file, 'rb') as stream:
-        records_written = 0  # The number of records with metadata.
-        total_records_read = 0  # The total number of records within the WARC file.
-        text_mime = 0  # The number of records with 'text' type mimetypes.
-        non_text = 0  # The number of records with other types of mimetypes (ex: img or gif).
-        fido = ExtendFido()
-
-        writer = WARCWriter(output, gzip=True)
-        warc_info = create_warcinfo_payload(new_file, operator, publisher)
-        # Create warcinfo record and write it into sidecar.
-        warcinfo_record = writer.create_warcinfo_record(meta_file, warc_info)
-        writer.write_record(warcinfo_record)
-
-        for record in ArchiveIterator(stream, arc2warc=True):
-            total_records_read += 1
-            if record.rec_type not in ['response', 'resource']:
-                continue
-            url = record.rec_headers.get_header('WARC-Target-URI')
-            if DNS.match(url):
-                continue
-            # The payload is how we find the important info. Skip record if empty.
-            payload = io.BytesIO(record.content_stream().read())
-            if not payload.read(1):
-                continue
-            # Define specific warc_headers to include in sidecar.
-            record_date = record.rec_headers.get_header('WARC-Date')
-            if warc:
-                # This digest hash is not included in the sidecar.
-                warc_digest = record.rec_headers.get_header('WARC-Payload-Digest')
-                warcinfo_id = record.rec_headers.get_header('WARC-Warcinfo-ID')
-                warcrecord_id = record.rec_headers.get_header('WARC-Record-ID')
-                warc_dict = {'WARC-Date': record_date, 'WARC-Concurrent-ID': warcrecord_id}
-                if warcinfo_id:
-                    warc_dict['WARC-Warcinfo-ID'] = warcinfo_id
+def join_string_payload(fields):
+    """Join field titles and values into a sidecar record payload, in the usual field order."""
+    return '\n'.join('{0} {1}'.format(title, fields[title])
+                     for title in PAYLOAD_TITLES if title in fields)
+
+
+class SidecarAnalyzer:
+    """Find the sidecar metadata of payloads, reusing the same detectors for every payload.
+
+    The fido signatures, chardet detector, and python-magic handle are
+    created once, so a service can analyze payloads in process without
+    a setup cost per payload.
+    """
+    def __init__(self, fido=None, full_identification=False, lang_max_chars=LANG_MAX_CHARS,
+                 lang_samples=LANG_SAMPLES, detector_limits=None):
+        self.fido = fido if fido is not None else ExtendFido()
+        self.charset_detector = UniversalDetector()
+        self.magic_handle = magic.Magic(mime=True)
+        self.full_identification = full_identification
+        self.lang_max_chars = lang_max_chars
+        self.lang_samples = lang_samples
+        self.detector_limits = detector_limits or {}
+
+    def limit_payload(self, bytes_payload, detector):
+        """Return the start of a payload that a detector with a limit is given."""
+        limit = self.detector_limits.get(detector)
+        if limit is not None and len(bytes_payload) > limit:
+            return bytes_payload[:limit]
+        return bytes_payload
+
+    def analyze_payload(self, bytes_payload, status=None, detectors=DETECTORS):
+        """Return the string payload of a payload's metadata and whether the payload is text.
+
+        The charset, language, and soft-404 detectors in detectors run on
+        text payloads, soft-404 only on HTML with a 200 status. Each is
+        given no more of the payload than its detector_limits allow.
+        """
+        payload = io.BytesIO(bytes_payload)
+        mime_dict, puid = find_mime_and_puid(self.fido, payload, self.full_identification,
+                                             self.magic_handle)
+        mimes_found = ' '.join(mime_dict.values())
+        is_text = bool(TEXT_FORMAT_MIMES.search(mimes_found))
+        result_dict = {}
+        lang_cld = None
+        soft404_detected = None
+        if is_text:
+            if 'charset' in detectors:
+                result_dict = find_character_set(
+                    io.BytesIO(self.limit_payload(bytes_payload, 'charset')),
+                    self.charset_detector)
+            if 'lang' in detectors:
+                lang_cld = find_language(self.limit_payload(bytes_payload, 'lang'),
+                                         'html' in mimes_found, self.lang_max_chars,
+                                         self.lang_samples)
+            if 'soft404' in detectors and status == '200' and 'html' in mimes_found:
+                soft404_detected = determine_soft404(self.limit_payload(bytes_payload,
+                                                                        'soft404'))
+        string_payload = create_string_payload(mime_dict, puid, result_dict, lang_cld,
+                                               soft404_detected)
+        return (string_payload, is_text)
+
+    def analyze(self, payload, http_headers=None, detectors=DETECTORS):
+        """Return the string payload of a payload's metadata, as written to a sidecar.
+
+        http_headers are the warcio StatusAndHeaders of an HTTP response,
+        whose status decides whether soft-404 detection runs.
+        """
+        status = http_headers.get_statuscode() if http_headers else None
+        return self.analyze_payload(payload, status, detectors)[0]
+
+    def analyze_many(self, payloads):
+        """Yield the string payload of each payload, or each (payload, http_headers) pair."""
+        for item in payloads:
+            if isinstance(item, tuple):
+                yield self.analyze(*item)
             else:
-                warc_dict = {'WARC-Date': record_date}
-                warc_digest = None
-
-            logging.info(url)
-            if warc_digest and warc_digest in DIGEST_CACHE:
-                saved_metadata = DIGEST_CACHE.get(warc_digest)
-                metadata_list = saved_metadata.split('\n')
-                if TEXT_FORMAT_MIMES.search(metadata_list[0]):
-                    text_mime += 1
-                else:
-                    non_text += 1
-                meta_record = writer.create_warc_record(url,
-                                                        'metadata',
-                                                        payload=io.BytesIO(
-                                                            saved_metadata.encode()),
-                                                        warc_headers_dict=warc_dict
-                                                        )
-                writer.write_record(meta_record)
-                records_written += 1
+                yield self.analyze(item)
+
+
+def write_metadata_record(writer, url, warc_dict, string_payload, cdxj_out=None):
+    """Write a metadata record to the sidecar, and its CDXJ line when emitting a CDXJ."""
+    meta_record = writer.create_warc_record(url,
+                                            'metadata',
+                                            payload=io.BytesIO(string_payload.encode()),
+                                            warc_headers_dict=warc_dict
+                                            )
+    writer.write_record(meta_record)
+    if cdxj_out:
+        json_string = sidecar2cdxj.payload_to_json(string_payload)
+        cdxj_out.write(sidecar2cdxj.create_cdxj_line(url, warc_dict['WARC-Date'], json_string))
+
+
+class ProgressReporter:
+    """Log periodic progress summaries while a WARC is read, in place of a line per record."""
+    def __init__(self, stream, total_bytes=None, interval=PROGRESS_INTERVAL):
+        self.stream = stream
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+
+    def update(self, records_read, records_written):
+        """Log a summary if the reporting interval has passed since the last one."""
+        if not self.interval:
+            return
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(records_read, records_written, now)
+
+    def report(self, records_read, records_written, now=None):
+        """Log the records and bytes read per second and the estimated time remaining."""
+        now = now or time.time()
+        elapsed = max(now - self.start, 0.001)
+        bytes_read = self.stream.tell()
+        bytes_per_sec = bytes_read / elapsed
+        message = '{} records read, {} written, {:.1f} records/sec, {:.2f} MB/sec'.format(
+            records_read, records_written, records_read / elapsed, bytes_per_sec / 1000000)
+        if self.total_bytes and bytes_per_sec:
+            remaining = max(self.total_bytes - bytes_read, 0) / bytes_per_sec
+            message += ', ETA {}'.format(timedelta(seconds=round(remaining)))
+        logging.info('Progress: %s', message)
+
+
+def parse_memory_size(size):
+    """Convert a memory size such as 512M or 4G, in bytes without a unit, to bytes."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid memory size: {}'.format(size))
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+
+
+def plan_memory(max_memory, workers=1):
+    """Split a memory budget into workers, each with payload limits and a cache size.
+
+    Every process is estimated to need WORKER_BASE_MEMORY. Workers are
+    limited so each has at least that much again for payloads and its
+    cache, after the parent process of parallel workers takes its base.
+    Returns the number of workers, the payload limit, the cache size,
+    and a dictionary of the limits of the charset, lang, and soft404
+    detectors.
+    """
+    if workers > 1:
+        workers = min(workers, (max_memory - WORKER_BASE_MEMORY) // (2 * WORKER_BASE_MEMORY))
+    if workers > 1:
+        spare = (max_memory - WORKER_BASE_MEMORY) // workers - WORKER_BASE_MEMORY
+    else:
+        workers = 1
+        spare = max_memory - WORKER_BASE_MEMORY
+    if spare <= 0:
+        raise ValueError('The memory limit must be over {} MB'.format(
+            WORKER_BASE_MEMORY // 2 ** 20))
+    cache_bytes = int(spare * CACHE_SHARE)
+    payload_share = (spare - cache_bytes) // 2
+    payload_limit = payload_share // PAYLOAD_COPIES
+    detector_limits = {detector: min(payload_limit, payload_share // memory)
+                       for detector, memory in DETECTOR_MEMORY.items()}
+    return (workers, payload_limit, cache_bytes, detector_limits)
+
+
+def reset_peak_memory():
+    """Reset this process's resident memory high-water mark, returning whether Linux allowed it."""
+    try:
+        with open(PROC_CLEAR_REFS, 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def peak_memory():
+    """Return this process's resident memory high-water mark since reset_peak_memory.
+
+    Without /proc, this is the high-water mark over the process's life.
+    """
+    try:
+        with open(PROC_STATUS, 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def get_cached_metadata(cache_key):
+    """Return the metadata saved for a cache key, or None, marking it as recently used."""
+    saved_metadata = DIGEST_CACHE.pop(cache_key, None)
+    if saved_metadata is not None:
+        DIGEST_CACHE[cache_key] = saved_metadata
+    return saved_metadata
+
+
+def cache_metadata(cache_key, string_payload, cache_bytes=None):
+    """Save metadata for reuse, evicting the least recently used entries over cache_bytes."""
+    global DIGEST_CACHE_SIZE
+    # The size restarts whenever the cache is emptied, including by replacing it.
+    if not DIGEST_CACHE:
+        DIGEST_CACHE_SIZE = 0
+    DIGEST_CACHE[cache_key] = string_payload
+    DIGEST_CACHE_SIZE += sys.getsizeof(cache_key) + sys.getsizeof(string_payload)
+    if cache_bytes is None:
+        return
+    while DIGEST_CACHE_SIZE > cache_bytes and DIGEST_CACHE:
+        old_key = next(iter(DIGEST_CACHE))
+        old_payload = DIGEST_CACHE.pop(old_key)
+        DIGEST_CACHE_SIZE -= sys.getsizeof(old_key) + sys.getsizeof(old_payload)
+
+
+def as_list(value):
+    """Return a rule condition that may be given as one value or a list of values as a list."""
+    return value if isinstance(value, list) else [value]
+
+
+def compile_rule(rule):
+    """Check a rule from a rules file and compile its patterns, raising ValueError if invalid."""
+    if not isinstance(rule, dict):
+        raise ValueError('A rule must be a JSON object: {}'.format(rule))
+    unknown = set(rule) - set(RULE_CONDITIONS) - {'action', 'detectors'}
+    if unknown:
+        raise ValueError('Unknown rule fields: {}'.format(', '.join(sorted(unknown))))
+    action = rule.get('action', 'include')
+    if action not in RULE_ACTIONS:
+        raise ValueError('A rule action must be include or exclude, not {}'.format(action))
+    detectors = rule.get('detectors', DETECTORS)
+    unknown = set(detectors) - set(DETECTORS)
+    if unknown:
+        raise ValueError('Unknown detectors: {}'.format(', '.join(sorted(unknown))))
+    compiled = {'action': action,
+                'detectors': tuple(detector for detector in DETECTORS
+                                   if detector in detectors or detector == 'mime')}
+    if 'surt_prefix' in rule:
+        compiled['surt_prefix'] = tuple(as_list(rule['surt_prefix']))
+    if 'url_regex' in rule:
+        compiled['url_regex'] = re.compile(rule['url_regex'])
+    if 'content_type' in rule:
+        compiled['content_type'] = tuple(content_type.lower()
+                                         for content_type in as_list(rule['content_type']))
+    for bound in ['min_length', 'max_length']:
+        if bound in rule:
+            compiled[bound] = int(rule[bound])
+    return compiled
+
+
+def load_rules(rules_file):
+    """Read a JSON rules file, a list of rules that are checked in order, and compile them.
+
+    Each rule has an action, include or exclude, and conditions on the
+    record's SURT prefix, URL regex, declared Content-Type prefix, and
+    declared payload length. An included record is analyzed with the
+    rule's detectors, or all of them.
+    """
+    with open(rules_file, 'r') as rules:
+        rule_list = json.load(rules)
+    if not isinstance(rule_list, list):
+        raise ValueError('A rules file must hold a JSON list of rules')
+    return [compile_rule(rule) for rule in rule_list]
+
+
+def declared_length(record):
+    """Return the payload length declared by a record's headers, before the payload is read."""
+    if record.length is None:
+        return None
+    if record.http_headers:
+        return record.length - record.http_headers.total_len
+    return record.length
+
+
+def declared_content_type(record):
+    """Return the media type of the HTTP Content-Type, or the WARC Content-Type of a resource."""
+    if record.http_headers:
+        content_type = record.http_headers.get_header('Content-Type')
+    else:
+        content_type = record.rec_headers.get_header('Content-Type')
+    return (content_type or '').split(';')[0].strip().lower()
+
+
+def rule_matches(rule, record, url, record_surt, length=UNREAD):
+    """Return whether every condition of a rule holds for a record.
+
+    Returns UNREAD when only the length conditions are left to check
+    and the payload length is not known yet.
+    """
+    if 'surt_prefix' in rule and not record_surt.startswith(rule['surt_prefix']):
+        return False
+    if 'url_regex' in rule and not rule['url_regex'].search(url):
+        return False
+    if 'content_type' in rule and not declared_content_type(record).startswith(
+            rule['content_type']):
+        return False
+    if 'min_length' in rule or 'max_length' in rule:
+        if length is UNREAD:
+            return UNREAD
+        if length is None:
+            return False
+        if length < rule.get('min_length', length) or length > rule.get('max_length', length):
+            return False
+    return True
+
+
+def choose_detectors(rules, record, url, length=UNREAD):
+    """Return the detectors of the first rule matching a record, or None if it is excluded.
+
+    A record no rule matches is analyzed with every detector. Without
+    the payload length, only the record's headers are used, and UNREAD
+    is returned when the first rule that may match has length conditions.
+    """
+    record_surt = None
+    for rule in rules:
+        if 'surt_prefix' in rule and record_surt is None:
+            record_surt = surt.surt(url)
+        matches = rule_matches(rule, record, url, record_surt, length)
+        if matches is UNREAD:
+            return UNREAD
+        if matches:
+            return rule['detectors'] if rule['action'] == 'include' else None
+    return DETECTORS
+
+
+def sample_value(url, digest=None):
+    """Map a record's URI and payload digest to a number in [0, 1) that is the same every run."""
+    key = '{} {}'.format(url, digest or '').encode('utf-8')
+    value = int.from_bytes(hashlib.sha1(key).digest()[:SAMPLE_HASH_BYTES], 'big')
+    return value / 2 ** (8 * SAMPLE_HASH_BYTES)
+
+
+def iter_sample_values(stream, rules=None):
+    """Yield the sample value of each response or resource record that could get metadata.
+
+    Records excluded by the rules are skipped, with length bounds
+    checked on the declared payload length.
+    """
+    for record in ArchiveIterator(stream, arc2warc=True):
+        if record.rec_type not in ['response', 'resource']:
+            continue
+        url = record.rec_headers.get_header('WARC-Target-URI')
+        if DNS.match(url):
+            continue
+        if rules and choose_detectors(rules, record, url, declared_length(record)) is None:
+            continue
+        yield sample_value(url, record.rec_headers.get_header('WARC-Payload-Digest'))
+
+
+def find_sample_threshold(warc_file, sample_n, rules=None):
+    """Return the sample value below which exactly the sample_n lowest records of a WARC fall.
+
+    Only the records the rules include are counted. Only record headers
+    are read, so this pass over the WARC is much faster than the
+    analysis of the sample that follows it.
+    """
+    with open(warc_file, 'rb') as stream:
+        lowest = heapq.nsmallest(sample_n + 1, iter_sample_values(stream, rules))
+    if len(lowest) <= sample_n:
+        return 1.0
+    return lowest[-1]
+
+
+class Sampler:
+    """Choose the records analyzed in sampling mode, and collect the statistics of the sample.
+
+    A record is chosen when its sample value is below the threshold, so
+    the same records are chosen every run, and a record chosen at a
+    lower threshold is also chosen at every higher one.
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.population = 0
+        self.chosen = 0
+        self.stats = sidecar_stats.create_stats()
+
+    def choose(self, url, digest=None):
+        """Count a record in the population and return whether it is in the sample."""
+        self.population += 1
+        if sample_value(url, digest) >= self.threshold:
+            return False
+        self.chosen += 1
+        return True
+
+    def add(self, string_payload):
+        """Add the metadata written for a sampled record to the statistics of the sample."""
+        sidecar_stats.add_meta_obj(self.stats, sidecar2cdxj.parse_payload(string_payload))
+
+    def summary(self):
+        """Return the population estimates of the sample, with 95% confidence intervals.
+
+        Chosen records with an empty payload or no metadata are not in the
+        statistics, so the population is scaled to the share of chosen
+        records with metadata.
+        """
+        population = 0
+        if self.chosen:
+            population = round(self.population * self.stats['records'] / self.chosen)
+        summary = sidecar_stats.sample_summary(self.stats, population)
+        summary.update({'threshold': self.threshold,
+                        'sampled_records': self.chosen,
+                        'candidate_records': self.population})
+        return summary
+
+
+def create_sample_path(meta_file_path):
+    """Create the path of the summary written in sampling mode."""
+    return re.sub(r'\.meta\.gz$', '.sample.json', meta_file_path)
+
+
+def write_sample_summary(sample_path, summary):
+    """Write the summary of a sample as JSON, replacing sample_path."""
+    tmp_path = sample_path + '.tmp'
+    with open(tmp_path, 'w') as sample_file:
+        json.dump(summary, sample_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, sample_path)
+
+
+@contextmanager
+def sidecar_logging(archive_dir, log_level=logging.INFO):
+    """Log to sidecar.log in archive_dir through a queue, writing from a background thread.
+
+    Formatting and writing the log file happens in the queue listener's
+    thread rather than between records. The handler is removed and the
+    queue flushed when the block exits.
+    """
+    file_handler = logging.FileHandler(os.path.join(archive_dir, 'sidecar.log'))
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    root_logger = logging.getLogger()
+    previous_level = root_logger.level
+    root_logger.setLevel(log_level)
+    root_logger.addHandler(queue_handler)
+    listener.start()
+    try:
+        yield
+    finally:
+        root_logger.removeHandler(queue_handler)
+        root_logger.setLevel(previous_level)
+        listener.stop()
+        file_handler.close()
+
+
+def write_sidecar_records(stream, writer, fido, warc=True, cdxj_out=None, progress=None,
+                          full_identification=False, lang_max_chars=LANG_MAX_CHARS,
+                          lang_samples=LANG_SAMPLES, sampler=None, rules=None,
+                          payload_limit=None, cache_bytes=None, detector_limits=None):
+    """Write a metadata record for each response or resource record in a WARC/ARC stream.
+
+    Records excluded by the rules are skipped, and included records are
+    analyzed with their rule's detectors. With a sampler, only the
+    records it chooses are analyzed. Only the first payload_limit bytes
+    of a payload are read, and a payload over the limit only gets its
+    mimetype and PUID. The detectors in detector_limits are given only
+    that many bytes of a payload. Returns the
+    number of metadata records written, the total number of records
+    read, and the number of records with text and other mimetypes.
+    """
+    records_written = 0  # The number of records with metadata.
+    total_records_read = 0  # The total number of records within the WARC file.
+    text_mime = 0  # The number of records with 'text' type mimetypes.
+    non_text = 0  # The number of records with other types of mimetypes (ex: img or gif).
+    analyzer = SidecarAnalyzer(fido, full_identification, lang_max_chars, lang_samples,
+                               detector_limits)
+
+    for record in ArchiveIterator(stream, arc2warc=True):
+        total_records_read += 1
+        if progress:
+            progress.update(total_records_read, records_written)
+        if record.rec_type not in ['response', 'resource']:
+            continue
+        url = record.rec_headers.get_header('WARC-Target-URI')
+        if DNS.match(url):
+            continue
+        # Rules are checked on the headers, before the payload is read.
+        detectors = choose_detectors(rules, record, url) if rules else DETECTORS
+        if detectors is None:
+            logging.debug('Excluded by rule: %s', url)
+            continue
+        # Records outside the sample are skipped before their payload is read.
+        if sampler and not sampler.choose(
+                url, record.rec_headers.get_header('WARC-Payload-Digest')):
+            continue
+        # The payload is how we find the important info. Skip record if empty.
+        bytes_read = record.content_stream().read(payload_limit + 1 if payload_limit else None)
+        if not bytes_read:
+            continue
+        truncated = bool(payload_limit) and len(bytes_read) > payload_limit
+        if detectors is UNREAD:
+            # The declared length of a record can be off, so bounds are checked on the payload.
+            length = declared_length(record) if truncated else len(bytes_read)
+            detectors = choose_detectors(rules, record, url, length)
+            if detectors is None:
+                logging.debug('Excluded by rule: %s', url)
                 continue
+        if truncated:
+            logging.warning('Payload of %s is over %s bytes, identifying only its format from '
+                            'its start', url, payload_limit)
+            bytes_read = bytes_read[:payload_limit]
+            detectors = ('mime',)
+        # Define specific warc_headers to include in sidecar.
+        record_date = record.rec_headers.get_header('WARC-Date')
+        if warc:
+            # This digest hash is not included in the sidecar.
+            warc_digest = record.rec_headers.get_header('WARC-Payload-Digest')
+            warcinfo_id = record.rec_headers.get_header('WARC-Warcinfo-ID')
+            warcrecord_id = record.rec_headers.get_header('WARC-Record-ID')
+            warc_dict = {'WARC-Date': record_date, 'WARC-Concurrent-ID': warcrecord_id}
+            if warcinfo_id:
+                warc_dict['WARC-Warcinfo-ID'] = warcinfo_id
+        else:
+            warc_dict = {'WARC-Date': record_date}
+            warc_digest = None
+        # Metadata found with fewer detectors is only reused for records with the same ones.
+        cache_key = warc_digest
+        if warc_digest and detectors != DETECTORS:
+            cache_key = '{} {}'.format(warc_digest, ','.join(detectors))
+        if truncated:
+            # Metadata of part of a payload is never reused.
+            cache_key = None
 
-            payload.seek(0)
-            mime_dict, puid = find_mime_and_puid(fido, payload)
-            mimes_found = ' '.join(mime_dict.values())
-            soft404_detected = None
-            result_dict = {}
-            lang_cld = None
-            # If these text formats are in the mime type(s), find the encoding and language.
-            if TEXT_FORMAT_MIMES.search(mimes_found):
-                payload.seek(0)
-                result_dict = find_character_set(payload)
-                payload.seek(0)
-                bytes_payload = payload.read()
-                lang_cld = find_language(bytes_payload)
+        logging.debug(url)
+        saved_metadata = get_cached_metadata(cache_key) if cache_key else None
+        if saved_metadata is not None:
+            metadata_list = saved_metadata.split('\n')
+            if TEXT_FORMAT_MIMES.search(metadata_list[0]):
                 text_mime += 1
-                # Determine the soft404 probability on html records.
-                status = record.http_headers.get_statuscode()
-                if status == '200' and 'html' in mimes_found:
-                    soft404_detected = determine_soft404(bytes_payload)
             else:
                 non_text += 1
-            string_payload = create_string_payload(mime_dict, puid, result_dict,
-                                                   lang_cld, soft404_detected)
-            if not string_payload:
-                continue
+            write_metadata_record(writer, url, warc_dict, saved_metadata, cdxj_out)
             records_written += 1
+            if sampler:
+                sampler.add(saved_metadata)
+            continue
+
+        # Text payloads also get their encoding, language, and soft-404 probability found.
+        status = record.http_headers.get_statuscode() if record.http_headers else None
+        string_payload, is_text = analyzer.analyze_payload(bytes_read, status, detectors)
+        if is_text:
+            text_mime += 1
+        else:
+            non_text += 1
+        if not string_payload:
+            continue
+        records_written += 1
+        if sampler:
+            sampler.add(string_payload)
+
+        # Save the record metadata for each digest hash for possible reuse.
+        if cache_key:
+            cache_metadata(cache_key, string_payload, cache_bytes)
+
+        write_metadata_record(writer, url, warc_dict, string_payload, cdxj_out)
+    return (records_written, total_records_read, text_mime, non_text)
 
-            # Save the record metadata for each digest hash for possible reuse.
-            if warc_digest:
-                DIGEST_CACHE[warc_digest] = string_payload
-
-            meta_record = writer.create_warc_record(url,
-                                                    'metadata',
-                                                    payload=io.BytesIO(string_payload.encode()),
-                                                    warc_headers_dict=warc_dict
-                                                    )
-            writer.write_record(meta_record)
-        # Rewrite sidecar file if there are no metadata sidecar records to write.
-        if not records_written:
-            os.remove(meta_file_path)
-            logging.info('No metadata records to write, updating warcinfo')
-            with open(meta_file_path, 'ab') as output:
-                writer = WARCWriter(output, gzip=True)
-                warc_info['description'] += '; 0 metadata sidecar records'
+
+def find_record_offsets(warc_file, warc_cdxj=None):
+    """Return the sorted offsets of records in a WARC, always including 0.
+
+    The offsets are read from the WARC's CDXJ when one is given.
+    Otherwise the WARC is scanned for the start of each record.
+    """
+    offsets = {0}
+    if warc_cdxj:
+        filename = os.path.basename(warc_file)
+        with open(warc_cdxj, 'r') as cdxj:
+            for line in cdxj:
+                _, _, cdxj_obj = line.split(' ', 2)
+                cdxj_dict = json.loads(cdxj_obj)
+                cdxj_filename = os.path.basename(cdxj_dict.get('filename', filename))
+                if cdxj_filename == filename and 'offset' in cdxj_dict:
+                    offsets.add(int(cdxj_dict['offset']))
+    else:
+        with open(warc_file, 'rb') as stream:
+            archive_iterator = ArchiveIterator(stream)
+            for _ in archive_iterator:
+                offsets.add(archive_iterator.get_record_offset())
+    return sorted(offsets)
+
+
+def is_record_start(stream, offset):
+    """Return whether a WARC record, gzipped or not, starts at offset."""
+    stream.seek(offset)
+    try:
+        record = next(iter(ArchiveIterator(stream)))
+        return record.rec_headers.protocol.startswith(WARC_MAGIC.decode())
+    except Exception:
+        # Bytes that only look like the start of a record fail to decompress or parse.
+        return False
+
+
+def find_record_boundary(stream, position, end):
+    """Return the offset of the first record of a gzipped WARC at or after position, or end.
+
+    Only a gzip member that parses as a record is taken as its start.
+    """
+    search_from = position
+    while search_from < end:
+        stream.seek(search_from)
+        block = stream.read(BOUNDARY_SEARCH_BLOCK + len(GZIP_MAGIC) - 1)
+        if not block:
+            break
+        index = block.find(GZIP_MAGIC)
+        while -1 < index < BOUNDARY_SEARCH_BLOCK:
+            if is_record_start(stream, search_from + index):
+                return search_from + index
+            index = block.find(GZIP_MAGIC, index + 1)
+        search_from += BOUNDARY_SEARCH_BLOCK
+    return end
+
+
+def find_split_offsets(warc_file, workers):
+    """Return 0 and the first record offset after each of workers - 1 evenly spaced points.
+
+    In a gzipped WARC, only the bytes from each point to the next record
+    are read, so splitting it does not need a pass over all of it. An
+    uncompressed payload can hold text that parses as a record, so the
+    records of an uncompressed WARC are found by reading every record.
+    """
+    file_size = os.path.getsize(warc_file)
+    points = [file_size * number // workers for number in range(1, workers)]
+    offsets = {0}
+    with open(warc_file, 'rb') as stream:
+        compressed = stream.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        if compressed:
+            for point in points:
+                offsets.add(find_record_boundary(stream, point, file_size))
+            return sorted(offsets)
+    record_offsets = find_record_offsets(warc_file)
+    for point in points:
+        index = bisect.bisect_left(record_offsets, point)
+        offsets.add(record_offsets[index] if index < len(record_offsets) else file_size)
+    return sorted(offsets)
+
+
+def split_ranges(offsets, file_size, workers):
+    """Split a WARC into at most workers byte ranges of similar size, on record offsets."""
+    boundaries = [0]
+    for number in range(1, workers):
+        index = bisect.bisect_left(offsets, file_size * number // workers)
+        if index < len(offsets) and boundaries[-1] < offsets[index] < file_size:
+            boundaries.append(offsets[index])
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def init_range_worker(log_queue=None, log_level=logging.INFO):
+    """Detach a worker process from the parent's log handlers, which it cannot write to.
+
+    With a multiprocessing log_queue, the worker's records at log_level
+    and above are put on it, for a listener in the parent to handle.
+    """
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    if log_queue is not None:
+        root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        root_logger.setLevel(log_level)
+
+
+def write_range_records(range_job):
+    """Write the metadata records for one byte range of a WARC to a partial sidecar.
+
+    Runs in a worker process with its own ArchiveIterator and ExtendFido.
+    The partial sidecar has no warcinfo record. Returns the counts from
+    write_sidecar_records, the worker's process ID, and its peak memory.
+    """
+    (warc_file, start, end, part_path, cdxj_part_path, compress_level, compressor,
+     record_options) = range_job
+    with open(warc_file, 'rb') as stream, open(part_path, 'wb') as output, \
+         open(cdxj_part_path or os.devnull, 'wt') as cdxj_file:
+        stream.seek(start)
+        writer = SidecarWriter(output, compress_level, compressor)
+        cdxj_out = cdxj_file if cdxj_part_path else None
+        counts = write_sidecar_records(LimitReader(stream, end - start), writer, ExtendFido(),
+                                       True, cdxj_out, **record_options)
+    return counts, os.getpid(), peak_memory()
+
+
+def write_sidecar_records_parallel(warc_file, output, meta_file_path, workers, warc_cdxj=None,
+                                   cdxj_out=None, compress_level=COMPRESS_LEVEL,
+                                   compressor='zlib', record_options=None):
+    """Write the metadata records of a WARC by processing byte ranges in worker processes.
+
+    The WARC is split on record offsets into one range per worker, found
+    from the WARC's CDXJ or near evenly spaced points of the WARC. The
+    partial sidecars (and CDXJs) of the ranges are appended to output
+    (and cdxj_out) in record order. Returns the summed counts from
+    write_sidecar_records, and the summed peak memory of the workers.
+    """
+    if warc_cdxj:
+        offsets = find_record_offsets(warc_file, warc_cdxj)
+    else:
+        offsets = find_split_offsets(warc_file, workers)
+    ranges = split_ranges(offsets, os.path.getsize(warc_file), workers)
+    logging.info('Processing %s byte range(s) with %s worker(s)', len(ranges), workers)
+    range_jobs = []
+    part_paths = []
+    for number, (start, end) in enumerate(ranges):
+        part_path = '{}.part{}'.format(meta_file_path, number)
+        cdxj_part_path = part_path + '.cdxj' if cdxj_out else None
+        range_jobs.append((warc_file, start, end, part_path, cdxj_part_path, compress_level,
+                           compressor, record_options or {}))
+        part_paths.extend([part_path, cdxj_part_path] if cdxj_part_path else [part_path])
+
+    totals = [0, 0, 0, 0]
+    worker_peaks = {}
+    # The workers' log records are handled by the parent's handlers, in a listener thread.
+    root_logger = logging.getLogger()
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *root_logger.handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    pool = multiprocessing.Pool(workers, initializer=init_range_worker,
+                                initargs=(log_queue, root_logger.getEffectiveLevel()))
+    try:
+        for range_job, (counts, pid, peak) in zip(range_jobs,
+                                                  pool.imap(write_range_records, range_jobs)):
+            _, start, end, part_path, cdxj_part_path = range_job[:5]
+            with open(part_path, 'rb') as part:
+                shutil.copyfileobj(part, output)
+            os.remove(part_path)
+            if cdxj_part_path:
+                with open(cdxj_part_path, 'r') as cdxj_part:
+                    shutil.copyfileobj(cdxj_part, cdxj_out)
+                os.remove(cdxj_part_path)
+            totals = [total + count for total, count in zip(totals, counts)]
+            # A worker that processed several ranges is counted once, at its highest peak.
+            worker_peaks[pid] = max(peak, worker_peaks.get(pid, 0))
+            logging.info('Finished byte range %s-%s: %s records read, %s written',
+                         start, end, counts[1], counts[0])
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        # Workers that exit normally flush their queued log records before the listener stops.
+        pool.close()
+        pool.join()
+        listener.stop()
+        # A failed range leaves none of the partial sidecars and CDXJs behind.
+        for part_path in part_paths:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    return tuple(totals), sum(worker_peaks.values())
+
+
+def create_checkpoint_path(meta_file_path):
+    """Create the path of the checkpoint kept while following a growing WARC."""
+    return meta_file_path + '.checkpoint.json'
+
+
+def checkpoint_warc_path(warc_file):
+    """Return the path a checkpoint records for a WARC, the same before and after it closes."""
+    return os.path.abspath(re.sub(r'\.open$', '', warc_file))
+
+
+def read_checkpoint(checkpoint_path, warc_file=None):
+    """Return the saved follow checkpoint, or None if there is none.
+
+    Raises ValueError if the checkpoint was left by a WARC other than
+    warc_file, which only shares its sidecar name.
+    """
+    if not os.path.isfile(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if warc_file and (checkpoint_warc_path(checkpoint['warc_file'])
+                      != checkpoint_warc_path(warc_file)):
+        raise ValueError('{} was left by {}, not {}'.format(checkpoint_path,
+                                                            checkpoint['warc_file'], warc_file))
+    return checkpoint
+
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    """Save the follow checkpoint, replacing the previous one in a single step."""
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def find_complete_end(stream, start, end):
+    """Return the offset where the complete records between start and end of a WARC stop.
+
+    A record of a growing WARC is complete once the next record has
+    started after it, so this is the offset of the last record found.
+    """
+    stream.seek(start)
+    archive_iterator = ArchiveIterator(LimitReader(stream, end - start))
+    complete_end = start
+    try:
+        for _ in archive_iterator:
+            complete_end = start + archive_iterator.get_record_offset()
+    except Exception:
+        # A partly written record can fail to parse in several ways.
+        pass
+    return complete_end
+
+
+def follow_sidecar_records(stream, warc_file, writer, fido, checkpoint, checkpoint_path,
+                           warc=True, cdxj_out=None, poll_interval=FOLLOW_POLL_INTERVAL,
+                           idle_timeout=FOLLOW_IDLE_TIMEOUT, record_options=None):
+    """Write metadata records for a WARC that is still being written, until it is closed.
+
+    Complete records are processed as they are appended, starting from
+    the checkpoint's offset. A WARC ending in .open is closed when it is
+    renamed; any other WARC is closed once it has not grown for
+    idle_timeout seconds. The checkpoint is saved after each batch of
+    records. Returns the summed counts from write_sidecar_records and
+    whether the WARC was closed.
+    """
+    offset = checkpoint['offset']
+    totals = checkpoint['counts']
+    last_size = None
+    last_growth = time.time()
+    while True:
+        # Check for the rename before reading the size, so the size of a closed WARC is final.
+        closed = warc_file.endswith(OPEN_SUFFIX) and not os.path.exists(warc_file)
+        size = os.fstat(stream.fileno()).st_size
+        if size != last_size:
+            last_size = size
+            last_growth = time.time()
+        idle = time.time() - last_growth >= idle_timeout
+        if idle and not warc_file.endswith(OPEN_SUFFIX):
+            closed = True
+        end = size if closed else find_complete_end(stream, offset, size)
+        if end > offset:
+            stream.seek(offset)
+            counts = write_sidecar_records(LimitReader(stream, end - offset), writer, fido, warc,
+                                           cdxj_out, **(record_options or {}))
+            totals = [total + count for total, count in zip(totals, counts)]
+            offset = end
+            writer.out.flush()
+            if cdxj_out:
+                cdxj_out.flush()
+            checkpoint.update({'offset': offset,
+                               'counts': totals,
+                               'sidecar_size': writer.out.tell(),
+                               'cdxj_size': cdxj_out.tell() if cdxj_out else 0})
+            write_checkpoint(checkpoint_path, checkpoint)
+            logging.info('Followed %s to byte %s: %s records read, %s written',
+                         warc_file, offset, totals[1], totals[0])
+        if closed:
+            return (tuple(totals), True)
+        if idle:
+            logging.warning('%s has not grown for %s seconds, stopping', warc_file, idle_timeout)
+            return (tuple(totals), False)
+        time.sleep(poll_interval)
+
+
+def follow_directory(archive_dir, warc_dir, poll_interval=FOLLOW_POLL_INTERVAL,
+                     idle_timeout=FOLLOW_IDLE_TIMEOUT, sidecar_args=()):
+    """Follow each .open WARC that appears in warc_dir in its own process.
+
+    sidecar_args are the remaining positional arguments of
+    metadata_sidecar. Returns the followed WARCs once none are being
+    followed and no new ones have appeared for idle_timeout seconds.
+    """
+    followers = {}
+    last_active = time.time()
+    while True:
+        for filename in sorted(os.listdir(warc_dir)):
+            open_path = os.path.join(warc_dir, filename)
+            if OPEN_WARC.match(filename) and open_path not in followers:
+                follower = multiprocessing.Process(target=metadata_sidecar,
+                                                   args=(archive_dir, open_path) + sidecar_args)
+                follower.start()
+                followers[open_path] = follower
+        if any(follower.is_alive() for follower in followers.values()):
+            last_active = time.time()
+        elif time.time() - last_active >= idle_timeout:
+            break
+        time.sleep(poll_interval)
+    for follower in followers.values():
+        follower.join()
+    return sorted(followers)
+
+
+def metadata_sidecar(archive_dir, warc_file, operator=None, publisher=None, emit_cdxj=False,
+                     hostname=None, ip=None, log_level=logging.INFO,
+                     progress_interval=PROGRESS_INTERVAL, compress_level=COMPRESS_LEVEL,
+                     compressor='zlib', full_identification=False,
+                     lang_max_chars=LANG_MAX_CHARS, lang_samples=LANG_SAMPLES, workers=1,
+                     warc_cdxj=None, follow=False, poll_interval=FOLLOW_POLL_INTERVAL,
+                     idle_timeout=FOLLOW_IDLE_TIMEOUT, name=None, to_stdout=False, fido=None,
+                     sample_rate=None, sample_n=None, rules_file=None, max_memory=None):
+    start = time.time()
+    # The peak memory reported is this WARC's, not that of earlier work in a long-lived process.
+    reset_peak_memory()
+    workers_peak = 0
+    if warc_file == sidecar2cdxj.STDIO and not name:
+        raise ValueError('A name is required to name the sidecar of a WARC read from stdin')
+    if sample_n is not None and warc_file == sidecar2cdxj.STDIO:
+        raise ValueError('A sample of a number of records cannot be taken from stdin')
+    rules = load_rules(rules_file) if rules_file else None
+    payload_limit = cache_bytes = detector_limits = None
+    if max_memory:
+        workers, payload_limit, cache_bytes, detector_limits = plan_memory(max_memory, workers)
+
+    if not os.path.isdir(archive_dir):
+        os.mkdir(archive_dir)
+
+    with sidecar_logging(archive_dir, log_level):
+        logging.info('Logging WARC metadata record information for %s', warc_file)
+        if max_memory:
+            logging.info('Memory limit %s MB: %s worker(s), %s MB payload limit, %s MB cache, '
+                         'detector limits %s', max_memory // 2 ** 20, workers,
+                         payload_limit // 2 ** 20, cache_bytes // 2 ** 20,
+                         ', '.join('{} {} KB'.format(detector, limit // 2 ** 10)
+                                   for detector, limit in sorted(detector_limits.items())))
+
+        # Create sidecar filename, adding 'meta' as extension. A WARC being written is named
+        # for the WARC it will become.
+        new_file = re.sub(r'\.open$', '', os.path.basename(name or warc_file))
+        meta_file = re.sub(r'w?arc(\.gz)?$', 'warc.meta.gz', new_file)
+        logging.info('Creating sidecar %s', meta_file)
+        meta_file_path = os.path.join(archive_dir, meta_file)
+        # A sidecar streamed to stdout is still named for the CDXJ and the warcinfo record.
+        output_path = sidecar2cdxj.STDIO if to_stdout else meta_file_path
+        report_file = sys.stderr if to_stdout else sys.stdout
+        # Determine the type of file we are processing, WARC or ARC.
+        warc = True
+        if ARC.match(new_file):
+            warc = False
+
+        # The sidecar CDXJ lines can be written as each record is written, saving a second pass.
+        cdxj_path = None
+        if emit_cdxj:
+            cdxj_path = sidecar2cdxj.create_cdxj_path(meta_file_path, archive_dir)
+            logging.info('Creating sidecar CDXJ %s', cdxj_path)
+
+        checkpoint_path = create_checkpoint_path(meta_file_path)
+        checkpoint = read_checkpoint(checkpoint_path, warc_file) if follow else None
+        closed = True
+
+        # A sample of a number of records takes the records with the lowest sample values,
+        # found by a first pass over the record headers.
+        sampler = None
+        if sample_n is not None:
+            sampler = Sampler(find_sample_threshold(warc_file, sample_n, rules))
+        elif sample_rate is not None:
+            sampler = Sampler(sample_rate)
+        if sampler:
+            logging.info('Sampling records below sample value %s', sampler.threshold)
+
+        # Open the sidecar file to write in the metadata, open the warc file to get each record.
+        with sidecar2cdxj.open_stream(output_path, 'ab') as output, \
+             sidecar2cdxj.open_stream(warc_file, 'rb') as stream, \
+             open(cdxj_path or os.devnull, 'at') as cdxj_file:
+            cdxj_out = cdxj_file if emit_cdxj else None
+            # A long-lived caller can pass an ExtendFido that has already loaded its signatures.
+            if fido is None:
+                fido = ExtendFido()
+            total_bytes = None
+            if warc_file != sidecar2cdxj.STDIO:
+                total_bytes = os.path.getsize(warc_file)
+            progress = ProgressReporter(stream, total_bytes, progress_interval)
+
+            writer = SidecarWriter(output, compress_level, compressor)
+            warc_info = create_warcinfo_payload(new_file, operator, publisher, hostname, ip)
+            if sampler:
+                warc_info['description'] += '; sample of records below sample value {}'.format(
+                    sampler.threshold)
+            if checkpoint:
+                # Drop anything written after the checkpoint by an interrupted follow.
+                output.truncate(checkpoint['sidecar_size'])
+                if cdxj_out:
+                    cdxj_file.truncate(checkpoint['cdxj_size'])
+                logging.info('Resuming from byte %s', checkpoint['offset'])
+            else:
                 # Create warcinfo record and write it into sidecar.
                 warcinfo_record = writer.create_warcinfo_record(meta_file, warc_info)
                 writer.write_record(warcinfo_record)
 
-        logging.info('Finished creating sidecar in %s',
+            record_options = {'full_identification': full_identification,
+                              'lang_max_chars': lang_max_chars,
+                              'lang_samples': lang_samples,
+                              'rules': rules,
+                              'payload_limit': payload_limit,
+                              'cache_bytes': cache_bytes,
+                              'detector_limits': detector_limits}
+            if follow:
+                if not checkpoint:
+                    output.flush()
+                    checkpoint = {'warc_file': checkpoint_warc_path(warc_file),
+                                  'offset': 0,
+                                  'counts': [0, 0, 0, 0],
+                                  'sidecar_size': output.tell(),
+                                  'cdxj_size': 0}
+                    write_checkpoint(checkpoint_path, checkpoint)
+                counts, closed = follow_sidecar_records(stream, warc_file, writer, fido,
+                                                        checkpoint, checkpoint_path, warc,
+                                                        cdxj_out, poll_interval, idle_timeout,
+                                                        record_options)
+                if closed:
+                    os.remove(checkpoint_path)
+            elif workers > 1 and warc and warc_file != sidecar2cdxj.STDIO and not sampler:
+                try:
+                    counts, workers_peak = write_sidecar_records_parallel(
+                        warc_file, output, meta_file_path, workers, warc_cdxj, cdxj_out,
+                        compress_level, compressor, record_options)
+                except BaseException:
+                    # A sidecar missing the records of a failed range is not left behind.
+                    for path in [None if to_stdout else meta_file_path, cdxj_path]:
+                        if path and os.path.exists(path):
+                            os.remove(path)
+                    raise
+                # The workers read the WARC, so the parent's stream has no progress to report.
+                progress = None
+            else:
+                counts = write_sidecar_records(stream, writer, fido, warc, cdxj_out, progress,
+                                               sampler=sampler, **record_options)
+            records_written, total_records_read, text_mime, non_text = counts
+            if progress:
+                progress.report(total_records_read, records_written)
+            # Rewrite sidecar file if there are no metadata sidecar records to write.
+            if not records_written and closed and not to_stdout:
+                os.remove(meta_file_path)
+                logging.info('No metadata records to write, updating warcinfo')
+                with open(meta_file_path, 'ab') as output:
+                    writer = SidecarWriter(output, compress_level, compressor)
+                    warc_info['description'] += '; 0 metadata sidecar records'
+                    # Create warcinfo record and write it into sidecar.
+                    warcinfo_record = writer.create_warcinfo_record(meta_file, warc_info)
+                    writer.write_record(warcinfo_record)
+
+            logging.info('Finished creating sidecar in %s',
+                         str(timedelta(seconds=(time.time() - start))))
+            logging.info('Determined sidecar information for %s response/resource record(s)',
+                         records_written)
+        if sampler:
+            summary = dict(sampler.summary(), warc_file=new_file, sample_rate=sample_rate,
+                           sample_n=sample_n)
+            sample_path = create_sample_path(meta_file_path)
+            write_sample_summary(sample_path, summary)
+            logging.info('Sampled %s of %s records, summary in %s', sampler.chosen,
+                         sampler.population, sample_path)
+        # The peaks of parallel workers are added, a bound on the memory used at once.
+        peak_mb = round((peak_memory() + workers_peak) / 2 ** 20, 1)
+        logging.info('Peak memory for this WARC: %s MB', peak_mb)
+        mime_type_records = text_mime + non_text
+        if max_memory:
+            print('Peak memory for this WARC: {} MB'.format(peak_mb), file=report_file)
+        print('Records with Mime Types: ' + str(mime_type_records), file=report_file)
+        logging.info('Total Records for this WARC file: %s', total_records_read)
+        print('Total Records for this WARC file:', total_records_read, file=report_file)
+    return (output_path, total_records_read, mime_type_records)
+
+
+def iter_keyed_records(stream, warc=True):
+    """Yield each response or resource record of a WARC/ARC stream with its matching key.
+
+    The key is the WARC-Record-ID of a WARC record, which is the
+    WARC-Concurrent-ID of its sidecar record, or the URI and date of an
+    ARC record.
+    """
+    for record in ArchiveIterator(stream, arc2warc=True):
+        if record.rec_type not in ['response', 'resource']:
+            continue
+        if warc:
+            yield (record.rec_headers.get_header('WARC-Record-ID'), record)
+        else:
+            yield ((record.rec_headers.get_header('WARC-Target-URI'),
+                    record.rec_headers.get_header('WARC-Date')), record)
+
+
+def refresh_payload(detector, string_payload, record, fido=None, full_identification=False,
+                    lang_max_chars=LANG_MAX_CHARS, lang_samples=LANG_SAMPLES):
+    """Rerun one detector on a record and replace its fields in the sidecar payload.
+
+    Whether the detector applies is decided from the mimetypes already
+    in the payload, as when the sidecar was created. Returns the new
+    payload, or None if the detector does not apply to the record.
+    """
+    fields = parse_string_payload(string_payload)
+    mimes_found = ' '.join(json.loads(fields.get(MIME_TITLE, '{}')).values())
+    is_text = TEXT_FORMAT_MIMES.search(mimes_found)
+    if detector in ['charset', 'lang'] and not is_text:
+        return None
+    if detector == 'soft404':
+        status = record.http_headers.get_statuscode() if record.http_headers else None
+        if not (is_text and status == '200' and 'html' in mimes_found):
+            return None
+    payload = io.BytesIO(record.content_stream().read())
+    if detector == 'puid':
+        mime_dict, puid = find_mime_and_puid(fido, payload, full_identification)
+        refreshed = create_string_payload(mime_dict, puid, {}, None, None)
+    elif detector == 'charset':
+        refreshed = create_string_payload({}, None, find_character_set(payload), None, None)
+    elif detector == 'lang':
+        lang_cld = find_language(payload.getvalue(), 'html' in mimes_found, lang_max_chars,
+                                 lang_samples)
+        refreshed = create_string_payload({}, None, {}, lang_cld, None)
+    else:
+        refreshed = create_string_payload({}, None, {}, None,
+                                          determine_soft404(payload.getvalue()))
+    for title in REFRESH_TITLES[detector]:
+        fields.pop(title, None)
+    if refreshed:
+        fields.update(parse_string_payload(refreshed))
+    return join_string_payload(fields)
+
+
+def refresh_sidecar(archive_dir, warc_file, detector, emit_cdxj=False, log_level=logging.INFO,
+                    compress_level=COMPRESS_LEVEL, compressor='zlib', full_identification=False,
+                    lang_max_chars=LANG_MAX_CHARS, lang_samples=LANG_SAMPLES, fido=None):
+    """Rerun one detector over an existing sidecar, copying every other field.
+
+    The sidecar in archive_dir and the WARC it was created from are read
+    in step. Only the payloads of records the detector applies to are
+    read from the WARC; the other records are copied. The refreshed
+    sidecar (and CDXJ) replace the old ones. Returns the sidecar path and
+    the numbers of records refreshed and copied.
+    """
+    start = time.time()
+    with sidecar_logging(archive_dir, log_level):
+        meta_file = re.sub(r'w?arc(\.gz)?$', 'warc.meta.gz', os.path.basename(warc_file))
+        meta_file_path = os.path.join(archive_dir, meta_file)
+        logging.info('Refreshing %s in sidecar %s from %s', detector, meta_file, warc_file)
+        warc = not ARC.match(os.path.basename(warc_file))
+        if detector == 'puid' and fido is None:
+            fido = ExtendFido()
+        cdxj_path = None
+        if emit_cdxj:
+            cdxj_path = sidecar2cdxj.create_cdxj_path(meta_file_path, archive_dir)
+        # Payloads with the same digest and old fields get the same refreshed fields.
+        refreshed_cache = {}
+        records_refreshed = 0
+        records_copied = 0
+
+        with open(meta_file_path, 'rb') as old_stream, open(warc_file, 'rb') as stream, \
+             open(meta_file_path + '.tmp', 'wb') as output, \
+             open(cdxj_path + '.tmp' if cdxj_path else os.devnull, 'wt') as cdxj_file:
+            cdxj_out = cdxj_file if emit_cdxj else None
+            writer = SidecarWriter(output, compress_level, compressor)
+            keyed_records = iter_keyed_records(stream, warc)
+            for old_record in ArchiveIterator(old_stream):
+                if old_record.rec_type == 'warcinfo':
+                    warc_info = parse_warcinfo(old_record)
+                    warc_info['description'] = '{}; {} refreshed'.format(
+                        warc_info.get('description', ''), detector)
+                    writer.write_record(writer.create_warcinfo_record(meta_file, warc_info))
+                    continue
+                url = old_record.rec_headers.get_header('WARC-Target-URI')
+                warc_dict = {'WARC-Date': old_record.rec_headers.get_header('WARC-Date')}
+                for header in ['WARC-Concurrent-ID', 'WARC-Warcinfo-ID']:
+                    if old_record.rec_headers.get_header(header):
+                        warc_dict[header] = old_record.rec_headers.get_header(header)
+                key = warc_dict.get('WARC-Concurrent-ID') or (url, warc_dict['WARC-Date'])
+                for record_key, record in keyed_records:
+                    if record_key == key:
+                        break
+                else:
+                    raise ValueError('No record of {} matches the sidecar record of {}'.format(
+                        warc_file, url))
+
+                old_payload = old_record.content_stream().read().decode('utf-8')
+                cache_key = (record.rec_headers.get_header('WARC-Payload-Digest'), old_payload)
+                if cache_key[0] and cache_key in refreshed_cache:
+                    string_payload = refreshed_cache[cache_key]
+                else:
+                    string_payload = refresh_payload(detector, old_payload, record, fido,
+                                                     full_identification, lang_max_chars,
+                                                     lang_samples)
+                    if cache_key[0]:
+                        refreshed_cache[cache_key] = string_payload
+                if string_payload is None:
+                    string_payload = old_payload
+                    records_copied += 1
+                else:
+                    records_refreshed += 1
+                write_metadata_record(writer, url, warc_dict, string_payload, cdxj_out)
+        os.replace(meta_file_path + '.tmp', meta_file_path)
+        if cdxj_path:
+            os.replace(cdxj_path + '.tmp', cdxj_path)
+
+        logging.info('Finished refreshing sidecar in %s',
                      str(timedelta(seconds=(time.time() - start))))
-        logging.info('Determined sidecar information for %s response/resource record(s)',
-                     records_written)
-    mime_type_records = text_mime + non_text
-    print('Records with Mime Types: ' + str(mime_type_records))
-    logging.info('Total Records for this WARC file: %s', total_records_read)
-    print('Total Records for this WARC file:', total_records_read)
-    return (meta_file_path, total_records_read, mime_type_records)
+        logging.info('Refreshed %s record(s), copied %s record(s)', records_refreshed,
+                     records_copied)
+        print('Refreshed {} record(s), copied {} record(s)'.format(
+            records_refreshed, records_copied))
+    return (meta_file_path, records_refreshed, records_copied)
 
 
 def main():
@@ -313,7 +1688,8 @@ def main():
     parser.add_argument(
         'warc_file',
         action='store',
-        help='A WARC file that will be used to generate a sidecar with metadata.'
+        help='A WARC file that will be used to generate a sidecar with metadata, - to read the '
+             'WARC from stdin, or with --follow, a directory of WARCs being written.'
     )
     parser.add_argument(
         '--operator',
@@ -327,8 +1703,210 @@ def main():
         default='University of North Texas - Digital Projects Unit',
         help='The name of the institute or department to produce the metadata sidecar WARC file.'
     )
+    parser.add_argument(
+        '--emit-cdxj',
+        action='store_true',
+        default=False,
+        help='Write the sidecar CDXJ while the sidecar is created, instead of running '
+             'sidecar2cdxj.py on the finished sidecar.'
+    )
+    parser.add_argument(
+        '--hostname',
+        action='store',
+        default=None,
+        help='The hostname recorded in the warcinfo record. Defaults to SIDECAR_HOSTNAME '
+             'or the name of this host.'
+    )
+    parser.add_argument(
+        '--ip',
+        action='store',
+        default=None,
+        help='The IP address recorded in the warcinfo record. Defaults to SIDECAR_IP '
+             'or the address of the outgoing network interface, found without DNS.'
+    )
+    parser.add_argument(
+        '--log-level',
+        action='store',
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help='The verbosity of sidecar.log. DEBUG also logs the URL of every record.'
+    )
+    parser.add_argument(
+        '--progress-interval',
+        action='store',
+        type=float,
+        default=PROGRESS_INTERVAL,
+        help='The number of seconds between progress summaries in the log, 0 to disable.'
+    )
+    parser.add_argument(
+        '--compress-level',
+        action='store',
+        type=int,
+        default=COMPRESS_LEVEL,
+        choices=range(10),
+        help='The gzip compression level of each sidecar record.'
+    )
+    parser.add_argument(
+        '--compressor',
+        action='store',
+        default='zlib',
+        choices=sorted(COMPRESSORS),
+        help='The deflate implementation used to compress the sidecar. isal and zlib-ng are '
+             'available when the isal and zlib-ng packages are installed.'
+    )
+    parser.add_argument(
+        '--full-identification',
+        action='store_true',
+        default=False,
+        help='Identify every payload with fido and python-magic, instead of identifying '
+             'common formats from their magic numbers.'
+    )
+    parser.add_argument(
+        '--lang-max-chars',
+        action='store',
+        type=int,
+        default=LANG_MAX_CHARS,
+        help='The number of characters of text used for language detection, taken as evenly '
+             'spaced samples of longer text. 0 uses all of the text.'
+    )
+    parser.add_argument(
+        '--lang-samples',
+        action='store',
+        type=int,
+        default=LANG_SAMPLES,
+        help='The number of evenly spaced samples taken from text longer than --lang-max-chars.'
+    )
+    parser.add_argument(
+        '--workers',
+        action='store',
+        type=int,
+        default=1,
+        help='The number of worker processes. A WARC is split into byte ranges on record '
+             'boundaries, one per worker, and the partial sidecars are joined in record order.'
+    )
+    parser.add_argument(
+        '--warc-cdxj',
+        action='store',
+        default=None,
+        help='A CDXJ of the WARC, used with --workers to find record offsets without '
+             'scanning the WARC.'
+    )
+    parser.add_argument(
+        '--follow',
+        action='store_true',
+        default=False,
+        help='Process records as they are appended to a WARC that is still being written, '
+             'until it is renamed from .open. With a directory, follow each .open WARC in it.'
+    )
+    parser.add_argument(
+        '--poll-interval',
+        action='store',
+        type=float,
+        default=FOLLOW_POLL_INTERVAL,
+        help='The number of seconds between checks for new records with --follow.'
+    )
+    parser.add_argument(
+        '--idle-timeout',
+        action='store',
+        type=float,
+        default=FOLLOW_IDLE_TIMEOUT,
+        help='The number of seconds without new records before --follow stops.'
+    )
+    parser.add_argument(
+        '--name',
+        action='store',
+        default=None,
+        help='The file name of a WARC read from stdin, used to name the sidecar, the CDXJ, '
+             'and the warcinfo record.'
+    )
+    parser.add_argument(
+        '--stdout',
+        action='store_true',
+        default=False,
+        help='Write the sidecar to stdout instead of archive_dir. The record counts are '
+             'printed to stderr.'
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store',
+        default=None,
+        choices=sorted(REFRESH_TITLES),
+        help='Rerun only this detector over the existing sidecar in archive_dir, reading the '
+             'payloads it needs from the WARC and copying every other field.'
+    )
+    parser.add_argument(
+        '--sample-rate',
+        action='store',
+        type=float,
+        default=None,
+        help='Analyze only this fraction of the response and resource records, chosen by a '
+             'hash of their URI and payload digest, and write a summary of the sample with '
+             'confidence intervals.'
+    )
+    parser.add_argument(
+        '--sample-n',
+        action='store',
+        type=int,
+        default=None,
+        help='Analyze only this number of records, those with the lowest hashes, and write a '
+             'summary of the sample with confidence intervals.'
+    )
+    parser.add_argument(
+        '--rules',
+        action='store',
+        default=None,
+        help='A JSON file of include and exclude rules on SURT prefix, URL regex, declared '
+             'Content-Type, and payload length, checked before a payload is read. A rule can '
+             'limit the detectors run on the records it includes.'
+    )
+    parser.add_argument(
+        '--max-memory',
+        action='store',
+        type=parse_memory_size,
+        default=None,
+        help='The memory budget, such as 2G, that limits the number of workers, the bytes of '
+             'a payload that are read and that each detector is given, and the size of the '
+             'digest cache. The peak memory of the WARC is reported.'
+    )
     args = parser.parse_args()
-    metadata_sidecar(args.archive_dir, args.warc_file, args.operator, args.publisher)
+    if args.refresh:
+        refresh_sidecar(args.archive_dir, args.warc_file, args.refresh, args.emit_cdxj,
+                        args.log_level, args.compress_level, args.compressor,
+                        args.full_identification, args.lang_max_chars, args.lang_samples)
+        return
+    if args.warc_file == sidecar2cdxj.STDIO and not args.name:
+        parser.error('--name is required to read a WARC from stdin')
+    if args.follow and (args.warc_file == sidecar2cdxj.STDIO or args.stdout):
+        parser.error('--follow cannot read from stdin or write to stdout')
+    if args.sample_rate is not None and args.sample_n is not None:
+        parser.error('--sample-rate and --sample-n cannot be used together')
+    if args.sample_rate is not None and not 0 <= args.sample_rate <= 1:
+        parser.error('--sample-rate must be between 0 and 1')
+    if args.sample_n is not None and args.warc_file == sidecar2cdxj.STDIO:
+        parser.error('--sample-n cannot read from stdin, use --sample-rate')
+    if args.follow and (args.sample_rate is not None or args.sample_n is not None):
+        parser.error('--follow cannot be used with --sample-rate or --sample-n')
+    if args.max_memory:
+        try:
+            plan_memory(args.max_memory)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.rules:
+        try:
+            load_rules(args.rules)
+        except (OSError, ValueError) as e:
+            parser.error('invalid rules file {}: {}'.format(args.rules, e))
+    sidecar_args = (args.operator, args.publisher, args.emit_cdxj, args.hostname, args.ip,
+                    args.log_level, args.progress_interval, args.compress_level,
+                    args.compressor, args.full_identification, args.lang_max_chars,
+                    args.lang_samples, args.workers, args.warc_cdxj, args.follow,
+                    args.poll_interval, args.idle_timeout, args.name, args.stdout, None,
+                    args.sample_rate, args.sample_n, args.rules, args.max_memory)
+    if args.follow and os.path.isdir(args.warc_file):
+        follow_directory(args.archive_dir, args.warc_file, args.poll_interval,
+                         args.idle_timeout, sidecar_args)
+    else:
+        metadata_sidecar(args.archive_dir, args.warc_file, *sidecar_args)
 
 
 if __name__ == '__main__':